@@ -1,3 +1,9 @@
+import contextlib
+import os
+import shlex
+import shutil
+import time
+
 from fbuild.builders.pkg_config import PkgConfig
 from fbuild.builders.platform import guess_platform
 from fbuild.builders import find_program
@@ -16,13 +22,27 @@ def arguments(parser):
     group.add_argument('--cxx', help='Use the given C++ compiler')
     group.add_argument('--cxxflag', help='Pass the given flag to the C++ compiler',
                        action='append', default=[])
+    group.add_argument('--compiler-cache', metavar='PROGRAM',
+                       help='Run the C and C++ compilers through the given compiler '
+                            'cache, e.g. ccache or sccache')
+    group.add_argument('--enable-gpu', help="Build Skia's OpenGL backend",
+                       action='store_true', default=False)
     group.add_argument('--enable-profiler', help="Enable gperftools' libprofiler",
                        action='store_true', default=False)
     group.add_argument('--no-force-color',
                        help='Disable forced C++ compiler colored output',
                        action='store_true', default=False)
+    group.add_argument('--no-skia-simd',
+                       help="Build only Skia's portable code, without the SSE/AVX "
+                            'blitters and runtime CPU dispatch',
+                       action='store_true', default=False)
     group.add_argument('--release', help='Build in release mode', action='store_true',
                        default=False)
+    group.add_argument('--pgo-generate', metavar='DIR',
+                       help='Build with profiling instrumentation, which writes the '
+                            'profile into DIR (see pgo.sh)')
+    group.add_argument('--pgo-use', metavar='DIR',
+                       help='Build in release mode, optimized using the profile in DIR')
     group.add_argument('--ld',
                        help='The name of the linker to try to use. Default is ' \
                              'lld for Clang and gold for other compilers.')
@@ -53,6 +73,24 @@ def pkg_config(ctx, package, *, name=None, optional=False, suffix=''):
         return rec
 
 
+@fbuild.db.caches
+def compiler_cache_wrapper(ctx, launcher, compiler):
+    # fbuild wants a single program for each compiler, so the cache is put in front of
+    # it by a script. It keeps the compiler's name, which fbuild goes by too.
+    compiler = find_program(ctx, [compiler])
+    outdir = ctx.buildroot / 'compiler-cache'
+    wrapper = outdir / os.path.basename(compiler)
+
+    os.makedirs(outdir, exist_ok=True)
+    with open(wrapper, 'w') as f:
+        f.write('#!/bin/sh\nexec %s %s "$@"\n' % (shlex.quote(launcher),
+                                                   shlex.quote(compiler)))
+    os.chmod(wrapper, 0o755)
+
+    ctx.db.add_external_dependencies_to_call(dsts=[wrapper])
+    return wrapper
+
+
 @fbuild.db.caches
 def configure(ctx):
     platform = guess_platform(ctx)
@@ -73,29 +111,65 @@ def configure(ctx):
         clang_flags.append('-fuse-ld=lld')
         nonclang_flags.append('-fuse-ld=gold')
 
-    if ctx.options.release:
+    if ctx.options.pgo_generate and ctx.options.pgo_use:
+        raise fbuild.ConfigFailed('--pgo-generate and --pgo-use are mutually exclusive.')
+
+    # The profile is only useful if it was collected from (and applied to) the same
+    # optimized code that ships, so both PGO stages imply --release.
+    if ctx.options.release or ctx.options.pgo_generate or ctx.options.pgo_use:
         kw['optimize'] = True
         posix_flags.append('-flto')
     else:
         kw['debug'] = True
         clang_flags.append('-fno-limit-debug-info')
 
+    # Clang writes one raw profile per process, which pgo.sh merges into uterm.profdata
+    # with llvm-profdata. GCC merges its .gcda files itself, but finds them by the
+    # objects' paths, so both stages have to use the same build directory.
+    clang_pgo_flags = []
+    gcc_pgo_flags = []
+
+    if ctx.options.pgo_generate:
+        profile_dir = os.path.abspath(ctx.options.pgo_generate)
+        clang_pgo_flags.append('-fprofile-instr-generate=%s' %
+                               os.path.join(profile_dir, 'uterm-%p.profraw'))
+        gcc_pgo_flags.extend(['-fprofile-generate', '-fprofile-dir=%s' % profile_dir,
+                              '-fprofile-update=atomic'])
+    elif ctx.options.pgo_use:
+        profile_dir = os.path.abspath(ctx.options.pgo_use)
+        clang_pgo_flags.extend([
+            '-fprofile-instr-use=%s' % os.path.join(profile_dir, 'uterm.profdata'),
+            # Code the training run never reached (e.g. the window) has no profile.
+            '-Wno-profile-instr-unprofiled',
+        ])
+        gcc_pgo_flags.extend(['-fprofile-use', '-fprofile-dir=%s' % profile_dir,
+                              '-fprofile-correction', '-Wno-missing-profile'])
+
     if not ctx.options.no_force_color:
         posix_flags.append('-fdiagnostics-color')
 
-    c = guess_c.static(ctx, exe=ctx.options.cc, flags=ctx.options.cflag,
+    cc_exe = ctx.options.cc
+    cxx_exe = ctx.options.cxx
+
+    if ctx.options.compiler_cache is not None:
+        launcher = find_program(ctx, [ctx.options.compiler_cache])
+        cc_exe = compiler_cache_wrapper(ctx, launcher, cc_exe or 'cc')
+        cxx_exe = compiler_cache_wrapper(ctx, launcher, cxx_exe or 'c++')
+
+    c = guess_c.static(ctx, exe=cc_exe, flags=ctx.options.cflag,
                        platform_options=[
                             ({'posix'}, {'flags+': posix_flags}),
-                            ({'clang'}, {'flags+': clang_flags}),
+                            ({'clang'}, {'flags+': clang_flags + clang_pgo_flags}),
+                            ({'!clang'}, {'flags+': gcc_pgo_flags}),
                        ], **kw)
 
-    cxx = guess_cxx.static(ctx, exe=ctx.options.cxx, flags=ctx.options.cxxflag,
+    cxx = guess_cxx.static(ctx, exe=cxx_exe, flags=ctx.options.cxxflag,
                            platform_options=[
                             ({'posix'}, {'flags+': ['-std=c++11'] + posix_flags}),
-                            ({'clang++'}, {'flags+': clang_flags,
+                            ({'clang++'}, {'flags+': clang_flags + clang_pgo_flags,
                                             'macros':
                                                 ['__CLANG_SUPPORT_DYN_ANNOTATION__']}),
-                            ({'!clang++'}, {'flags+': nonclang_flags}),
+                            ({'!clang++'}, {'flags+': nonclang_flags + gcc_pgo_flags}),
                            ], **kw)
 
     xkbcommon = pkg_config(ctx, 'xkbcommon', optional=True)
@@ -194,15 +268,37 @@ def build_fmtlib(ctx, cxx):
                                                     include_source_dirs=False))
 
 
+@fbuild.db.caches
+def patch_libtsm(ctx):
+    # The patches only add files, so rather than touching the submodule, they're
+    # applied to an empty directory that's searched before it.
+    patch_file = Path('patches/libtsm-sb-pop.patch')
+    outdir = ctx.buildroot / 'libtsm-patched'
+    tsm = outdir / 'src' / 'tsm'
+
+    patch = find_program(ctx, ['patch'])
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.makedirs(outdir)
+    ctx.execute([patch, '-p1', '-d', outdir, '-i', os.path.abspath(patch_file)], 'patch',
+                patch_file, color='compile', stdout_quieter=1)
+
+    ctx.db.add_external_dependencies_to_call(
+        srcs=[patch_file],
+        dsts=[tsm / 'libtsm-sb.h', tsm / 'tsm-sb.c'],
+    )
+    return tsm
+
+
 def build_libtsm(ctx, c, xkbcommon):
     base = Path('deps/libtsm')
     src = base / 'src'
     shl = src / 'shared'
     tsm = src / 'tsm'
+    patched = patch_libtsm(ctx)
 
-    sources = Path.glob(tsm / '*.c') + [shl / 'shl-htable.c',
+    sources = Path.glob(tsm / '*.c') + [patched / 'tsm-sb.c', shl / 'shl-htable.c',
                                         base / 'external' / 'wcwidth.c']
-    includes = [shl, tsm, base]
+    includes = [patched, shl, tsm, base]
 
     if xkbcommon is not None:
         cflags = xkbcommon.cflags
@@ -221,7 +317,45 @@ def skia_sources(*globs):
     return prefixed_sources('deps/skia/src', globs)
 
 
-def build_skia(ctx, platform, cxx, freetype, fontconfig):
+X86_MACHINES = {'x86_64', 'amd64', 'i386', 'i486', 'i586', 'i686'}
+
+# Skia's SIMD code, grouped by the instruction set each file has to be compiled for.
+# Only the SSE2 group is used unconditionally; SkOpts::Init and opts_check_x86.cpp check
+# SkCpu at runtime before calling into any of the others, so the library still runs on
+# CPUs that lack them.
+SKIA_X86_OPTS = [
+    (['-msse2'], [
+        'opts/SkBitmapProcState_opts_SSE2.cpp',
+        'opts/SkBlitRow_opts_SSE2.cpp',
+        'opts/SkBlitMask_opts_none.cpp',
+        'opts/opts_check_x86.cpp',
+    ]),
+    (['-mssse3'], [
+        'opts/SkBitmapProcState_opts_SSSE3.cpp',
+        'opts/SkOpts_ssse3.cpp',
+    ]),
+    (['-msse4.1'], ['opts/SkOpts_sse41.cpp']),
+    (['-msse4.2'], ['opts/SkOpts_sse42.cpp']),
+    (['-mavx'], ['opts/SkOpts_avx.cpp']),
+]
+
+# The portable fallback. SkOpts.cpp still refers to the per-ISA Init functions on x86,
+# so those files are built too, but for the baseline instruction set, which makes them
+# install the same code the defaults already use.
+SKIA_PORTABLE_OPTS = [
+    ([], [
+        'opts/SkBitmapProcState_opts_none.cpp',
+        'opts/SkBlitRow_opts_none.cpp',
+        'opts/SkBlitMask_opts_none.cpp',
+        'opts/SkOpts_ssse3.cpp',
+        'opts/SkOpts_sse41.cpp',
+        'opts/SkOpts_sse42.cpp',
+        'opts/SkOpts_avx.cpp',
+    ]),
+]
+
+
+def build_skia(ctx, platform, cxx, freetype, fontconfig, gpu, simd):
     srcs = [
         # core
         'c/sk_paint.cpp',
@@ -539,22 +673,6 @@ def build_skia(ctx, platform, cxx, freetype, fontconfig):
         'sfnt/SkOTUtils.cpp',
         'ports/SkDebug_stdio.cpp',
 
-        # opts
-        'opts/SkBlitRow_opts_none.cpp',
-        'opts/SkBlitMask_opts_none.cpp',
-        'opts/SkBitmapProcState_opts_none.cpp',
-        # 'opts/SkBitmapProcState_opts_SSE2.cpp',
-        # 'opts/SkBlitRow_opts_SSE2.cpp',
-        # 'opts/SkBlitMask_opts_none.cpp',
-
-        # 'opts/SkBitmapProcState_opts_SSSE3.cpp',
-        'opts/SkOpts_ssse3.cpp',
-
-        'opts/SkOpts_sse41.cpp',
-        'opts/SkOpts_sse42.cpp',
-        'opts/SkOpts_avx.cpp',
-        # 'opts/opts_check_x86.cpp',
-
         # effects
         'ports/SkGlobalInitialization_none.cpp',
 
@@ -609,11 +727,65 @@ def build_skia(ctx, platform, cxx, freetype, fontconfig):
     sources = skia_sources(*srcs)
     sources.append('deps/skia/third_party/gif/SkGifImageReader.cpp')
 
+    if gpu:
+        # The GL interface is assembled from GLFW's glfwGetProcAddress at runtime, so
+        # none of the platform-specific native interfaces are needed.
+        sources.extend(prefixed_sources('deps/skia/src', [
+            'gpu/*.cpp',
+            'gpu/ccpr/*.cpp',
+            'gpu/ddl/*.cpp',
+            'gpu/effects/*.cpp',
+            'gpu/gl/*.cpp',
+            'gpu/gl/builders/*.cpp',
+            'gpu/glsl/*.cpp',
+            'gpu/mock/*.cpp',
+            'gpu/ops/*.cpp',
+            'gpu/text/*.cpp',
+        ], glob=True))
+        sources.extend(skia_sources(
+            'image/SkImage_Gpu.cpp',
+            'image/SkSurface_Gpu.cpp',
+        ))
+        macros = ['SK_SUPPORT_GPU=1']
+    else:
+        macros = ['SK_SUPPORT_GPU=0']
+
     public_includes = Path.glob('deps/skia/include/*')
-    lib = cxx.build_lib('skia', sources, macros=['SK_SUPPORT_GPU=0'],
-                        includes=Path.glob('deps/skia/src/*') + public_includes + \
-                                 ['deps/skia/third_party/gif'], cflags=cflags)
-    return Record(includes=public_includes, lib=lib, ldlibs=ldlibs)
+    includes = Path.glob('deps/skia/src/*') + public_includes + \
+               ['deps/skia/third_party/gif']
+
+    if simd and os.uname().machine in X86_MACHINES:
+        opts = SKIA_X86_OPTS
+    else:
+        opts = SKIA_PORTABLE_OPTS
+
+    objs = cxx.build_objects(sources, macros=macros, includes=includes, flags=cflags)
+    for isa_flags, opts_srcs in opts:
+        objs.extend(cxx.build_objects(skia_sources(*opts_srcs), macros=macros,
+                                      includes=includes, flags=cflags + isa_flags))
+
+    lib = cxx.link_lib('skia', objs)
+    return Record(includes=public_includes, lib=lib, ldlibs=ldlibs, macros=macros)
+
+
+@contextlib.contextmanager
+def timed(times, name):
+    start = time.monotonic()
+    yield
+    times.append((name, time.monotonic() - start))
+
+
+def report_build_times(ctx, times):
+    # Written out too, so CI can keep track of which library the time goes to. Anything
+    # that was already up to date shows up as (nearly) zero.
+    lines = ['%-16s %8.1fs' % (name, seconds) for name, seconds in times]
+    lines.append('%-16s %8.1fs' % ('total', sum(seconds for _, seconds in times)))
+
+    for line in lines:
+        ctx.logger.log(line)
+
+    with open(ctx.buildroot / 'build-times.txt', 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
 
 
 def build(ctx):
@@ -622,28 +794,65 @@ def build(ctx):
 
     rec = configure(ctx)
 
-    gl3w = build_gl3w(ctx, rec.c)
-    abseil = build_abseil(ctx, rec.cxx)
-    fmt = build_fmtlib(ctx, rec.cxx)
-    tsm = build_libtsm(ctx, rec.c, rec.xkbcommon)
-    skia = build_skia(ctx, rec.platform, rec.cxx, rec.freetype, rec.fontconfig)
-
-    macros = []
+    times = []
+
+    with timed(times, 'gl3w'):
+        gl3w = build_gl3w(ctx, rec.c)
+    with timed(times, 'abseil'):
+        abseil = build_abseil(ctx, rec.cxx)
+    with timed(times, 'fmt'):
+        fmt = build_fmtlib(ctx, rec.cxx)
+    with timed(times, 'libtsm'):
+        tsm = build_libtsm(ctx, rec.c, rec.xkbcommon)
+    with timed(times, 'skia'):
+        skia = build_skia(ctx, rec.platform, rec.cxx, rec.freetype, rec.fontconfig,
+                          ctx.options.enable_gpu, not ctx.options.no_skia_simd)
+
+    # Skia's headers change shape depending on SK_SUPPORT_GPU, so everything including
+    # them has to agree with the library.
+    macros = list(skia.macros)
     if rec.xkbcommon is None:
         macros.append('USE_LIBTSM_XKBCOMMON')
 
-    uterm = rec.cxx.build_exe('uterm', Path.glob('src/*.cc'),
-                              includes=abseil.includes + gl3w.includes + skia.includes +
-                                       fmt.includes + tsm.includes +
-                                       ['deps/utfcpp/source', 'deps/sparsepp'],
-                              libs=[abseil.base, abseil.strings, abseil.stacktrace,
-                                    gl3w.lib, skia.lib, fmt.lib, tsm.lib],
-                              macros=macros,
-                              external_libs=['dl', 'pthread'],
-                              cflags=rec.glfw.cflags + rec.egl.cflags +
-                                     rec.confuse.cflags,
-                              ldlibs=rec.glfw.ldlibs + rec.egl.ldlibs +
-                                     rec.confuse.ldlibs + skia.ldlibs +
-                                     (rec.libprofiler and rec.libprofiler.ldlibs or []))
+    includes = abseil.includes + gl3w.includes + skia.includes + fmt.includes + \
+               tsm.includes + ['deps/utfcpp/source', 'deps/sparsepp']
+    libs = [abseil.base, abseil.strings, abseil.stacktrace, gl3w.lib, skia.lib,
+            fmt.lib, tsm.lib]
+
+    # Everything that talks to GLFW, EGL, or OpenGL lives in the executable; the rest
+    # goes into a library that the headless benchmark can share.
+    window_sources = {'gl_manager.cc', 'keys.cc', 'main.cc', 'uterm.cc', 'window.cc'}
+    core_sources = [src for src in Path.glob('src/*.cc')
+                    if src.basename() not in window_sources]
+
+    with timed(times, 'uterm_core'):
+        core = rec.cxx.build_lib('uterm_core', core_sources, includes=includes,
+                                 libs=libs, macros=macros, cflags=rec.confuse.cflags)
+
+    with timed(times, 'uterm'):
+        uterm = rec.cxx.build_exe('uterm',
+                                  ['src/%s' % src for src in sorted(window_sources)],
+                                  includes=includes,
+                                  libs=[core],
+                                  macros=macros,
+                                  external_libs=['dl', 'pthread'],
+                                  cflags=rec.glfw.cflags + rec.egl.cflags +
+                                         rec.confuse.cflags,
+                                  ldlibs=rec.glfw.ldlibs + rec.egl.ldlibs +
+                                         rec.confuse.ldlibs + skia.ldlibs +
+                                         (rec.libprofiler and rec.libprofiler.ldlibs
+                                          or []))
+
+    with timed(times, 'uterm-bench'):
+        rec.cxx.build_exe('uterm-bench', Path.glob('src/bench/*.cc'),
+                          includes=includes,
+                          libs=[core],
+                          macros=macros,
+                          external_libs=['dl', 'pthread'],
+                          cflags=rec.confuse.cflags,
+                          ldlibs=rec.confuse.ldlibs + skia.ldlibs +
+                                 (rec.libprofiler and rec.libprofiler.ldlibs or []))
+
+    report_build_times(ctx, times)
 
     ctx.install(uterm, 'bin')
@@ -0,0 +1,30 @@
+#!/bin/bash
+# Does a profile-guided release build: builds everything (uterm, libtsm, and Skia) with
+# instrumentation, trains it by running uterm-bench, which needs no display, and then
+# rebuilds everything using the collected profile.
+#
+# Any arguments are passed to uterm-bench as extra training workloads, e.g. recordings
+# made with uterm --record. Options for fbuild can be given in FBUILD_FLAGS.
+set -ex -o pipefail
+
+profile_dir="$PWD/build/pgo-profile"
+rm -rf "$profile_dir"
+mkdir -p "$profile_dir"
+
+fbuild $FBUILD_FLAGS --pgo-generate="$profile_dir"
+
+# The built-in workloads cover parsing and drawing plain, colored, and full-screen
+# output; --raster adds Skia's clears and glyph blits on their own.
+build/uterm-bench
+build/uterm-bench --raster
+if [ $# -ne 0 ]; then
+  build/uterm-bench "$@"
+fi
+
+# Clang leaves raw profiles, which have to be merged first.
+if compgen -G "$profile_dir/*.profraw" > /dev/null; then
+  ${LLVM_PROFDATA:-llvm-profdata} merge -output="$profile_dir/uterm.profdata" \
+    "$profile_dir"/*.profraw
+fi
+
+fbuild $FBUILD_FLAGS --pgo-use="$profile_dir"
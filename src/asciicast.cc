@@ -0,0 +1,328 @@
+#include "asciicast.h"
+
+#include <utf8.h>
+
+#include <cstdlib>
+#include <cstring>
+#include <ctime>
+#include <fstream>
+#include <iterator>
+
+string Cast::Output() const {
+  string output;
+  for (auto &event : events) {
+    if (event.type == "o") {
+      output += event.data;
+    }
+  }
+  return output;
+}
+
+// Skips whitespace, then consumes c if it's next.
+static bool Consume(const char **p, char c) {
+  while (**p == ' ' || **p == '\t') {
+    ++*p;
+  }
+
+  if (**p != c) {
+    return false;
+  }
+
+  ++*p;
+  return true;
+}
+
+static bool ParseHex(const char **p, uint32_t *value) {
+  *value = 0;
+  for (int i = 0; i < 4; i++) {
+    char c = *(*p)++;
+    int digit = c >= '0' && c <= '9' ? c - '0' :
+                c >= 'a' && c <= 'f' ? c - 'a' + 10 :
+                c >= 'A' && c <= 'F' ? c - 'A' + 10 : -1;
+    if (digit == -1) {
+      return false;
+    }
+
+    *value = *value * 16 + digit;
+  }
+
+  return true;
+}
+
+// Parses a JSON string starting at the opening quote.
+static bool ParseString(const char **p, string *out) {
+  if (!Consume(p, '"')) {
+    return false;
+  }
+
+  out->clear();
+  auto it = std::back_inserter(*out);
+
+  for (;;) {
+    char c = *(*p)++;
+    if (c == '\0') {
+      return false;
+    } else if (c == '"') {
+      return true;
+    } else if (c != '\\') {
+      out->push_back(c);
+      continue;
+    }
+
+    switch (c = *(*p)++) {
+    case '"': case '\\': case '/': out->push_back(c); break;
+    case 'b': out->push_back('\b'); break;
+    case 'f': out->push_back('\f'); break;
+    case 'n': out->push_back('\n'); break;
+    case 'r': out->push_back('\r'); break;
+    case 't': out->push_back('\t'); break;
+    case 'u': {
+      uint32_t code, low;
+      if (!ParseHex(p, &code)) {
+        return false;
+      }
+
+      if (code >= 0xD800 && code <= 0xDBFF && (*p)[0] == '\\' && (*p)[1] == 'u') {
+        // A surrogate pair.
+        *p += 2;
+        if (!ParseHex(p, &low) || low < 0xDC00 || low > 0xDFFF) {
+          return false;
+        }
+
+        code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00);
+      } else if (code >= 0xD800 && code <= 0xDFFF) {
+        code = 0xFFFD;
+      }
+
+      it = utf8::append(code, it);
+      break;
+    }
+    default:
+      return false;
+    }
+  }
+}
+
+// Finds the integer value of the given key in a JSON object, or returns -1.
+static int FindIntField(const string &object, const string &key) {
+  size_t pos = object.find(fmt::format("\"{}\"", key));
+  if (pos == string::npos) {
+    return -1;
+  }
+
+  const char *p = object.c_str() + pos + key.size() + 2;
+  if (!Consume(&p, ':')) {
+    return -1;
+  }
+
+  char *end;
+  long value = strtol(p, &end, 10);
+  return end != p ? static_cast<int>(value) : -1;
+}
+
+Error ReadCast(const string &path, Cast *cast) {
+  std::ifstream stream{path, std::ios::binary};
+  if (!stream) {
+    return Error::Errno().Extend(fmt::format("opening cast file {}", path));
+  }
+
+  string line;
+  if (!std::getline(stream, line) || FindIntField(line, "version") != 2) {
+    return Error::New(fmt::format("{} is not an asciicast v2 file", path));
+  }
+
+  cast->width = FindIntField(line, "width");
+  cast->height = FindIntField(line, "height");
+  cast->events.clear();
+
+  for (int number = 2; std::getline(stream, line); number++) {
+    if (line.find_first_not_of(" \t\r") == string::npos) {
+      continue;
+    }
+
+    CastEvent event;
+    const char *p = line.c_str();
+    char *end;
+
+    bool valid = Consume(&p, '[');
+    if (valid) {
+      event.time = strtod(p, &end);
+      valid = end != p;
+      p = end;
+    }
+
+    valid = valid && Consume(&p, ',') && ParseString(&p, &event.type) &&
+            Consume(&p, ',') && ParseString(&p, &event.data) && Consume(&p, ']');
+    if (!valid) {
+      return Error::New(fmt::format("{}:{}: invalid event", path, number));
+    }
+
+    cast->events.push_back(std::move(event));
+  }
+
+  return Error::New();
+}
+
+static const char kReplacement[] = "\xEF\xBF\xBD";
+
+// Returns the length of the UTF-8 sequence starting with c, or 0 if c can't start one
+// (either because it's a continuation byte or because it's never valid).
+static size_t SequenceLength(uint8_t c) {
+  return c < 0x80 ? 1 :
+         c >= 0xC2 && c <= 0xDF ? 2 :
+         c >= 0xE0 && c <= 0xEF ? 3 :
+         c >= 0xF0 && c <= 0xF4 ? 4 : 0;
+}
+
+// Appends data to out as the contents of a JSON string. Invalid UTF-8 is replaced with
+// U+FFFD, except for a sequence cut off at the end, which is stored in *partial.
+static void AppendJsonString(const char *data, size_t size, string *out,
+                             string *partial) {
+  for (size_t i = 0; i < size; ) {
+    uint8_t c = data[i];
+
+    if (c < 0x80) {
+      switch (c) {
+      case '"': *out += "\\\""; break;
+      case '\\': *out += "\\\\"; break;
+      case '\n': *out += "\\n"; break;
+      case '\r': *out += "\\r"; break;
+      case '\t': *out += "\\t"; break;
+      default:
+        if (c < 0x20 || c == 0x7F) {
+          *out += fmt::format("\\u{:04x}", c);
+        } else {
+          out->push_back(c);
+        }
+      }
+
+      i++;
+      continue;
+    }
+
+    size_t len = SequenceLength(c);
+    size_t valid = len == 0 ? 0 : 1;
+    while (valid != 0 && valid < len && i + valid < size &&
+           (static_cast<uint8_t>(data[i + valid]) & 0xC0) == 0x80) {
+      valid++;
+    }
+
+    if (valid != 0 && valid == len) {
+      out->append(data + i, len);
+      i += len;
+    } else if (valid != 0 && i + valid == size) {
+      partial->assign(data + i, valid);
+      return;
+    } else {
+      *out += kReplacement;
+      i++;
+    }
+  }
+}
+
+CastWriter::~CastWriter() {
+  if (auto err = Close()) {
+    err.Extend("while closing cast file").Print();
+  }
+}
+
+Error CastWriter::Open(const string &path, int width, int height) {
+  std::lock_guard<std::mutex> lock{m_lock};
+
+  m_fp = fopen(path.c_str(), "w");
+  if (m_fp == nullptr) {
+    return Error::Errno().Extend(fmt::format("opening cast file {}", path));
+  }
+
+  m_start = Clock::now();
+  m_partial.clear();
+
+  fmt::print(m_fp, "{{\"version\": 2, \"width\": {}, \"height\": {}, "
+                   "\"timestamp\": {}}}\n",
+             width, height, static_cast<long>(time(nullptr)));
+  if (ferror(m_fp)) {
+    return Error::Errno().Extend(fmt::format("writing cast file {}", path));
+  }
+
+  return Error::New();
+}
+
+Error CastWriter::WriteOutput(const char *data, size_t size) {
+  std::lock_guard<std::mutex> lock{m_lock};
+  if (m_fp == nullptr) {
+    return Error::New();
+  }
+
+  string json;
+
+  if (!m_partial.empty()) {
+    // Try to finish the sequence that was cut off last time.
+    size_t len = SequenceLength(m_partial[0]), used = 0;
+    while (m_partial.size() < len && used < size &&
+           (static_cast<uint8_t>(data[used]) & 0xC0) == 0x80) {
+      m_partial.push_back(data[used++]);
+    }
+
+    data += used;
+    size -= used;
+
+    if (m_partial.size() == len) {
+      json += m_partial;
+    } else if (size != 0) {
+      // Something else came first, so it was never valid.
+      json += kReplacement;
+    } else {
+      return Error::New();
+    }
+
+    m_partial.clear();
+  }
+
+  AppendJsonString(data, size, &json, &m_partial);
+  if (json.empty()) {
+    return Error::New();
+  }
+
+  return WriteEvent("o", json);
+}
+
+Error CastWriter::WriteResize(int width, int height) {
+  std::lock_guard<std::mutex> lock{m_lock};
+  if (m_fp == nullptr) {
+    return Error::New();
+  }
+
+  return WriteEvent("r", fmt::format("{}x{}", width, height));
+}
+
+Error CastWriter::WriteEvent(const char *type, const string &json_data) {
+  double time = std::chrono::duration<double>(Clock::now() - m_start).count();
+  fmt::print(m_fp, "[{:.6f}, \"{}\", \"{}\"]\n", time, type, json_data);
+  if (ferror(m_fp)) {
+    return Error::Errno().Extend("writing cast file");
+  }
+
+  return Error::New();
+}
+
+Error CastWriter::Close() {
+  std::lock_guard<std::mutex> lock{m_lock};
+  if (m_fp == nullptr) {
+    return Error::New();
+  }
+
+  // A sequence that was cut off by the end of the recording will never be finished.
+  Error err = Error::New();
+  if (!m_partial.empty()) {
+    m_partial.clear();
+    err = WriteEvent("o", kReplacement);
+  }
+
+  FILE *fp = m_fp;
+  m_fp = nullptr;
+  if (fclose(fp) != 0 && !err) {
+    return Error::Errno().Extend("closing cast file");
+  }
+
+  return err;
+}
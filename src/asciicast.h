@@ -0,0 +1,57 @@
+#pragma once
+
+#include "base.h"
+#include "error.h"
+
+#include <chrono>
+#include <cstdio>
+#include <mutex>
+#include <vector>
+
+// Reading and writing pty sessions in the asciicast v2 format
+// (https://github.com/asciinema/asciinema/blob/develop/doc/asciicast-v2.md): a JSON
+// header line, followed by one [time, type, data] JSON array per line.
+
+struct CastEvent {
+  // Seconds since the start of the recording.
+  double time;
+  // "o" for output, "r" for a resize (with data being "COLSxROWS").
+  string type;
+  string data;
+};
+
+struct Cast {
+  int width{0}, height{0};
+  std::vector<CastEvent> events;
+
+  // Returns all the output, concatenated.
+  string Output() const;
+};
+
+// Reads the cast in the given file.
+Error ReadCast(const string &path, Cast *cast);
+
+// A CastWriter records a session into a file as it happens. Everything it writes is
+// timestamped relative to the call to Open. It's safe to use from multiple threads.
+class CastWriter {
+public:
+  ~CastWriter();
+
+  Error Open(const string &path, int width, int height);
+  bool is_open() const { return m_fp != nullptr; }
+
+  Error WriteOutput(const char *data, size_t size);
+  Error WriteResize(int width, int height);
+  Error Close();
+private:
+  using Clock = std::chrono::steady_clock;
+
+  Error WriteEvent(const char *type, const string &json_data);
+
+  std::mutex m_lock;
+  FILE *m_fp{nullptr};
+  Clock::time_point m_start;
+  // The start of a UTF-8 sequence that was cut off at the end of the last output, since
+  // JSON strings have to be valid UTF-8.
+  string m_partial;
+};
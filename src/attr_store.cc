@@ -0,0 +1,138 @@
+#include "attr_store.h"
+
+#include <algorithm>
+
+constexpr size_t AttrStore::kWordBits;
+constexpr size_t AttrStore::kMaxPaletteSize;
+
+AttrStore::AttrStore(const Attr &default_attr) {
+  m_palette.push_back(default_attr);
+  m_palette_ids[default_attr] = 0;
+}
+
+void AttrStore::Resize(size_t size) {
+  m_ids.resize(size, 0);
+  m_dirty.resize((size + kWordBits - 1) / kWordBits, 0);
+
+  if (size % kWordBits != 0) {
+    // Don't leave stale dirty bits past the end, NextDirtySpan doesn't check for them.
+    m_dirty.back() &= (Word{1} << (size % kWordBits)) - 1;
+  }
+}
+
+void AttrStore::Set(size_t index, const Attr &attr) {
+  if (index >= m_ids.size()) {
+    return;
+  }
+
+  m_ids[index] = Intern(attr);
+  m_dirty[index / kWordBits] |= Word{1} << (index % kWordBits);
+}
+
+void AttrStore::MarkAllDirty() {
+  if (m_dirty.empty()) {
+    return;
+  }
+
+  std::fill(m_dirty.begin(), m_dirty.end(), ~Word{0});
+  Resize(m_ids.size());
+}
+
+void AttrStore::ClearDirty() {
+  std::fill(m_dirty.begin(), m_dirty.end(), 0);
+}
+
+void AttrStore::ClearDirty(size_t begin, size_t end) {
+  for (size_t i = begin; i < end; i++) {
+    m_dirty[i / kWordBits] &= ~(Word{1} << (i % kWordBits));
+  }
+}
+
+bool AttrStore::AllDirty(size_t begin, size_t end) const {
+  for (size_t i = begin; i < end; i++) {
+    if (!dirty(i)) {
+      return false;
+    }
+  }
+
+  return true;
+}
+
+bool AttrStore::NextDirtySpan(Span *span, size_t limit) const {
+  limit = std::min(limit, m_ids.size());
+
+  size_t begin = span->end;
+  if (begin >= limit) {
+    return false;
+  }
+
+  // Skip over the clean cells a whole word at a time.
+  size_t word = begin / kWordBits;
+  Word bits = m_dirty[word] & (~Word{0} << (begin % kWordBits));
+  while (bits == 0) {
+    if (++word == m_dirty.size()) {
+      return false;
+    }
+    bits = m_dirty[word];
+  }
+
+  begin = word * kWordBits + __builtin_ctzll(bits);
+  if (begin >= limit) {
+    return false;
+  }
+
+  size_t end = begin + 1;
+  Id id = m_ids[begin];
+  while (end < limit && m_ids[end] == id && dirty(end)) {
+    end++;
+  }
+
+  span->begin = begin;
+  span->end = end;
+  span->attr = m_palette[id];
+  return true;
+}
+
+AttrStore::Id AttrStore::Intern(const Attr &attr) {
+  auto it = m_palette_ids.find(attr);
+  if (it != m_palette_ids.end()) {
+    return it->second;
+  }
+
+  if (m_palette.size() == kMaxPaletteSize) {
+    CollectGarbage();
+
+    if (m_palette.size() == kMaxPaletteSize) {
+      // Every single palette entry is actually on screen, which takes a truly absurd
+      // number of cells. Just show the default attributes instead.
+      return 0;
+    }
+  }
+
+  Id id = m_palette.size();
+  m_palette.push_back(attr);
+  m_palette_ids[attr] = id;
+  return id;
+}
+
+void AttrStore::CollectGarbage() {
+  // Maps each old ID to its new one, or 0 if it's unused (0 itself always stays).
+  std::vector<Id> remap(m_palette.size(), 0);
+  std::vector<Attr> palette{m_palette[0]};
+
+  for (Id &id : m_ids) {
+    if (id != 0 && remap[id] == 0) {
+      remap[id] = palette.size();
+      palette.push_back(m_palette[id]);
+    }
+
+    id = remap[id];
+  }
+
+  m_palette.swap(palette);
+
+  m_palette_ids.clear();
+  for (size_t i = 0; i < m_palette.size(); i++) {
+    m_palette_ids[m_palette[i]] = i;
+  }
+}
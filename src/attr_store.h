@@ -0,0 +1,66 @@
+#pragma once
+
+#include "attrs.h"
+
+#include <sparsepp/spp.h>
+
+#include <stdint.h>
+#include <limits>
+#include <vector>
+
+// An AttrStore holds the attributes of every cell on the screen. Distinct attributes are
+// interned into a palette, so each cell only stores a 16-bit palette ID, and whether a
+// cell needs to be redrawn is tracked in a separate bitset.
+class AttrStore {
+public:
+  explicit AttrStore(const Attr &default_attr);
+
+  // A run of consecutive dirty cells that all have the same attributes.
+  struct Span {
+    size_t begin{0}, end{0};
+    Attr attr;
+  };
+
+  size_t size() const { return m_ids.size(); }
+  const Attr & At(size_t index) const { return m_palette[m_ids[index]]; }
+
+  // Resizes the store to the given number of cells. New cells get the default
+  // attributes.
+  void Resize(size_t size);
+  // Sets the attributes of the cell at the given index, and marks it as dirty. Indexes
+  // past the end are ignored.
+  void Set(size_t index, const Attr &attr);
+
+  void MarkAllDirty();
+  void ClearDirty();
+  void ClearDirty(size_t begin, size_t end);
+  // Whether all the cells in [begin, end) are dirty.
+  bool AllDirty(size_t begin, size_t end) const;
+
+  // Finds the first span of dirty cells starting at or after span->end and before
+  // limit, and stores it in *span; the span won't extend past limit either. Returns
+  // false if there are no such dirty cells left. To iterate over all of them, start
+  // with a default-constructed Span.
+  bool NextDirtySpan(Span *span,
+                     size_t limit = std::numeric_limits<size_t>::max()) const;
+private:
+  using Id = uint16_t;
+  using Word = uint64_t;
+  static constexpr size_t kWordBits = 64;
+  static constexpr size_t kMaxPaletteSize = 1 << 16;
+
+  Id Intern(const Attr &attr);
+  // Drops all the palette entries that no cell uses anymore, renumbering the rest.
+  void CollectGarbage();
+
+  bool dirty(size_t index) const {
+    return m_dirty[index / kWordBits] & (Word{1} << (index % kWordBits));
+  }
+
+  // The default attributes are always palette ID 0.
+  std::vector<Attr> m_palette;
+  spp::sparse_hash_map<Attr, Id, Attr::Hash> m_palette_ids;
+
+  std::vector<Id> m_ids;
+  std::vector<Word> m_dirty;
+};
@@ -32,8 +32,7 @@ struct Attr {
                        kItalic = 1<<2,
                        kUnderline = 1<<3,
                        kInverse = 1<<4,
-                       kProtect = 1<<5,
-                       kDirty = 1<<6;
+                       kProtect = 1<<5;
   int flags{0};
 
   bool operator==(const Attr &rhs) const {
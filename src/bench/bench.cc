@@ -0,0 +1,416 @@
+// uterm-bench replays pty output through the terminal pipeline (libtsm parsing,
+// Terminal::Draw, and Display::Draw onto a raster surface) without creating a window or
+// spawning a shell, and reports how fast it went.
+
+#include "../terminal.h"
+#include "../display.h"
+#include "../config.h"
+#include "../paint_batch.h"
+#include "workloads.h"
+
+#include <SkSurface.h>
+
+#include <absl/strings/numbers.h>
+
+#include <algorithm>
+#include <chrono>
+
+using Clock = std::chrono::steady_clock;
+
+struct Options {
+  int width{1280}, height{800};
+  size_t chunk{64 * 1024};
+  size_t size{32 * 1024 * 1024};
+  string font{"monospace"};
+  int font_size{16};
+  size_t scrollback{100000};
+  // Typed into a search one character at a time once the workload is done. The default
+  // never matches, which is the slowest case.
+  string search{"segfault"};
+  // Run the raster benchmark instead of the workloads.
+  bool raster{false};
+  std::vector<string> workloads;
+};
+
+struct Result {
+  size_t bytes{0};
+  // The number of bytes a window would have had to upload to the GPU.
+  size_t upload_bytes{0};
+  // The memory used by the compact scrollback at the end, and the lines it held.
+  size_t scrollback_bytes{0}, scrollback_lines{0};
+  int cols{0};
+  // From loading the font to drawing the first (empty) frame.
+  double startup_seconds{0};
+  double parse_seconds{0}, total_seconds{0};
+  // The slowest search keystroke.
+  double search_seconds{0};
+  std::vector<double> frame_seconds;
+  // A hash of the final frame, which should only change when the rendering does.
+  uint32 checksum{0};
+};
+
+struct RasterResult {
+  int frames{0};
+  size_t glyphs{0};
+  double clear_seconds{0}, text_seconds{0};
+};
+
+static double Seconds(Clock::duration duration) {
+  return std::chrono::duration<double>(duration).count();
+}
+
+static double Percentile(const std::vector<double> &sorted, double percentile) {
+  if (sorted.empty()) {
+    return 0;
+  }
+
+  size_t index = std::min(sorted.size() - 1,
+                          static_cast<size_t>(sorted.size() * percentile));
+  return sorted[index];
+}
+
+// Returns the FNV-1a hash of the pixels on the surface.
+static uint32 Checksum(SkSurface *surface) {
+  SkPixmap pixmap;
+  if (!surface->peekPixels(&pixmap)) {
+    return 0;
+  }
+
+  // Only the pixels themselves are hashed, since rows may be padded.
+  size_t row_size = static_cast<size_t>(pixmap.width()) * 4;
+  uint32 hash = 2166136261;
+  for (int y = 0; y < pixmap.height(); y++) {
+    auto row = static_cast<const uint8_t*>(pixmap.addr(0, y));
+    for (size_t i = 0; i < row_size; i++) {
+      hash = (hash ^ row[i]) * 16777619;
+    }
+  }
+
+  return hash;
+}
+
+static Error RunWorkload(const Options &options, const string &name, Result *result) {
+  auto startup_start = Clock::now();
+
+  FontSet fonts;
+  fonts.Add(options.font, options.font_size);
+
+  Terminal term;
+  Display display{&term, &fonts};
+
+  term.set_theme(kDefaultTheme);
+  term.SetScrollbackSize(options.scrollback);
+  if (auto err = display.Resize(options.width, options.height)) {
+    return err.Extend("while resizing display");
+  }
+
+  auto info = SkImageInfo::Make(options.width, options.height, kRGBA_8888_SkColorType,
+                                kPremul_SkAlphaType);
+  auto surface = SkSurface::MakeRaster(info);
+  if (surface == nullptr) {
+    return Error::New("failed to create SkSurface");
+  }
+
+  SkCanvas *canvas = surface->getCanvas();
+  canvas->clear(kDefaultTheme[Colors::kBackground]);
+
+  term.Draw();
+  display.Draw(canvas);
+  canvas->flush();
+  result->startup_seconds = Seconds(Clock::now() - startup_start);
+
+  auto builtins = BuiltinWorkloadNames();
+  bool builtin = std::find(builtins.begin(), builtins.end(), name) != builtins.end();
+  auto data = builtin ? GenerateWorkload(name, options.size, display.cols(),
+                                         display.rows())
+                      : LoadWorkloadFile(name);
+  if (auto err = data.Error()) {
+    return err;
+  }
+
+  result->bytes = data->size();
+
+  auto start = Clock::now();
+
+  for (size_t offset = 0; offset < data->size(); offset += options.chunk) {
+    auto frame_start = Clock::now();
+
+    term.WriteToScreen(data->data() + offset,
+                       std::min(options.chunk, data->size() - offset));
+    auto parse_end = Clock::now();
+
+    term.Draw();
+    display.Draw(canvas);
+    canvas->flush();
+    auto frame_end = Clock::now();
+
+    const SkIRect &damage = display.damage();
+    result->upload_bytes += static_cast<size_t>(damage.width()) * damage.height() * 4;
+
+    result->parse_seconds += Seconds(parse_end - frame_start);
+    result->frame_seconds.push_back(Seconds(frame_end - frame_start));
+  }
+
+  result->total_seconds = Seconds(Clock::now() - start);
+  result->scrollback_bytes = term.scrollback().memory_usage();
+  result->scrollback_lines = term.scrollback().size();
+  result->cols = display.cols();
+  result->checksum = Checksum(surface.get());
+
+  term.StartSearch();
+  for (size_t i = 1; i <= options.search.size(); i++) {
+    auto search_start = Clock::now();
+    term.SetSearchQuery(options.search.substr(0, i));
+    result->search_seconds = std::max(result->search_seconds,
+                                      Seconds(Clock::now() - search_start));
+  }
+  term.EndSearch();
+  return Error::New();
+}
+
+// Times the two raster operations Display::Draw spends most of its time in, without the
+// terminal in the way: clearing the whole surface, and blitting a screenful of glyphs.
+// Everything here goes through Skia's blitters, so comparing builds configured with and
+// without --no-skia-simd shows what its SIMD code is worth.
+static Error RunRaster(const Options &options, RasterResult *result) {
+  constexpr int kFrames = 200;
+
+  Font font{options.font, options.font_size};
+  int cell_width = font.GetWidth(), cell_height = font.GetHeight();
+  if (cell_width <= 0 || cell_height <= 0) {
+    return Error::New(fmt::format("font {} has no size", options.font));
+  }
+
+  int cols = options.width / cell_width,
+      rows = (options.height - font.GetBaselineOffset()) / cell_height;
+
+  auto info = SkImageInfo::Make(options.width, options.height, kRGBA_8888_SkColorType,
+                                kPremul_SkAlphaType);
+  auto surface = SkSurface::MakeRaster(info);
+  if (surface == nullptr) {
+    return Error::New("failed to create SkSurface");
+  }
+
+  SkCanvas *canvas = surface->getCanvas();
+
+  // The screen is filled with printable ASCII, each row in another color.
+  std::vector<SkGlyphID> glyphs(static_cast<size_t>(cols) * rows);
+  for (size_t i = 0; i < glyphs.size(); i++) {
+    glyphs[i] = font.LookupGlyph('!' + i % ('~' - '!' + 1), FontStyle::kNormal);
+  }
+
+  auto &paint = font.paint(FontStyle::kNormal);
+  paint.setTextEncoding(SkPaint::kGlyphID_TextEncoding);
+  PaintBatch batch;
+
+  for (int frame = 0; frame < kFrames; frame++) {
+    auto clear_start = Clock::now();
+    canvas->clear(kDefaultTheme[Colors::kBackground]);
+    canvas->flush();
+    auto text_start = Clock::now();
+
+    for (int y = 0; y < rows; y++) {
+      SkColor color = kDefaultTheme[Colors::kRed + y % Colors::kWhite];
+      auto &run = batch.TextBuilder(color)->allocRunPos(paint, cols);
+
+      for (int x = 0; x < cols; x++) {
+        run.glyphs[x] = glyphs[y * cols + x];
+        run.pos[x * 2] = cell_width * x;
+        run.pos[x * 2 + 1] = cell_height * (y + 1);
+      }
+    }
+
+    batch.Flush(canvas);
+    canvas->flush();
+    auto text_end = Clock::now();
+
+    result->clear_seconds += Seconds(text_start - clear_start);
+    result->text_seconds += Seconds(text_end - text_start);
+  }
+
+  result->frames = kFrames;
+  result->glyphs = glyphs.size();
+  return Error::New();
+}
+
+static void PrintRasterResult(const Options &options, const RasterResult &result) {
+  double pixels = static_cast<double>(options.width) * options.height;
+  double clear_per_frame = result.clear_seconds / result.frames,
+         text_per_frame = result.text_seconds / result.frames;
+
+  fmt::print("{:<8} {:>7} {:>9} {:>10} {:>10} {:>10}\n", "surface", "frames", "glyphs",
+             "clear ms", "clear MP/s", "glyph ms");
+  fmt::print("{:<8} {:>7} {:>9} {:>10.3f} {:>10.1f} {:>10.3f}\n",
+             fmt::format("{}x{}", options.width, options.height), result.frames,
+             result.glyphs, clear_per_frame * 1000,
+             clear_per_frame ? pixels / 1e6 / clear_per_frame : 0,
+             text_per_frame * 1000);
+}
+
+static void PrintResult(const string &name, const Result &result) {
+  constexpr double kMB = 1024 * 1024;
+
+  auto sorted = result.frame_seconds;
+  std::sort(sorted.begin(), sorted.end());
+
+  double parse_rate = result.parse_seconds ? result.bytes / kMB / result.parse_seconds
+                                           : 0;
+  double total_rate = result.total_seconds ? result.bytes / kMB / result.total_seconds
+                                           : 0;
+
+  double upload_per_frame = sorted.empty() ? 0
+                                          : result.upload_bytes / 1024.0 / sorted.size();
+
+  fmt::print("{:<16} {:>8.1f} {:>8.1f} {:>10.1f} {:>10.1f} {:>7} {:>8.3f} {:>8.3f} "
+             "{:>9.1f} {:>6.1f} {:>9.3f} {:08x}\n",
+             name, result.bytes / kMB, result.startup_seconds * 1000, parse_rate,
+             total_rate, sorted.size(),
+             Percentile(sorted, 0.5) * 1000, Percentile(sorted, 0.99) * 1000,
+             upload_per_frame, result.scrollback_bytes / kMB,
+             result.search_seconds * 1000, result.checksum);
+}
+
+// README.rst documents how much memory the scrollback takes for a plain-text log, which
+// is what cat-log generates.
+static Error CheckScrollbackMemory(const string &name, const Result &result) {
+  constexpr size_t kLineOverhead = 32;
+
+  if (name != "cat-log") {
+    return Error::New();
+  }
+
+  size_t limit = result.scrollback_lines * (result.cols + kLineOverhead);
+  if (result.scrollback_bytes > limit) {
+    return Error::New(fmt::format("scrollback uses {} bytes for {} lines, over the "
+                                  "documented {}", result.scrollback_bytes,
+                                  result.scrollback_lines, limit));
+  }
+
+  return Error::New();
+}
+
+static void Usage(const char *argv0) {
+  fmt::print("usage: {} [options] [workload|file...]\n\n", argv0);
+  fmt::print("Replays pty output through the terminal pipeline headlessly.\n\n");
+  fmt::print("options:\n");
+  fmt::print("  --width PIXELS      surface width (default 1280)\n");
+  fmt::print("  --height PIXELS     surface height (default 800)\n");
+  fmt::print("  --chunk BYTES       bytes parsed per frame (default 65536)\n");
+  fmt::print("  --size MB           size of generated workloads (default 32)\n");
+  fmt::print("  --font NAME         font name (default monospace)\n");
+  fmt::print("  --font-size SIZE    font size (default 16)\n");
+  fmt::print("  --scrollback LINES  scrollback size (default 100000)\n");
+  fmt::print("  --search QUERY      text to search for afterwards (default segfault)\n");
+  fmt::print("  --raster            time clearing the surface and drawing glyphs "
+             "instead\n\n");
+  fmt::print("Built-in workloads:");
+  for (auto &name : BuiltinWorkloadNames()) {
+    fmt::print(" {}", name);
+  }
+  fmt::print("\nAny other argument is read as a file of raw recorded pty output, or as\n"
+             "an asciicast recording if it ends in .cast.\n");
+}
+
+static Error ParseOptions(int argc, char **argv, Options *options) {
+  for (int i = 1; i < argc; i++) {
+    string arg{argv[i]};
+
+    if (arg == "-h" || arg == "--help") {
+      Usage(argv[0]);
+      exit(0);
+    } else if (arg == "--raster") {
+      options->raster = true;
+      continue;
+    } else if (arg.size() < 2 || arg[0] != '-' || arg[1] != '-') {
+      options->workloads.push_back(arg);
+      continue;
+    }
+
+    if (i + 1 == argc) {
+      return Error::New(fmt::format("{} requires an argument", arg));
+    }
+
+    string value{argv[++i]};
+    int number;
+
+    if (arg == "--font") {
+      options->font = value;
+      continue;
+    } else if (arg == "--search") {
+      options->search = value;
+      continue;
+    } else if (arg == "--scrollback") {
+      if (!absl::SimpleAtoi(value, &number) || number < 0) {
+        return Error::New(fmt::format("invalid value for {}: {}", arg, value));
+      }
+
+      options->scrollback = number;
+      continue;
+    } else if (!absl::SimpleAtoi(value, &number) || number <= 0) {
+      return Error::New(fmt::format("invalid value for {}: {}", arg, value));
+    }
+
+    if (arg == "--width") {
+      options->width = number;
+    } else if (arg == "--height") {
+      options->height = number;
+    } else if (arg == "--chunk") {
+      options->chunk = number;
+    } else if (arg == "--size") {
+      options->size = static_cast<size_t>(number) * 1024 * 1024;
+    } else if (arg == "--font-size") {
+      options->font_size = number;
+    } else {
+      return Error::New(fmt::format("unknown option: {}", arg));
+    }
+  }
+
+  if (options->workloads.empty()) {
+    options->workloads = BuiltinWorkloadNames();
+  }
+
+  return Error::New();
+}
+
+int main(int argc, char **argv) {
+  Options options;
+  if (auto err = ParseOptions(argc, argv, &options)) {
+    err.Print();
+    return 1;
+  }
+
+  if (options.raster) {
+    RasterResult result;
+    if (auto err = RunRaster(options, &result)) {
+      err.Extend("while running the raster benchmark").Print();
+      return 1;
+    }
+
+    PrintRasterResult(options, result);
+    return 0;
+  }
+
+  fmt::print("{:<16} {:>8} {:>8} {:>10} {:>10} {:>7} {:>8} {:>8} {:>9} {:>6} {:>9} "
+             "{:<8}\n",
+             "workload", "MB", "start ms", "parse MB/s", "total MB/s", "frames", "p50 ms",
+             "p99 ms", "upload KB", "sb MB", "search ms", "checksum");
+
+  int status = 0;
+  for (auto &name : options.workloads) {
+    Result result;
+    if (auto err = RunWorkload(options, name, &result)) {
+      err.Extend(fmt::format("while running workload {}", name)).Print();
+      status = 1;
+      continue;
+    }
+
+    PrintResult(name, result);
+
+    if (auto err = CheckScrollbackMemory(name, result)) {
+      err.Extend(fmt::format("while running workload {}", name)).Print();
+      status = 1;
+    }
+  }
+
+  return status;
+}
@@ -0,0 +1,206 @@
+#include "workloads.h"
+#include "../asciicast.h"
+
+#include <algorithm>
+#include <cstring>
+#include <fstream>
+#include <sstream>
+
+// A tiny xorshift generator. The standard library distributions aren't guaranteed to
+// give the same results everywhere, and the workloads need to be identical across
+// builds.
+class Random {
+public:
+  uint32 Next() {
+    m_state ^= m_state << 13;
+    m_state ^= m_state >> 17;
+    m_state ^= m_state << 5;
+    return m_state;
+  }
+
+  uint32 Below(uint32 limit) { return Next() % limit; }
+
+  template <typename T, size_t N>
+  const T & Pick(const T (&choices)[N]) { return choices[Below(N)]; }
+private:
+  uint32 m_state{0x2545f491};
+};
+
+static const char *kWords[] = {
+  "request", "handled", "worker", "queue", "flush", "connection", "timeout", "retry",
+  "cache", "miss", "hit", "shard", "replica", "commit", "index", "segment", "compact",
+  "session", "token", "upstream", "latency", "bytes", "frame", "render", "parse",
+};
+
+static const char *kNames[] = {
+  "main", "util", "config", "display", "terminal", "window", "render", "buffer",
+  "parser", "screen", "glyph", "font", "theme", "surface", "canvas", "vte",
+};
+
+static const char *kExtensions[] = {
+  ".c", ".cc", ".h", ".py", ".txt", ".md", ".o", ".so",
+};
+
+static void AppendWords(Random *random, string *out, int count) {
+  for (int i = 0; i < count; i++) {
+    if (i != 0) {
+      out->push_back(' ');
+    }
+    *out += random->Pick(kWords);
+  }
+}
+
+// `cat` of a large application log: long lines of mostly plain text.
+static void GenerateCatLog(Random *random, string *out, size_t size, int cols, int rows) {
+  static const char *levels[] = {"DEBUG", "INFO ", "INFO ", "INFO ", "WARN ", "ERROR"};
+
+  for (uint32 line = 0; out->size() < size; line++) {
+    *out += fmt::format("2018-03-{:02} {:02}:{:02}:{:02}.{:03} {} [{}-{}] ",
+                        line / 86400 % 28 + 1, line / 3600 % 24, line / 60 % 60,
+                        line % 60, random->Below(1000), random->Pick(levels),
+                        random->Pick(kNames), random->Below(32));
+    AppendWords(random, out, 4 + random->Below(12));
+    *out += fmt::format(" in {}ms\r\n", random->Below(5000));
+  }
+}
+
+// `ls -lR` with colors: short lines, frequent attribute changes.
+static void GenerateLsLR(Random *random, string *out, size_t size, int cols, int rows) {
+  for (uint32 dir = 0; out->size() < size; dir++) {
+    *out += fmt::format("./{}/{}:\r\ntotal {}\r\n", random->Pick(kNames), dir,
+                        random->Below(4096));
+
+    int entries = 4 + random->Below(24);
+    for (int i = 0; i < entries; i++) {
+      const char *name = random->Pick(kNames);
+
+      switch (random->Below(4)) {
+      case 0:
+        *out += fmt::format("drwxr-xr-x 2 user user 4096 Mar 14 12:{:02} "
+                            "\x1b[01;34m{}\x1b[0m\r\n", random->Below(60), name);
+        break;
+      case 1:
+        *out += fmt::format("-rwxr-xr-x 1 user user {:>8} Mar 14 12:{:02} "
+                            "\x1b[01;32m{}\x1b[0m\r\n", random->Below(1 << 24),
+                            random->Below(60), name);
+        break;
+      default:
+        *out += fmt::format("-rw-r--r-- 1 user user {:>8} Mar 14 12:{:02} {}{}\r\n",
+                            random->Below(1 << 20), random->Below(60), name,
+                            random->Pick(kExtensions));
+        break;
+      }
+    }
+
+    *out += "\r\n";
+  }
+}
+
+// Full-screen editor redraws: absolute cursor movement and syntax coloring of every
+// row, on the alternate screen.
+static void GenerateVimRedraw(Random *random, string *out, size_t size, int cols,
+                              int rows) {
+  static const int colors[] = {1, 2, 3, 4, 5, 6, 130, 166, 172, 33, 244};
+
+  *out += "\x1b[?1049h";
+
+  for (uint32 frame = 0; out->size() < size; frame++) {
+    *out += "\x1b[?25l";
+
+    for (int y = 1; y < rows; y++) {
+      *out += fmt::format("\x1b[{};1H\x1b[38;5;130m{:>4} \x1b[m", y, frame + y);
+
+      int width = 5;
+      while (width < cols - 12) {
+        const char *word = random->Pick(kWords);
+        *out += fmt::format("\x1b[38;5;{}m{}\x1b[m ", random->Pick(colors), word);
+        width += strlen(word) + 1;
+      }
+
+      *out += "\x1b[K";
+    }
+
+    *out += fmt::format("\x1b[{};1H\x1b[7m{}.cc [+]{:>{}}\x1b[27m", rows,
+                        random->Pick(kNames), fmt::format("{},1", frame),
+                        std::max(cols - 20, 1));
+    *out += fmt::format("\x1b[{};{}H\x1b[?25h", 1 + random->Below(rows - 1),
+                        1 + random->Below(cols));
+  }
+
+  *out += "\x1b[?1049l";
+}
+
+// 24-bit color spam: a new foreground and background color for every cell.
+static void GenerateTrueColor(Random *random, string *out, size_t size, int cols,
+                              int rows) {
+  for (uint32 line = 0; out->size() < size; line++) {
+    for (int x = 0; x < cols; x++) {
+      *out += fmt::format("\x1b[38;2;{};{};{}m\x1b[48;2;{};{};{}m{}",
+                          random->Below(256), random->Below(256), random->Below(256),
+                          random->Below(256), random->Below(256), random->Below(256),
+                          static_cast<char>('!' + random->Below('~' - '!')));
+    }
+
+    *out += "\x1b[0m\r\n";
+  }
+}
+
+using WorkloadGenerator = void (*)(Random*, string*, size_t, int, int);
+
+static const struct {
+  const char *name;
+  WorkloadGenerator generator;
+} kWorkloads[] = {
+  {"cat-log", GenerateCatLog},
+  {"ls-lR", GenerateLsLR},
+  {"vim-redraw", GenerateVimRedraw},
+  {"truecolor", GenerateTrueColor},
+};
+
+std::vector<string> BuiltinWorkloadNames() {
+  std::vector<string> names;
+  for (auto &workload : kWorkloads) {
+    names.push_back(workload.name);
+  }
+  return names;
+}
+
+Expect<string> GenerateWorkload(const string& name, size_t size, int cols, int rows) {
+  for (auto &workload : kWorkloads) {
+    if (name == workload.name) {
+      Random random;
+      string data;
+      data.reserve(size);
+
+      workload.generator(&random, &data, size, cols, rows);
+      return Expect<string>::New(data);
+    }
+  }
+
+  return Expect<string>::WithError(fmt::format("unknown workload: {}", name));
+}
+
+Expect<string> LoadWorkloadFile(const string& path) {
+  const string kCastExtension = ".cast";
+  if (path.size() > kCastExtension.size() &&
+      path.compare(path.size() - kCastExtension.size(), kCastExtension.size(),
+                   kCastExtension) == 0) {
+    // The timing is irrelevant here, so a recording is just its output.
+    Cast cast;
+    if (auto err = ReadCast(path, &cast)) {
+      return Expect<string>::New(err);
+    }
+
+    return Expect<string>::New(cast.Output());
+  }
+
+  std::ifstream stream{path, std::ios::binary};
+  if (!stream) {
+    // ifstream doesn't reliably set errno, so there's no more detail to give.
+    return Expect<string>::WithError(fmt::format("failed to open {}", path));
+  }
+
+  std::stringstream contents;
+  contents << stream.rdbuf();
+  return Expect<string>::New(contents.str());
+}
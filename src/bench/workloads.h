@@ -0,0 +1,18 @@
+#pragma once
+
+#include "../base.h"
+#include "../error.h"
+
+#include <vector>
+
+// Returns the names of all the built-in synthetic workloads.
+std::vector<string> BuiltinWorkloadNames();
+
+// Generates the pty output for the built-in workload with the given name, producing
+// roughly the given number of bytes for a screen of the given size. The output is
+// deterministic across runs and platforms, so results from different builds can be
+// compared.
+Expect<string> GenerateWorkload(const string& name, size_t size, int cols, int rows);
+
+// Loads the raw recorded pty output stored in the given file.
+Expect<string> LoadWorkloadFile(const string& path);
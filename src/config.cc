@@ -155,6 +155,12 @@ Error Config::Parse() {
     CFG_STR("shell", const_cast<char*>(m_shell.c_str()), CFGF_NONE),
     CFG_INT("vsync", -1, CFGF_NONE),
     CFG_INT("fps", 120, CFGF_NONE),
+    CFG_BOOL("gpu", cfg_false, CFGF_NONE),
+    CFG_INT("read-size", kDefaultReadSize, CFGF_NONE),
+    CFG_INT("read-latency", kDefaultReadLatency, CFGF_NONE),
+    CFG_INT("scrollback", kDefaultScrollback, CFGF_NONE),
+    CFG_BOOL("stats-overlay", cfg_false, CFGF_NONE),
+    CFG_STR("stats-file", "", CFGF_NONE),
 
     CFG_SEC("theme", theme_opts, CFGF_MULTI | CFGF_TITLE | CFGF_NO_TITLE_DUPES),
     CFG_STR("current-theme", "", CFGF_NONE),
@@ -177,6 +183,26 @@ Error Config::Parse() {
   m_shell = cfg_getstr(cfg, "shell");
   m_vsync = cfg_getint(cfg, "vsync");
   m_fps = cfg_getint(cfg, "fps");
+  m_gpu = cfg_getbool(cfg, "gpu");
+  m_read_size = cfg_getint(cfg, "read-size");
+  if (m_read_size < kMinReadSize) {
+    m_read_size = kMinReadSize;
+  } else if (m_read_size > kMaxReadSize) {
+    m_read_size = kMaxReadSize;
+  }
+
+  m_read_latency = cfg_getint(cfg, "read-latency");
+  if (m_read_latency < 0) {
+    m_read_latency = 0;
+  }
+
+  m_scrollback = cfg_getint(cfg, "scrollback");
+  if (m_scrollback < 0) {
+    m_scrollback = 0;
+  }
+
+  m_stats_overlay = cfg_getbool(cfg, "stats-overlay");
+  m_stats_file = cfg_getstr(cfg, "stats-file");
 
   const char *wanted_theme = cfg_getstr(cfg, "current-theme");
   int themes = cfg_size(cfg, "theme");
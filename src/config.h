@@ -45,12 +45,30 @@ public:
   const string & shell() const { return m_shell; }
   int vsync() const { return m_vsync; }
   int fps() const { return m_fps; }
+  bool gpu() const { return m_gpu; }
+  int read_size() const { return m_read_size; }
+  int read_latency() const { return m_read_latency; }
+  int scrollback() const { return m_scrollback; }
+  bool stats_overlay() const { return m_stats_overlay; }
+  const string & stats_file() const { return m_stats_file; }
   int font_defaults_size() const { return m_font_defaults_size; }
   const std::vector<Font> & fonts() const { return m_fonts; }
   const Theme & theme() const { return m_theme; }
 private:
   string m_shell;
-  int m_vsync, m_fps;
+  int m_vsync{-1}, m_fps{120};
+  bool m_gpu{false};
+
+  static constexpr int kDefaultReadSize = 64 * 1024, kMinReadSize = 4 * 1024,
+                       kMaxReadSize = 1024 * 1024;
+  static constexpr int kDefaultReadLatency = 2000;
+  int m_read_size{kDefaultReadSize}, m_read_latency{kDefaultReadLatency};
+
+  static constexpr int kDefaultScrollback = 100000;
+  int m_scrollback{kDefaultScrollback};
+
+  bool m_stats_overlay{false};
+  string m_stats_file;
 
   static constexpr int kDefaultFontSize = 16;
   int m_font_defaults_size{kDefaultFontSize};
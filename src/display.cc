@@ -1,4 +1,7 @@
 #include "display.h"
+#include "stats.h"
+
+#include <SkPictureRecorder.h>
 
 // Clamps v to the range low (inclusive) to high (exclusive).
 template <typename T>
@@ -6,23 +9,28 @@ T clamp(T v, T low, T high) {
   return v < low ? low : (v > high ? high : v);
 }
 
-Display::Display(Terminal *term): m_term{term}, m_attrs{m_term->default_attr()} {
+constexpr size_t Display::kRowCacheSize;
+
+Display::Display(Terminal *term, FontSet *fonts): m_term{term}, m_fonts{fonts},
+    m_attrs{m_term->default_attr()} {
   using namespace std::placeholders;
   m_term->set_draw_cb(std::bind(&Display::TermDraw, this, _1, _2, _3, _4));
-}
 
-void Display::AddFont(string name, int size) {
-  m_renderers.emplace_back();
-  m_renderers.back().SetFont(name);
-  m_renderers.back().SetTextSize(size);
+  // Nothing is measured until the first resize, so the fonts can keep loading until
+  // then.
+  assert(m_fonts->size() != 0);
+  for (size_t i = 0; i < m_fonts->size(); i++) {
+    m_renderers.emplace_back(&m_fonts->font(i));
+  }
 
-  UpdateWidth();
-  UpdateGlyphs();
+  m_overlay_paint.setTextEncoding(SkPaint::kUTF8_TextEncoding);
+  m_overlay_paint.setTextSize(12);
+  m_overlay_paint.setAntiAlias(true);
 }
 
 void Display::SetSelection(Selection state, int mx, int my) {
   int x = clamp(mx / m_char_width, 0, m_text.cols() - 1);
-  int y = clamp(my / m_renderers[0].GetHeight(), 0, m_text.rows() - 1);
+  int y = clamp(my / primary_font().GetHeight(), 0, m_text.rows() - 1);
 
   m_term->SetSelection(state, x, y);
 }
@@ -32,12 +40,19 @@ void Display::EndSelection() {
 }
 
 Error Display::Resize(int width, int height) {
-  assert(m_char_width != -1);
+  UpdateWidth();
 
-  int rows = (height - m_renderers[0].GetBaselineOffset()) / m_renderers[0].GetHeight();
+  int rows = (height - primary_font().GetBaselineOffset()) / primary_font().GetHeight();
   int cols = width / m_char_width;
 
+  // Sizes that fit the same grid change nothing, so there's no reason to redraw
+  // everything (or to have the shell do the same).
+  if (rows == m_text.rows() && cols == m_text.cols() && rows * cols != 0) {
+    return Error::New();
+  }
+
   m_text.Resize(cols, rows);
+  m_row_cache.Clear();
 
   for (auto &renderer : m_renderers) {
     renderer.Resize(rows * cols);
@@ -48,10 +63,10 @@ Error Display::Resize(int width, int height) {
 
   UpdatePositions();
 
-  m_attrs.UpdateWith(0, rows * cols, [](Attr &attr) {
-    attr.flags |= Attr::kDirty;
-  });
-  m_has_updated = true;
+  m_attrs.MarkAllDirty();
+  m_row_damaged.assign(rows, false);
+  m_damaged_rows.clear();
+  DamageAllRows();
 
   if (err) {
     return err.Extend("while resizing display");
@@ -61,73 +76,144 @@ Error Display::Resize(int width, int height) {
 }
 
 bool Display::Draw(SkCanvas *canvas) {
-  bool significant_redraw = m_has_updated;
+  m_damage.setEmpty();
 
-  if (!significant_redraw) {
+  // Only the rows something was drawn to are looked at, so an idle screen costs
+  // nothing.
+  if (m_damaged_rows.empty()) {
     return false;
   }
 
-  std::vector<AttrSet::Span> dirty;
-  AttrSet::Span *pspan = nullptr;
-
-  while ((pspan = m_attrs.NextSpan(pspan))) {
-    if (!(pspan->data.flags & Attr::kDirty)) continue;
+  ScopedTimer timer{Stage::kDisplayDraw};
 
-    bool inverse = pspan->data.flags & Attr::kInverse;
-    SkColor background;
-    if (pspan->data.flags & Attr::kInverse) {
-      background = pspan->data.foreground;
-    } else {
-      background = pspan->data.background;
+  // Rows that changed entirely (which is all of them when scrolling) are likely to
+  // have been on screen before, so they go through the row cache. That has to happen
+  // before any spans are added to m_batch, since DrawRow flushes it.
+  for (int y : m_damaged_rows) {
+    size_t begin = m_text.PosToOffset(0, y), end = begin + m_text.cols();
+    if (m_attrs.AllDirty(begin, end)) {
+      DrawRow(canvas, y);
+      m_attrs.ClearDirty(begin, end);
     }
+  }
 
-    HighlightRange(canvas, m_text.OffsetToPos(pspan->begin),
-                   m_text.OffsetToPos(pspan->end), background);
+  for (int y : m_damaged_rows) {
+    size_t begin = m_text.PosToOffset(0, y), end = begin + m_text.cols();
 
-    dirty.push_back(*pspan);
+    AttrStore::Span span;
+    span.end = begin;
+    while (m_attrs.NextDirtySpan(&span, end)) {
+      AddSpan(span);
+    }
+
+    m_attrs.ClearDirty(begin, end);
+    m_row_damaged[y] = false;
   }
 
-  for (auto &span : dirty) {
-    bool is_primary = true;
-    for (auto &renderer : m_renderers) {
-      m_text.DrawRangeWithRenderer(canvas, &renderer, span.data, span.begin, span.end,
-                                   is_primary);
-      is_primary = false;
+  m_damaged_rows.clear();
+  m_batch.Flush(canvas);
+
+  if (!m_damage.isEmpty()) {
+    // Glyphs can overhang their cells a bit (e.g. italics, or fallback fonts with
+    // different metrics), so the neighboring cells count as damaged too.
+    m_damage.outset(m_char_width, primary_font().GetHeight());
+    SkISize size = canvas->getBaseLayerSize();
+    if (!m_damage.intersect(SkIRect::MakeWH(size.width(), size.height()))) {
+      m_damage.setEmpty();
     }
+  }
 
-    m_attrs.UpdateWith(span.begin, span.end, [](Attr &attr) {
-      attr.flags &= ~Attr::kDirty;
-    });
+  return true;
+}
+
+void Display::Invalidate() {
+  m_attrs.MarkAllDirty();
+  DamageAllRows();
+}
+
+SkIRect Display::DrawOverlay(SkCanvas *canvas, const std::vector<string> &lines) {
+  constexpr SkScalar kPadding = 4;
+  constexpr SkColor kBackground = SkColorSetARGB(0xff, 0x20, 0x20, 0x20),
+                    kForeground = SkColorSetARGB(0xff, 0x80, 0xff, 0x80);
+
+  m_overlay_paint.setTypeface(m_fonts->OverlayTypeface());
+
+  SkPaint::FontMetrics metrics;
+  SkScalar line_height = m_overlay_paint.getFontMetrics(&metrics);
+
+  SkScalar width = 0;
+  for (auto &line : lines) {
+    width = std::max(width, m_overlay_paint.measureText(line.data(), line.size()));
   }
 
-  m_has_updated = false;
-  return significant_redraw;
+  // The box is opaque, since the cells under it aren't redrawn every frame.
+  SkISize size = canvas->getBaseLayerSize();
+  SkRect box = SkRect::MakeXYWH(size.width() - width - kPadding * 2, 0,
+                                width + kPadding * 2,
+                                line_height * lines.size() + kPadding * 2);
+
+  SkPaint background;
+  background.setColor(kBackground);
+  canvas->drawRect(box, background);
+
+  m_overlay_paint.setColor(kForeground);
+  SkScalar y = box.fTop + kPadding - metrics.fAscent;
+  for (auto &line : lines) {
+    canvas->drawText(line.data(), line.size(), box.fLeft + kPadding, y, m_overlay_paint);
+    y += line_height;
+  }
+
+  return box.roundOut();
 }
 
-void Display::TermDraw(const u32string& str, Pos pos, Attr attr, int width) {
-  attr.flags |= Attr::kDirty;
+void Display::TermDraw(uint row, uint begin, uint end, const Cell *cells) {
+  gStats.Count(Counter::kCellsRedrawn, end - begin);
+
+  for (uint x = begin; x < end; x++) {
+    const Cell &cell = cells[x - begin];
+    uint index = m_text.PosToOffset(x, row);
+    if (index >= m_attrs.size()) {
+      break;
+    }
+
+    bool style_changed = AttrsToFontStyle(m_attrs.At(index)) !=
+                         AttrsToFontStyle(cell.attr);
+    m_attrs.Set(index, cell.attr);
 
-  if (m_text.set_cell(pos.x, pos.y, str[0] ? str[0] : ' ')) {
-    UpdateGlyph(pos.x, pos.y);
+    if (m_text.set_cell(x, row, cell.c) || style_changed) {
+      UpdateGlyph(x, row);
+    }
   }
 
-  m_attrs.Update(m_text.PosToOffset(pos), attr);
-  m_has_updated = true;
+  DamageRow(row);
+}
+
+void Display::DamageRow(int y) {
+  if (y < m_row_damaged.size() && !m_row_damaged[y]) {
+    m_row_damaged[y] = true;
+    m_damaged_rows.push_back(y);
+  }
+}
+
+void Display::DamageAllRows() {
+  for (int y = 0; y < m_text.rows(); y++) {
+    DamageRow(y);
+  }
 }
 
 void Display::UpdateWidth() {
-  m_char_width = m_renderers[0].GetWidth();
+  m_char_width = primary_font().GetWidth();
   UpdatePositions();
 }
 
 void Display::UpdatePositions() {
-  m_text.UpdatePositions(m_renderers[0].GetHeight(), m_char_width);
+  m_text.UpdatePositions(primary_font().GetHeight(), m_char_width);
 }
 
 void Display::UpdateGlyphs() {
   for (int i=0; i<m_text.rows(); i++) {
     for (int j=0; j<m_text.cols(); j++) {
-      UpdateGlyph(i, j);
+      UpdateGlyph(j, i);
     }
   }
 }
@@ -141,38 +227,99 @@ void Display::UpdateGlyph(int x, int y) {
   char32_t c = m_text.cell(x, y);
   FontStyle style = AttrsToFontStyle(m_attrs.At(index));
 
-  bool found_success = false;
-  for (auto &renderer : m_renderers) {
-    if (found_success) {
-      renderer.ClearGlyph(index);
+  GlyphCache::Entry entry = m_fonts->Resolve(c, style);
+
+  // Fall back to the first renderer if a glyph cannot be found.
+  int owner = entry.renderer != -1 ? entry.renderer : 0;
+
+  for (int i = 0; i < m_renderers.size(); i++) {
+    if (i == owner) {
+      m_renderers[i].SetGlyph(index, entry.glyph);
     } else {
-      found_success = renderer.UpdateGlyph(c, index, style);
-      if (!found_success) {
-        renderer.ClearGlyph(index);
-      }
+      m_renderers[i].ClearGlyph(index);
     }
   }
-
-  // Fallback to the first renderer if a glyph cannot be found.
-  if (!found_success) {
-    m_renderers[0].UpdateGlyph(c, index, style);
-  }
 }
 
-void Display::HighlightRange(SkCanvas *canvas, Pos begin, Pos end, SkColor color) {
+void Display::HighlightRange(Pos begin, Pos end, SkColor color) {
   assert(begin.y <= end.y);
 
   for (int y = begin.y; y <= end.y; y++) {
     int first = y == begin.y ? begin.x : 0,
         last = y == end.y ? end.x : m_text.cols();
-    SkRect rect = SkRect::MakeXYWH(m_char_width * first,
-                                   m_renderers[0].GetHeight() * y +
-                                    m_renderers[0].GetBaselineOffset(),
-                                   m_char_width * (last - first),
-                                   m_renderers[0].GetHeight());
-    canvas->save();
-    canvas->clipRect(rect, false);
-    canvas->clear(color);
-    canvas->restore();
+    if (first == last) {
+      continue;
+    }
+
+    SkRect rect = RowRect(y, first, last);
+    m_damage.join(rect.roundOut());
+    m_batch.AddBackground(rect, color);
+  }
+}
+
+void Display::AddSpan(const AttrStore::Span &span) {
+  SkColor background;
+  if (span.attr.flags & Attr::kInverse) {
+    background = span.attr.foreground;
+  } else {
+    background = span.attr.background;
   }
+
+  HighlightRange(m_text.OffsetToPos(span.begin), m_text.OffsetToPos(span.end),
+                 background);
+
+  bool is_primary = true;
+  for (auto &renderer : m_renderers) {
+    m_text.AddRangeWithRenderer(&m_batch, &renderer, span.attr, span.begin, span.end,
+                                is_primary);
+    is_primary = false;
+  }
+}
+
+void Display::DrawRow(SkCanvas *canvas, int y) {
+  size_t begin = m_text.PosToOffset(0, y), end = begin + m_text.cols();
+
+  m_row_cells.clear();
+  for (int x = 0; x < m_text.cols(); x++) {
+    m_row_cells.push_back(Cell{m_text.cell(x, y), m_attrs.At(begin + x)});
+  }
+
+  SkRect rect = RowRect(y, 0, m_text.cols());
+  m_damage.join(rect.roundOut());
+
+  size_t hash = RowCache::Hash(m_row_cells);
+  sk_sp<SkPicture> picture = m_row_cache.Lookup(hash, m_row_cells);
+
+  if (picture == nullptr) {
+    // Rows are recorded relative to their own top, so they can be played back on any
+    // other row. The bounds leave room for glyphs overhanging the row.
+    SkPictureRecorder recorder;
+    SkCanvas *row_canvas = recorder.beginRecording(
+      SkRect::MakeLTRB(-m_char_width, -rect.height(), rect.width() + m_char_width,
+                       rect.height() * 2));
+    row_canvas->translate(0, -rect.fTop);
+
+    AttrStore::Span span;
+    span.end = begin;
+    while (m_attrs.NextDirtySpan(&span, end)) {
+      AddSpan(span);
+    }
+    m_batch.Flush(row_canvas);
+
+    picture = recorder.finishRecordingAsPicture();
+    m_row_cache.Insert(hash, m_row_cells, picture);
+  }
+
+  canvas->save();
+  canvas->translate(0, rect.fTop);
+  canvas->drawPicture(picture);
+  canvas->restore();
+}
+
+SkRect Display::RowRect(int y, int first, int last) {
+  return SkRect::MakeXYWH(m_char_width * first,
+                          primary_font().GetHeight() * y +
+                            primary_font().GetBaselineOffset(),
+                          m_char_width * (last - first),
+                          primary_font().GetHeight());
 }
@@ -7,35 +7,68 @@
 #include "base.h"
 #include "terminal.h"
 #include "text.h"
-#include "marker_set.h"
+#include "attr_store.h"
+#include "row_cache.h"
 
 class Display {
 public:
-  Display(Terminal *term);
+  // The font set must already have all its fonts, and has to outlive the display.
+  Display(Terminal *term, FontSet *fonts);
 
-  void AddFont(string name, int size);
+  int cols() { return m_text.cols(); }
+  int rows() { return m_text.rows(); }
 
   void SetSelection(Selection state, int mx, int my);
   void EndSelection();
 
   Error Resize(int width, int height);
   bool Draw(SkCanvas *canvas);
+  // Makes the next Draw redraw everything, e.g. to get rid of an overlay.
+  void Invalidate();
+  // Draws the given lines in a box in the top right corner, returning the area drawn.
+  SkIRect DrawOverlay(SkCanvas *canvas, const std::vector<string> &lines);
+
+  // The area of the canvas that was changed by the last call to Draw.
+  const SkIRect & damage() const { return m_damage; }
 private:
-  void TermDraw(const u32string& str, Pos pos, Attr attr, int width);
+  void TermDraw(uint row, uint begin, uint end, const Cell *cells);
   void UpdateWidth();
   void UpdatePositions();
   void UpdateGlyphs();
   void UpdateGlyph(int x, int y);
-  void HighlightRange(SkCanvas *canvas, Pos begin, Pos end, SkColor color);
+  void HighlightRange(Pos begin, Pos end, SkColor color);
+  // Adds the backgrounds and glyphs of the span to m_batch.
+  void AddSpan(const AttrStore::Span &span);
+  // Makes the next Draw look at the given row(s) for dirty cells.
+  void DamageRow(int y);
+  void DamageAllRows();
+  // Draws the given row, which must be entirely dirty, via the row cache.
+  void DrawRow(SkCanvas *canvas, int y);
+  SkRect RowRect(int y, int first, int last);
+
+  // The font everything is measured with.
+  Font & primary_font() { return m_fonts->font(0); }
 
   Terminal *m_term;
+  FontSet *m_fonts;
   int m_char_width{-1};
 
   TextManager m_text;
+  // One renderer per font in the set, in the same order.
   std::vector<GlyphRenderer> m_renderers;
 
-  using AttrSet = MarkerSet<Attr, Attr::Hash>;
-  AttrSet m_attrs;
+  AttrStore m_attrs;
+  PaintBatch m_batch;
+
+  static constexpr size_t kRowCacheSize = 1024;
+  RowCache m_row_cache{kRowCacheSize};
+  // The contents of the row being drawn by DrawRow, reused to avoid reallocating it.
+  std::vector<Cell> m_row_cells;
+
+  // The rows that have dirty cells, each listed once, in the order they were damaged.
+  std::vector<int> m_damaged_rows;
+  std::vector<bool> m_row_damaged;
+  SkIRect m_damage{SkIRect::MakeEmpty()};
 
-  bool m_has_updated{false};
+  SkPaint m_overlay_paint;
 };
@@ -105,3 +105,4 @@ T* Expect<T>::operator ->() { return &**this; }
 
 // XXX
 template class Expect<string>;
+template class Expect<size_t>;
@@ -1,5 +1,7 @@
 #include "gl_manager.h"
+#include "stats.h"
 
+#include <cstring>
 #include <sstream>
 
 static Error ExtendErrorWithLog(GLchar *log, Error err) {
@@ -51,11 +53,14 @@ static const char vertex_source[] =
   "layout (location = 0) in vec2 in_position;"
   "layout (location = 1) in vec2 in_texpos;"
 
+  // The part of the texture that's shown.
+  "uniform vec2 tex_scale;"
+
   "out vec2 texpos;"
 
   "void main() {"
     "gl_Position = vec4(in_position, 0.0, 1.0);"
-    "texpos = in_texpos;"
+    "texpos = in_texpos * tex_scale;"
   "}"
 ;
 
@@ -73,18 +78,28 @@ static const char fragment_source[] =
   "}"
 ;
 
-void GLManager::Resize(int width, int height) {
+void GLManager::Resize(int width, int height, int texture_width, int texture_height) {
   m_width = width;
   m_height = height;
 
   glViewport(0, 0, m_width, m_height);
 
-  glBindTexture(GL_TEXTURE_2D, m_texture.id());
-  glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, m_width, m_height, 0, GL_RGBA,
-               GL_UNSIGNED_BYTE, NULL);
+  if (texture_width != m_texture_width || texture_height != m_texture_height) {
+    m_texture_width = texture_width;
+    m_texture_height = texture_height;
+
+    glBindTexture(GL_TEXTURE_2D, m_texture.id());
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, m_texture_width, m_texture_height, 0,
+                 GL_RGBA, GL_UNSIGNED_BYTE, NULL);
+  }
+
+  glUseProgram(m_program.id());
+  glUniform2f(m_tex_scale_location,
+              static_cast<float>(m_width) / m_texture_width,
+              static_cast<float>(m_height) / m_texture_height);
 }
 
-Error GLManager::Initialize(int width, int height) {
+Error GLManager::Initialize() {
   glClearColor(1, 1, 1, 0);
 
   *m_vertex.id_ptr() = glCreateShader(GL_VERTEX_SHADER);
@@ -144,18 +159,63 @@ Error GLManager::Initialize(int width, int height) {
   glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR);
   glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR);
 
-  Resize(width, height);
+  for (auto &pbo : m_pbos) {
+    glGenBuffers(1, pbo.id_ptr());
+  }
 
   glUseProgram(m_program.id());
   glUniform1i(glGetUniformLocation(m_program.id(), "tex"), 0);
+  m_tex_scale_location = glGetUniformLocation(m_program.id(), "tex_scale");
 
   return Error::New();
 }
 
-void GLManager::UpdateTextureData(const void *data) {
+void GLManager::UpdateTextureData(const void *data, int row_pixels, int x, int y,
+                                  int width, int height) {
+  if (width <= 0 || height <= 0) {
+    return;
+  }
+
+  ScopedTimer timer{Stage::kUpload};
+
+  constexpr int kBytesPerPixel = 4;
+  const char *source = static_cast<const char*>(data) +
+                       (static_cast<size_t>(y) * row_pixels + x) * kBytesPerPixel;
+  size_t row_bytes = static_cast<size_t>(width) * kBytesPerPixel,
+         source_row_bytes = static_cast<size_t>(row_pixels) * kBytesPerPixel;
+
   glBindTexture(GL_TEXTURE_2D, m_texture.id());
-  glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, m_width, m_height, GL_RGBA, GL_UNSIGNED_BYTE,
-                  data);
+
+  GLuint pbo = m_pbos[m_current_pbo].id();
+  m_current_pbo = (m_current_pbo + 1) % kPixelBuffers;
+
+  // Re-specifying the buffer's storage orphans the old one, in case the driver still
+  // hasn't consumed it.
+  glBindBuffer(GL_PIXEL_UNPACK_BUFFER, pbo);
+  glBufferData(GL_PIXEL_UNPACK_BUFFER, row_bytes * height, NULL, GL_STREAM_DRAW);
+
+  void *mapped = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, row_bytes * height,
+                                  GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT);
+  if (mapped != nullptr) {
+    char *dest = static_cast<char*>(mapped);
+    for (int row = 0; row < height; row++) {
+      memcpy(dest + row * row_bytes, source + row * source_row_bytes, row_bytes);
+    }
+
+    if (glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER) == GL_TRUE) {
+      glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, width, height, GL_RGBA, GL_UNSIGNED_BYTE,
+                      reinterpret_cast<void*>(0));
+      glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+      return;
+    }
+  }
+
+  // The buffer couldn't be used, so upload straight from the client memory instead.
+  glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0);
+  glPixelStorei(GL_UNPACK_ROW_LENGTH, row_pixels);
+  glTexSubImage2D(GL_TEXTURE_2D, 0, x, y, width, height, GL_RGBA, GL_UNSIGNED_BYTE,
+                  source);
+  glPixelStorei(GL_UNPACK_ROW_LENGTH, 0);
 }
 
 void GLManager::Draw() {
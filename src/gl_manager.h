@@ -7,10 +7,17 @@
 
 class GLManager {
 public:
-  void Resize(int width, int height);
-  Error Initialize(int width, int height);
+  Error Initialize();
+  // Sets the size of the framebuffer, and of the texture, which can be larger. Only
+  // the framebuffer's worth of the texture's top left corner is shown. The texture's
+  // contents are lost if its size changes.
+  void Resize(int width, int height, int texture_width, int texture_height);
 
-  void UpdateTextureData(const void *data);
+  // Uploads the width x height rectangle at (x, y) of the given pixels, whose rows are
+  // row_pixels pixels apart, to the same place in the texture. data points to the
+  // start of the whole image, not the start of the rectangle.
+  void UpdateTextureData(const void *data, int row_pixels, int x, int y, int width,
+                         int height);
   void Draw();
 private:
   struct ShaderId {
@@ -50,10 +57,19 @@ private:
   };
 
   int m_width{-1}, m_height{-1};
+  int m_texture_width{-1}, m_texture_height{-1};
+  GLint m_tex_scale_location{-1};
 
   IdWrapper<ShaderId> m_vertex, m_fragment;
   IdWrapper<ProgramId> m_program;
   IdWrapper<VertexArrayId> m_vao;
   IdWrapper<BufferId> m_vbo, m_ebo;
   IdWrapper<TextureId> m_texture;
+
+  // Uploads are staged through two pixel unpack buffers, alternating between frames, so
+  // writing the next frame's pixels never has to wait for the driver to finish reading
+  // the previous ones.
+  static constexpr int kPixelBuffers = 2;
+  IdWrapper<BufferId> m_pbos[kPixelBuffers];
+  int m_current_pbo{0};
 };
@@ -1,5 +1,53 @@
 #include "uterm.h"
 
-int main() {
-  return gUterm.Run();
+static void Usage(const char *argv0) {
+  fmt::print(stderr,
+             "usage: {} [--record FILE | --replay FILE [--replay-fast]]\n"
+             "       {} --server | --client [--socket PATH]\n",
+             argv0, argv0);
+}
+
+int main(int argc, char **argv) {
+  UtermOptions options;
+
+  for (int i = 1; i < argc; i++) {
+    string arg{argv[i]};
+
+    if (arg == "-h" || arg == "--help") {
+      Usage(argv[0]);
+      return 0;
+    } else if (arg == "--replay-fast") {
+      options.replay_fast = true;
+    } else if (arg == "--server") {
+      options.server = true;
+    } else if (arg == "--client") {
+      options.client = true;
+    } else if ((arg == "--record" || arg == "--replay" || arg == "--socket") &&
+               i + 1 < argc) {
+      (arg == "--record" ? options.record :
+       arg == "--replay" ? options.replay : options.socket) = argv[++i];
+    } else {
+      Error::New(fmt::format("invalid argument: {}", arg)).Print();
+      Usage(argv[0]);
+      return 1;
+    }
+  }
+
+  if (!options.record.empty() && !options.replay.empty()) {
+    Error::New("--record and --replay can't be used together").Print();
+    return 1;
+  }
+
+  if (options.server && options.client) {
+    Error::New("--server and --client can't be used together").Print();
+    return 1;
+  }
+
+  if ((options.server || options.client) &&
+      (!options.record.empty() || !options.replay.empty())) {
+    Error::New("--record and --replay only work without --server or --client").Print();
+    return 1;
+  }
+
+  return gUterm.Run(options);
 }
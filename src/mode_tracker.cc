@@ -0,0 +1,79 @@
+#include "mode_tracker.h"
+
+#include <cstring>
+
+constexpr size_t ModeTracker::kMaxParams;
+
+void ModeTracker::Feed(const char *text, size_t len) {
+  const char *end = text + len;
+
+  while (text != end) {
+    if (m_state == State::kGround) {
+      text = static_cast<const char*>(memchr(text, '\x1b', end - text));
+      if (text == nullptr) {
+        return;
+      }
+
+      text++;
+      m_state = State::kEscape;
+      continue;
+    }
+
+    char c = *text++;
+    if (c == '\x1b') {
+      m_state = State::kEscape;
+      continue;
+    }
+
+    switch (m_state) {
+    case State::kGround:
+      break;
+    case State::kEscape:
+      if (c == '[') {
+        m_state = State::kCsi;
+        break;
+      } else if (c == 'c') {
+        // A full reset turns everything off again.
+        m_bracketed_paste = false;
+      }
+
+      m_state = State::kGround;
+      break;
+    case State::kCsi:
+      if (c == '?') {
+        m_params.clear();
+        m_state = State::kPrivate;
+      } else {
+        m_state = State::kGround;
+      }
+      break;
+    case State::kPrivate:
+      if (((c >= '0' && c <= '9') || c == ';') && m_params.size() < kMaxParams) {
+        m_params.push_back(c);
+        break;
+      } else if (c == 'h' || c == 'l') {
+        ApplyPrivateModes(c == 'h');
+      }
+
+      m_state = State::kGround;
+      break;
+    }
+  }
+}
+
+void ModeTracker::ApplyPrivateModes(bool set) {
+  size_t begin = 0;
+
+  while (begin <= m_params.size()) {
+    size_t end = m_params.find(';', begin);
+    if (end == string::npos) {
+      end = m_params.size();
+    }
+
+    if (m_params.compare(begin, end - begin, "2004") == 0) {
+      m_bracketed_paste = set;
+    }
+
+    begin = end + 1;
+  }
+}
@@ -0,0 +1,25 @@
+#pragma once
+
+#include "base.h"
+
+// A ModeTracker watches the output going to libtsm for the private modes that uterm
+// needs to know about but libtsm doesn't expose, i.e. bracketed paste (mode 2004). It
+// only looks at escape sequences, so most of the output is skipped over via memchr.
+class ModeTracker {
+public:
+  void Feed(const char *text, size_t len);
+
+  bool bracketed_paste() const { return m_bracketed_paste; }
+private:
+  void ApplyPrivateModes(bool set);
+
+  enum class State { kGround, kEscape, kCsi, kPrivate };
+  State m_state{State::kGround};
+
+  // The parameters of the current CSI ? ... h/l sequence. Anything longer than this
+  // isn't a mode list worth tracking.
+  static constexpr size_t kMaxParams = 64;
+  string m_params;
+
+  bool m_bracketed_paste{false};
+};
@@ -0,0 +1,96 @@
+#include "paint_batch.h"
+
+void PaintBatch::AddBackground(const SkRect &rect, SkColor color) {
+  ColorBatch *batch = GetBatch(color);
+
+  if (batch->has_pending_background) {
+    SkRect &pending = batch->pending_background;
+
+    if (pending.fTop == rect.fTop && pending.fBottom == rect.fBottom &&
+        pending.fRight == rect.fLeft) {
+      pending.fRight = rect.fRight;
+      return;
+    }
+
+    batch->backgrounds.addRect(pending);
+  }
+
+  batch->pending_background = rect;
+  batch->has_pending_background = true;
+}
+
+void PaintBatch::AddDecoration(const SkRect &rect, SkColor color) {
+  GetBatch(color)->decorations.addRect(rect);
+}
+
+SkTextBlobBuilder * PaintBatch::TextBuilder(SkColor color) {
+  ColorBatch *batch = GetBatch(color);
+  batch->has_text = true;
+  return &batch->text;
+}
+
+void PaintBatch::Flush(SkCanvas *canvas) {
+  SkPaint paint;
+  paint.setBlendMode(SkBlendMode::kSrc);
+
+  for (size_t i = 0; i < m_used; i++) {
+    ColorBatch *batch = m_batches[i].get();
+
+    if (batch->has_pending_background) {
+      batch->backgrounds.addRect(batch->pending_background);
+      batch->has_pending_background = false;
+    }
+
+    if (!batch->backgrounds.isEmpty()) {
+      paint.setColor(batch->color);
+      canvas->drawPath(batch->backgrounds, paint);
+    }
+  }
+
+  paint.setAntiAlias(true);
+
+  for (size_t i = 0; i < m_used; i++) {
+    ColorBatch *batch = m_batches[i].get();
+    if (!batch->has_text) {
+      continue;
+    }
+
+    auto blob = batch->text.make();
+    if (blob != nullptr) {
+      paint.setColor(batch->color);
+      canvas->drawTextBlob(blob, 0, 0, paint);
+    }
+  }
+
+  for (size_t i = 0; i < m_used; i++) {
+    ColorBatch *batch = m_batches[i].get();
+
+    if (!batch->decorations.isEmpty()) {
+      paint.setColor(batch->color);
+      canvas->drawPath(batch->decorations, paint);
+    }
+
+    batch->backgrounds.rewind();
+    batch->decorations.rewind();
+    batch->has_text = false;
+  }
+
+  m_batch_indexes.clear();
+  m_used = 0;
+}
+
+PaintBatch::ColorBatch * PaintBatch::GetBatch(SkColor color) {
+  auto it = m_batch_indexes.find(color);
+  if (it != m_batch_indexes.end()) {
+    return m_batches[it->second].get();
+  }
+
+  if (m_used == m_batches.size()) {
+    m_batches.emplace_back(new ColorBatch);
+  }
+
+  ColorBatch *batch = m_batches[m_used].get();
+  batch->color = color;
+  m_batch_indexes[color] = m_used++;
+  return batch;
+}
@@ -0,0 +1,49 @@
+#pragma once
+
+#include <SkCanvas.h>
+#include <SkPaint.h>
+#include <SkPath.h>
+#include <SkTextBlob.h>
+
+#include <sparsepp/spp.h>
+
+#include <memory>
+#include <vector>
+
+// A PaintBatch collects everything drawn in a frame, grouped by color, and then draws
+// it all at once. That way each distinct color costs a handful of canvas calls, no
+// matter how many cells use it.
+class PaintBatch {
+public:
+  // Fills the given rect, replacing whatever was there before. Rects that continue the
+  // previous one of the same color on the same row are merged.
+  void AddBackground(const SkRect &rect, SkColor color);
+  // Fills the given rect on top of the text.
+  void AddDecoration(const SkRect &rect, SkColor color);
+  // Returns the builder for text in the given color. Runs allocated in it must use
+  // kGlyphID_TextEncoding.
+  SkTextBlobBuilder * TextBuilder(SkColor color);
+
+  // Draws all the backgrounds, then all the text, then all the decorations, and resets
+  // the batch.
+  void Flush(SkCanvas *canvas);
+private:
+  struct ColorBatch {
+    SkColor color;
+    SkPath backgrounds, decorations;
+    // The last background rect, which hasn't been added to the path yet in case the
+    // next one continues it.
+    SkRect pending_background;
+    bool has_pending_background{false};
+    SkTextBlobBuilder text;
+    bool has_text{false};
+  };
+
+  ColorBatch * GetBatch(SkColor color);
+
+  // The batches are kept around between frames to reuse their storage; only the first
+  // m_used are part of the current frame.
+  std::vector<std::unique_ptr<ColorBatch>> m_batches;
+  spp::sparse_hash_map<SkColor, size_t> m_batch_indexes;
+  size_t m_used{0};
+};
@@ -1,4 +1,7 @@
 #include "pty.h"
+#include "stats.h"
+
+#include <algorithm>
 
 #include <sys/ioctl.h>
 #include <sys/wait.h>
@@ -27,9 +30,15 @@ private:
   int m_fd{-1};
 };
 
-static Error ChildSpawnTerm(const std::vector<string>& command, int slave) {
+static Error ChildSpawnTerm(const std::vector<string>& command, const string& cwd,
+                            int slave) {
   FdWrapper w_slave{slave};
 
+  // If the directory is gone, the shell just starts wherever uterm is.
+  if (!cwd.empty() && chdir(cwd.c_str()) == -1) {
+    Error::Errno().Extend(fmt::format("changing to {}", cwd)).Print();
+  }
+
   setenv("TERM", "xterm-256color", 1);
   setenv("COLORTERM", "truecolor", 1);
 
@@ -46,6 +55,11 @@ static Error ChildSpawnTerm(const std::vector<string>& command, int slave) {
   setsid();
   ioctl(0, TIOCSCTTY, 1);
 
+  // uterm blocks SIGCHLD in all its threads, which the shell would otherwise inherit.
+  sigset_t none;
+  sigemptyset(&none);
+  sigprocmask(SIG_SETMASK, &none, nullptr);
+
   std::vector<char*> c_command;
   for (auto& s : command) {
     char* c = new char[s.size()+1];
@@ -59,9 +73,23 @@ static Error ChildSpawnTerm(const std::vector<string>& command, int slave) {
   return Error::Errno().Extend("execv new process");
 }
 
-Pty::~Pty() { Signal(SIGKILL); }
+constexpr size_t Pty::kMaxWriteSize;
 
-Error Pty::Spawn(const std::vector<string>& command) {
+Pty::~Pty() {
+  Signal(SIGKILL);
+
+  if (m_master != -1) {
+    close(m_master);
+  }
+
+  for (int fd : m_wake_pipe) {
+    if (fd != -1) {
+      close(fd);
+    }
+  }
+}
+
+Error Pty::Spawn(const std::vector<string>& command, const string& cwd) {
   assert(command.size() >= 1);
 
   int master = posix_openpt(O_RDWR);
@@ -86,6 +114,19 @@ Error Pty::Spawn(const std::vector<string>& command) {
 
   FdWrapper w_slave{slave};
 
+  int wake_pipe[2];
+  if (pipe(wake_pipe) == -1) {
+    return Error::Errno().Extend("creating pty wake pipe");
+  }
+
+  FdWrapper w_wake_read{wake_pipe[0]}, w_wake_write{wake_pipe[1]};
+
+  for (int fd : wake_pipe) {
+    if (fcntl(fd, F_SETFL, O_NONBLOCK) == -1 || fcntl(fd, F_SETFD, FD_CLOEXEC) == -1) {
+      return Error::Errno().Extend("setting up pty wake pipe");
+    }
+  }
+
   int pid = fork();
 
   if (pid == -1) {
@@ -93,7 +134,7 @@ Error Pty::Spawn(const std::vector<string>& command) {
   } else if (pid == 0) {
     // Slave side.
     close(w_master.Relinquish());
-    auto err = ChildSpawnTerm(command, w_slave.Relinquish());
+    auto err = ChildSpawnTerm(command, cwd, w_slave.Relinquish());
 
     if (err) {
       err.Extend("in Pty::Spawn slave process").Print();
@@ -104,53 +145,141 @@ Error Pty::Spawn(const std::vector<string>& command) {
   } else {
     // Master side.
     close(w_slave.Relinquish());
+
+    // Reads drain the master until it's empty, so they must not block.
+    int flags = fcntl(master, F_GETFL);
+    if (flags == -1 || fcntl(master, F_SETFL, flags | O_NONBLOCK) == -1) {
+      return Error::Errno().Extend("making master PTY non-blocking");
+    }
+
+    // Other ptys' shells (when there's more than one window) shouldn't keep it open.
+    if (fcntl(master, F_SETFD, FD_CLOEXEC) == -1) {
+      return Error::Errno().Extend("setting FD_CLOEXEC on master PTY");
+    }
+
     m_master = w_master.Relinquish();
+    m_wake_pipe[0] = w_wake_read.Relinquish();
+    m_wake_pipe[1] = w_wake_write.Relinquish();
     m_pid = pid;
     return Error::New();
   }
 }
 
-Expect<string> Pty::Read(bool *eof) {
-  pid_t child_status = waitpid(m_pid, nullptr, WNOHANG);
-  if (child_status == m_pid || (child_status == -1 && errno == ECHILD)) {
-    *eof = true;
-    return Expect<string>::New(string(""));
-  }
+Error Pty::Wait(bool *eof) {
+  pollfd fds[2];
+  pollfd &poll_master = fds[0], &poll_wake = fds[1];
 
-  pollfd poll_master;
   poll_master.fd = m_master;
   poll_master.events = POLLIN;
+  if (has_pending_writes()) {
+    poll_master.events |= POLLOUT;
+  }
   poll_master.revents = 0;
 
-  fflush(stdout);
-  int polled = poll(&poll_master, 1, -1);
-  if (polled == -1) {
+  poll_wake.fd = m_wake_pipe[0];
+  poll_wake.events = POLLIN;
+  poll_wake.revents = 0;
+
+  if (poll(fds, 2, -1) == -1) {
     if (errno == EINTR) {
-      return Expect<string>::New(string(""));
+      return Error::New();
     } else {
-      return Expect<string>::New(Error::Errno().Extend("polling master PTY"));
+      return Error::Errno().Extend("polling master PTY");
     }
-  } else if (poll_master.revents & POLLIN) {
-    fflush(stdout);
-    char buf[4096];
-    int sz = read(m_master, buf, sizeof(buf));
+  }
 
-    if (sz == -1) {
-      return Expect<string>::New(Error::Errno().Extend("reading master PTY"));
-    }
+  if (poll_wake.revents & POLLIN) {
+    char buffer[64];
+    while (read(m_wake_pipe[0], buffer, sizeof(buffer)) > 0) {}
+  }
 
-    return Expect<string>::New(string(buf, sz));
+  if (poll_master.revents & (POLLIN | POLLOUT) || poll_wake.revents & POLLIN) {
+    return Error::New();
   } else if (poll_master.revents & (POLLERR | POLLHUP)) {
     *eof = true;
-    return Expect<string>::New(string(""));
+    return Error::New();
   } else {
-    return Expect<string>::WithError("unknown error occurred in NonblockingRead");
+    return Error::New("unknown error occurred in Pty::Wait");
   }
 }
 
-Error Pty::Write(const string& data) {
-  if (write(m_master, static_cast<const void*>(data.c_str()), data.size()) == -1) {
-    return Error::Errno().Extend("writing to master PTY");
+Expect<size_t> Pty::Read(char *buffer, size_t size, bool *eof) {
+  ssize_t sz;
+  {
+    ScopedTimer timer{Stage::kPtyRead};
+    sz = read(m_master, buffer, size);
+  }
+
+  if (sz == -1) {
+    if (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR) {
+      return Expect<size_t>::New(size_t{0});
+    } else if (errno == EIO) {
+      // Linux reports EIO once the slave side has been closed.
+      *eof = true;
+      return Expect<size_t>::New(size_t{0});
+    } else {
+      return Expect<size_t>::New(Error::Errno().Extend("reading master PTY"));
+    }
+  } else if (sz == 0) {
+    *eof = true;
+  }
+
+  return Expect<size_t>::New(static_cast<size_t>(sz));
+}
+
+Error Pty::Write(const char *data, size_t size) {
+  bool was_empty;
+
+  {
+    std::lock_guard<std::mutex> lock{m_write_lock};
+    was_empty = m_write_offset == m_write_queue.size();
+    m_write_queue.append(data, size);
+  }
+
+  // If there was something queued already, the waiting thread has been woken up for it
+  // and will write this as well.
+  if (was_empty && size != 0 && write(m_wake_pipe[1], "", 1) == -1 && errno != EAGAIN) {
+    return Error::Errno().Extend("waking up pty writer");
+  }
+
+  return Error::New();
+}
+
+bool Pty::has_pending_writes() {
+  std::lock_guard<std::mutex> lock{m_write_lock};
+  return m_write_offset != m_write_queue.size();
+}
+
+Error Pty::FlushWrites() {
+  std::lock_guard<std::mutex> lock{m_write_lock};
+
+  while (m_write_offset != m_write_queue.size()) {
+    size_t size = std::min(m_write_queue.size() - m_write_offset, kMaxWriteSize);
+    ssize_t sz = write(m_master, m_write_queue.data() + m_write_offset, size);
+
+    if (sz != -1) {
+      m_write_offset += sz;
+      continue;
+    } else if (errno == EINTR) {
+      continue;
+    } else if (errno == EAGAIN || errno == EWOULDBLOCK) {
+      // The child isn't keeping up; try again later.
+      break;
+    } else {
+      // Whatever was queued is never going to make it.
+      m_write_queue.clear();
+      m_write_offset = 0;
+      return Error::Errno().Extend("writing to master PTY");
+    }
+  }
+
+  if (m_write_offset == m_write_queue.size()) {
+    m_write_queue.clear();
+    m_write_offset = 0;
+  } else if (m_write_offset >= m_write_queue.size() / 2) {
+    // Don't let the written part pile up in front of a long paste.
+    m_write_queue.erase(0, m_write_offset);
+    m_write_offset = 0;
   }
 
   return Error::New();
@@ -168,6 +297,15 @@ Error Pty::Signal(int signal) {
   return Error::New();
 }
 
+bool Pty::HandleExit(int pid) {
+  if (pid != m_pid) {
+    return false;
+  }
+
+  m_exited.store(true);
+  return true;
+}
+
 Error Pty::Resize(int x, int y) {
   winsize ws;
   ws.ws_xpixel = ws.ws_ypixel = 0;
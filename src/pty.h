@@ -3,26 +3,60 @@
 #include "base.h"
 #include "error.h"
 
+#include <atomic>
+#include <mutex>
+
 // A Pty represents a currently active pty (surprise, surprise).
 class Pty {
 public:
   ~Pty();
 
-  // Spawn the given command within this pty.
-  Error Spawn(const std::vector<string>& command);
+  // Spawn the given command within this pty, in the given directory (or the current one
+  // if it's empty).
+  Error Spawn(const std::vector<string>& command, const string& cwd = "");
 
-  // Performs a blocking read from the pty output. If an EOF occurs, returns an empty
-  // string.
-  Expect<string> Read(bool *eof);
-  // Performs a blocking write
-  Error Write(const string& data);
+  // Blocks until the pty has output to read, queued writes can make progress, or a
+  // signal arrives. If the pty was hung up, sets *eof.
+  Error Wait(bool *eof);
+  // Performs a non-blocking read of at most size bytes from the pty output into
+  // buffer, returning the number of bytes read (0 if nothing was available). If an EOF
+  // occurs, sets *eof and returns 0.
+  Expect<size_t> Read(char *buffer, size_t size, bool *eof);
+  // Queues the data to be written to the pty, without writing anything itself. The
+  // thread calling Wait is woken up to write it (along with anything else queued in the
+  // meantime) via FlushWrites, so a child that isn't reading can't block the caller.
+  // Safe to call from any thread.
+  Error Write(const char *data, size_t size);
+  Error Write(const string& data) { return Write(data.data(), data.size()); }
+  // Writes as much of the queued data as possible without blocking.
+  Error FlushWrites();
+  // Whether there's queued data that hasn't been written yet.
+  bool has_pending_writes();
   // Sends the given signal to the pty.
   Error Signal(int signal);
   // Resizes the given pty to the number of columns and rows.
   Error Resize(int x, int y);
+
+  // Called when the process with the given PID has been reaped. Returns true if it was
+  // this pty's child. Safe to call from a signal handler.
+  bool HandleExit(int pid);
+  // Whether the child process has exited.
+  bool exited() { return m_exited.load(); }
 private:
   // The master end of the pty pipe.
   int m_master{-1};
   // The child process's PID.
   int m_pid{-1};
+  std::atomic<bool> m_exited{false};
+
+  // Wait also polls the read end of this pipe, so that Write can wake it up.
+  int m_wake_pipe[2]{-1, -1};
+
+  // Data waiting to be written; everything before m_write_offset already has been.
+  std::mutex m_write_lock;
+  string m_write_queue;
+  size_t m_write_offset{0};
+  // The most written in a single write call, which is about as much as the kernel's
+  // pty buffer can take anyway.
+  static constexpr size_t kMaxWriteSize = 64 * 1024;
 };
@@ -0,0 +1,129 @@
+#pragma once
+
+#include <algorithm>
+#include <atomic>
+#include <condition_variable>
+#include <mutex>
+#include <vector>
+
+// A RingBuffer is a fixed-capacity byte queue with exactly one producer thread and one
+// consumer thread. Both sides work directly on regions of the underlying storage, so
+// data is never copied on its way through. When the buffer is full, the producer can
+// block until the consumer makes room again.
+class RingBuffer {
+public:
+  // The capacity is rounded up to a power of two.
+  explicit RingBuffer(size_t capacity);
+
+  size_t capacity() const { return m_data.size(); }
+  // The number of bytes available for reading.
+  size_t size() const { return m_head.load() - m_tail.load(); }
+  bool empty() const { return size() == 0; }
+
+  // Producer side: sets *data to the largest contiguous free region, and returns its
+  // size. This may be less than the total free space if the region would wrap around.
+  size_t WriteRegion(char **data);
+  // Producer side: marks the first size bytes of the write region as filled. Returns
+  // true if the consumer has announced (via PrepareToWait) that it may be waiting for
+  // data, in which case it has to be woken up.
+  bool CommitWrite(size_t size);
+  // Producer side: blocks until there is free space. Returns false if the buffer was
+  // closed instead.
+  bool WaitForSpace();
+
+  // Consumer side: sets *data to the largest contiguous readable region, and returns
+  // its size.
+  size_t ReadRegion(const char **data);
+  // Consumer side: releases the first size bytes of the read region.
+  void CommitRead(size_t size);
+  // Consumer side: must be called before blocking until the producer signals more data.
+  // Returns false if data arrived in the meantime, in which case the consumer mustn't
+  // block: the producer may have committed it without knowing to signal.
+  bool PrepareToWait();
+
+  // Wakes up the producer if it's waiting for space, and prevents it from waiting
+  // again.
+  void Close();
+private:
+  size_t free_space() const { return m_data.size() - size(); }
+
+  std::vector<char> m_data;
+  size_t m_mask;
+
+  // Both of these only ever increase; they're masked when indexing into m_data. m_head
+  // is only written by the producer, and m_tail only by the consumer.
+  std::atomic<size_t> m_head{0}, m_tail{0};
+  // Set by the consumer before it blocks, and cleared by whichever producer commit
+  // finds it set. Either that commit sees it, or the consumer sees the new head. It
+  // starts out set, since the consumer might not have checked for data at all yet.
+  std::atomic<bool> m_reader_waiting{true};
+
+  std::mutex m_space_lock;
+  std::condition_variable m_space_cond;
+  std::atomic<bool> m_writer_waiting{false};
+  bool m_closed{false};
+};
+
+inline RingBuffer::RingBuffer(size_t capacity) {
+  size_t rounded = 1;
+  while (rounded < capacity) {
+    rounded <<= 1;
+  }
+
+  m_data.resize(rounded);
+  m_mask = rounded - 1;
+}
+
+inline size_t RingBuffer::WriteRegion(char **data) {
+  size_t head = m_head.load();
+  *data = m_data.data() + (head & m_mask);
+  return std::min(free_space(), m_data.size() - (head & m_mask));
+}
+
+inline bool RingBuffer::CommitWrite(size_t size) {
+  m_head.store(m_head.load() + size);
+  return m_reader_waiting.exchange(false);
+}
+
+inline bool RingBuffer::WaitForSpace() {
+  std::unique_lock<std::mutex> lock{m_space_lock};
+  m_writer_waiting.store(true);
+
+  while (free_space() == 0 && !m_closed) {
+    m_space_cond.wait(lock);
+  }
+
+  m_writer_waiting.store(false);
+  return !m_closed;
+}
+
+inline size_t RingBuffer::ReadRegion(const char **data) {
+  size_t tail = m_tail.load();
+  *data = m_data.data() + (tail & m_mask);
+  return std::min(size(), m_data.size() - (tail & m_mask));
+}
+
+inline void RingBuffer::CommitRead(size_t size) {
+  m_tail.store(m_tail.load() + size);
+
+  if (m_writer_waiting.load()) {
+    std::unique_lock<std::mutex> lock{m_space_lock};
+    m_space_cond.notify_one();
+  }
+}
+
+inline bool RingBuffer::PrepareToWait() {
+  m_reader_waiting.store(true);
+  if (!empty()) {
+    m_reader_waiting.store(false);
+    return false;
+  }
+
+  return true;
+}
+
+inline void RingBuffer::Close() {
+  std::unique_lock<std::mutex> lock{m_space_lock};
+  m_closed = true;
+  m_space_cond.notify_one();
+}
@@ -0,0 +1,47 @@
+#include "row_cache.h"
+
+RowCache::RowCache(size_t capacity): m_capacity{capacity} {}
+
+size_t RowCache::Hash(const std::vector<Cell> &cells) {
+  size_t hash = 0;
+  for (auto &cell : cells) {
+    Attr::Hash::combine(&hash, static_cast<uint32>(cell.c));
+    Attr::Hash::combine(&hash, Attr::Hash{}(cell.attr));
+  }
+  return hash;
+}
+
+sk_sp<SkPicture> RowCache::Lookup(size_t hash, const std::vector<Cell> &cells) {
+  auto it = m_entries.find(hash);
+  if (it == m_entries.end() || it->second->cells != cells) {
+    return nullptr;
+  }
+
+  m_lru.splice(m_lru.begin(), m_lru, it->second);
+  return it->second->picture;
+}
+
+void RowCache::Insert(size_t hash, const std::vector<Cell> &cells,
+                      sk_sp<SkPicture> picture) {
+  auto it = m_entries.find(hash);
+  if (it != m_entries.end()) {
+    // Either the same row, or a collision; either way, the new one wins.
+    it->second->cells = cells;
+    it->second->picture = std::move(picture);
+    m_lru.splice(m_lru.begin(), m_lru, it->second);
+    return;
+  }
+
+  if (m_entries.size() >= m_capacity) {
+    m_entries.erase(m_lru.back().hash);
+    m_lru.pop_back();
+  }
+
+  m_lru.push_front(Entry{hash, cells, std::move(picture)});
+  m_entries[hash] = m_lru.begin();
+}
+
+void RowCache::Clear() {
+  m_lru.clear();
+  m_entries.clear();
+}
@@ -0,0 +1,40 @@
+#pragma once
+
+#include "terminal.h"
+
+#include <SkPicture.h>
+
+#include <sparsepp/spp.h>
+
+#include <list>
+#include <vector>
+
+// A RowCache maps the contents of a whole row to a recording of it being drawn, so rows
+// that merely moved (e.g. when scrolling) can be played back instead of being laid out
+// again. Once it's full, the least recently used rows are evicted.
+class RowCache {
+public:
+  explicit RowCache(size_t capacity);
+
+  static size_t Hash(const std::vector<Cell> &cells);
+
+  // Returns the picture for the row with the given contents and hash, or nullptr if it
+  // isn't cached.
+  sk_sp<SkPicture> Lookup(size_t hash, const std::vector<Cell> &cells);
+  void Insert(size_t hash, const std::vector<Cell> &cells, sk_sp<SkPicture> picture);
+  void Clear();
+private:
+  struct Entry {
+    size_t hash;
+    // The hashes can collide, so the contents are compared too.
+    std::vector<Cell> cells;
+    sk_sp<SkPicture> picture;
+  };
+
+  using LruList = std::list<Entry>;
+
+  size_t m_capacity;
+  // The most recently used entries are at the front.
+  LruList m_lru;
+  spp::sparse_hash_map<size_t, LruList::iterator> m_entries;
+};
@@ -0,0 +1,197 @@
+#include "scrollback.h"
+
+#include <utf8.h>
+
+#include <cassert>
+#include <iterator>
+#include <limits>
+
+constexpr size_t Scrollback::kBlockLines;
+
+Scrollback::Scrollback(size_t max_lines): m_max_lines{max_lines} {}
+
+size_t Scrollback::memory_usage() const {
+  size_t usage = 0;
+
+  for (auto &block : m_blocks) {
+    usage += sizeof(block) + block.text.capacity() +
+             block.runs.capacity() * sizeof(Run) +
+             block.line_text_starts.capacity() * sizeof(uint32_t) +
+             block.line_run_starts.capacity() * sizeof(uint32_t) +
+             block.palette.capacity() * sizeof(tsm_screen_attr);
+  }
+
+  return usage;
+}
+
+void Scrollback::set_max_lines(size_t max_lines) {
+  m_max_lines = max_lines;
+  DropOldLines();
+}
+
+void Scrollback::Push(const ScrollbackCell *cells, size_t count,
+                      const tsm_screen_attr &def_attr) {
+  if (m_max_lines == 0) {
+    return;
+  }
+
+  AttrKey def_key = MakeAttrKey(def_attr);
+  while (count != 0 && (cells[count - 1].c == 0 || cells[count - 1].c == ' ') &&
+         MakeAttrKey(cells[count - 1].attr) == def_key) {
+    count--;
+  }
+
+  if (m_blocks.empty() || m_blocks.back().line_text_starts.size() == kBlockLines) {
+    m_blocks.emplace_back();
+    m_palette_indexes.clear();
+  }
+
+  Block &block = m_blocks.back();
+  block.line_text_starts.push_back(block.text.size());
+  block.line_run_starts.push_back(block.runs.size());
+
+  size_t text_begin = block.text.size();
+  auto text = std::back_inserter(block.text);
+  for (size_t i = 0; i < count; i++) {
+    const ScrollbackCell &cell = cells[i];
+    utf8::unchecked::append(cell.c, text);
+
+    uint16_t attr = Intern(cell.attr);
+    // Runs can't span lines, so the last run only counts if it's part of this one.
+    if (i != 0 && block.runs.back().attr == attr &&
+        block.runs.back().length != std::numeric_limits<uint16_t>::max()) {
+      block.runs.back().length++;
+    } else {
+      block.runs.push_back(Run{attr, 1});
+    }
+  }
+
+  block.filter.Add(block.text.data() + text_begin, block.text.size() - text_begin);
+
+  // Full blocks never change again, so the room left for them to grow is wasted.
+  if (block.line_text_starts.size() == kBlockLines) {
+    block.text.shrink_to_fit();
+    block.runs.shrink_to_fit();
+    block.palette.shrink_to_fit();
+  }
+
+  m_size++;
+  DropOldLines();
+}
+
+void Scrollback::Get(size_t line, std::vector<ScrollbackCell> *cells) const {
+  cells->clear();
+  if (line >= m_size) {
+    return;
+  }
+
+  const Block &block = m_blocks[line / kBlockLines];
+  size_t index = line % kBlockLines;
+
+  bool is_last = index + 1 == block.line_text_starts.size();
+  size_t text_begin = block.line_text_starts[index],
+         text_end = is_last ? block.text.size() : block.line_text_starts[index + 1];
+  size_t run_begin = block.line_run_starts[index],
+         run_end = is_last ? block.runs.size() : block.line_run_starts[index + 1];
+
+  auto text = block.text.begin() + text_begin;
+  for (size_t i = run_begin; i < run_end; i++) {
+    const Run &run = block.runs[i];
+    for (uint16_t j = 0; j < run.length; j++) {
+      char32_t c = utf8::unchecked::next(text);
+      cells->push_back(ScrollbackCell{c, block.palette[run.attr]});
+    }
+  }
+
+  assert(text == block.text.begin() + text_end);
+}
+
+void Scrollback::GetText(size_t line, const char **text, size_t *len) const {
+  if (line >= m_size) {
+    *text = nullptr;
+    *len = 0;
+    return;
+  }
+
+  const Block &block = m_blocks[line / kBlockLines];
+  size_t index = line % kBlockLines;
+
+  size_t begin = block.line_text_starts[index],
+         end = index + 1 == block.line_text_starts.size() ?
+                 block.text.size() : block.line_text_starts[index + 1];
+  *text = block.text.data() + begin;
+  *len = end - begin;
+}
+
+void Scrollback::Clear() {
+  m_dropped_blocks += m_blocks.size();
+  m_blocks.clear();
+  m_palette_indexes.clear();
+  m_size = 0;
+}
+
+bool Scrollback::MayMatch(size_t line, const SearchQuery &query, size_t *begin,
+                          size_t *end, uint64_t *id, bool *full) const {
+  assert(line < m_size);
+
+  size_t index = line / kBlockLines;
+  const Block &block = m_blocks[index];
+
+  *begin = index * kBlockLines;
+  *end = *begin + block.line_text_starts.size();
+  *id = m_dropped_blocks + index;
+  *full = block.line_text_starts.size() == kBlockLines;
+
+  return !query.excluded(*id) && query.MayMatch(block.filter);
+}
+
+Scrollback::AttrKey Scrollback::MakeAttrKey(const tsm_screen_attr &attr) {
+  AttrKey key;
+  key.colors = static_cast<uint64_t>(static_cast<uint8_t>(attr.fccode)) |
+               static_cast<uint64_t>(static_cast<uint8_t>(attr.bccode)) << 8 |
+               static_cast<uint64_t>(attr.fr) << 16 |
+               static_cast<uint64_t>(attr.fg) << 24 |
+               static_cast<uint64_t>(attr.fb) << 32 |
+               static_cast<uint64_t>(attr.br) << 40 |
+               static_cast<uint64_t>(attr.bg) << 48 |
+               static_cast<uint64_t>(attr.bb) << 56;
+  key.flags = attr.bold | attr.italic << 1 | attr.underline << 2 | attr.inverse << 3 |
+              attr.protect << 4 | attr.blink << 5;
+  return key;
+}
+
+uint16_t Scrollback::Intern(const tsm_screen_attr &attr) {
+  AttrKey key = MakeAttrKey(attr);
+
+  auto it = m_palette_indexes.find(key);
+  if (it != m_palette_indexes.end()) {
+    return it->second;
+  }
+
+  // A block has at most kBlockLines lines of 64k cells each, so in theory its palette
+  // could overflow. In that case, just reuse the first entry.
+  auto &palette = m_blocks.back().palette;
+  if (palette.size() > std::numeric_limits<uint16_t>::max()) {
+    return 0;
+  }
+
+  uint16_t index = palette.size();
+  palette.push_back(attr);
+  m_palette_indexes[key] = index;
+  return index;
+}
+
+void Scrollback::DropOldLines() {
+  // Lines are dropped a whole block at a time, so up to kBlockLines extra lines might be
+  // kept around.
+  while (!m_blocks.empty() && m_size - m_blocks.front().line_text_starts.size() >=
+                              m_max_lines) {
+    m_size -= m_blocks.front().line_text_starts.size();
+    m_blocks.pop_front();
+    m_dropped_blocks++;
+
+    if (m_blocks.empty()) {
+      m_palette_indexes.clear();
+    }
+  }
+}
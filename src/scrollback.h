@@ -0,0 +1,99 @@
+#pragma once
+
+#include "base.h"
+#include "search.h"
+
+#include <libtsm.h>
+
+#include <sparsepp/spp.h>
+
+#include <deque>
+#include <vector>
+
+// A single cell of a scrollback line. Empty cells (e.g. the second half of a wide
+// character) have c == 0.
+struct ScrollbackCell {
+  char32_t c;
+  tsm_screen_attr attr;
+};
+
+// A Scrollback stores lines that have scrolled too far to be kept by libtsm. libtsm
+// needs a few dozen bytes per cell, but most lines are mostly plain text, so here each
+// line is stored as UTF-8 text plus run-length encoded attributes. Lines are grouped
+// into blocks, each with its own attribute palette, and the oldest block is dropped
+// once there are more lines than the maximum. Each block also has a BigramFilter, so
+// searches can skip most of them without decoding anything.
+class Scrollback {
+public:
+  explicit Scrollback(size_t max_lines);
+
+  // The number of lines stored. Line 0 is the oldest one.
+  size_t size() const { return m_size; }
+  // The number of lines dropped so far. Adding this to a line number gives a number
+  // that stays the same as older lines are dropped.
+  uint64_t dropped() const { return m_dropped_blocks * kBlockLines; }
+  // The approximate number of bytes used by the stored lines.
+  size_t memory_usage() const;
+
+  void set_max_lines(size_t max_lines);
+
+  // Appends a line. Trailing blank cells with the default attributes are dropped.
+  void Push(const ScrollbackCell *cells, size_t count, const tsm_screen_attr &def_attr);
+  // Decodes the given line into *cells, replacing their previous contents.
+  void Get(size_t line, std::vector<ScrollbackCell> *cells) const;
+  // Returns the text of the given line, with one UTF-8 encoded codepoint per cell.
+  void GetText(size_t line, const char **text, size_t *len) const;
+  void Clear();
+
+  // Sets [*begin, *end) to the lines of the block containing line, and returns whether
+  // any of them could contain query. *id is set to an ID for the block that doesn't
+  // change when older blocks are dropped, and *full to whether the block is full (in
+  // which case it won't change anymore, either).
+  bool MayMatch(size_t line, const SearchQuery &query, size_t *begin, size_t *end,
+                uint64_t *id, bool *full) const;
+private:
+  static constexpr size_t kBlockLines = 256;
+
+  struct Run {
+    uint16_t attr, length;
+  };
+
+  struct Block {
+    // One codepoint per cell, for all the lines in the block.
+    string text;
+    std::vector<Run> runs;
+    // Where each line starts in text and in runs.
+    std::vector<uint32_t> line_text_starts, line_run_starts;
+    std::vector<tsm_screen_attr> palette;
+    BigramFilter filter;
+  };
+
+  // A key for looking up the palette index of a tsm_screen_attr, which can't be hashed
+  // or compared directly because of its bitfields.
+  struct AttrKey {
+    uint64_t colors;
+    uint32_t flags;
+
+    bool operator==(const AttrKey &rhs) const {
+      return colors == rhs.colors && flags == rhs.flags;
+    }
+
+    struct Hash {
+      size_t operator()(const AttrKey &key) const {
+        return std::hash<uint64_t>{}(key.colors) ^ (key.flags * 0x9e3779b9);
+      }
+    };
+  };
+
+  static AttrKey MakeAttrKey(const tsm_screen_attr &attr);
+
+  uint16_t Intern(const tsm_screen_attr &attr);
+  void DropOldLines();
+
+  size_t m_max_lines;
+  size_t m_size{0};
+  uint64_t m_dropped_blocks{0};
+  std::deque<Block> m_blocks;
+  // The palette indexes for the last block, which is the only one still being written.
+  spp::sparse_hash_map<AttrKey, uint16_t, AttrKey::Hash> m_palette_indexes;
+};
@@ -0,0 +1,93 @@
+#include "search.h"
+
+#include <absl/strings/ascii.h>
+
+#include <utf8.h>
+
+#include <algorithm>
+#include <cstring>
+
+constexpr size_t BigramFilter::kBits;
+
+void BigramFilter::Add(const char *text, size_t len) {
+  for (size_t i = 0; i + 1 < len; i++) {
+    m_bits.set(Hash(absl::ascii_tolower(text[i]), absl::ascii_tolower(text[i + 1])));
+  }
+}
+
+uint16_t BigramFilter::Hash(char a, char b) {
+  static_assert(kBits == 1 << 12, "the hash should have as many bits as the filter.");
+
+  uint32_t bigram = static_cast<uint8_t>(a) << 8 | static_cast<uint8_t>(b);
+  return (bigram * 0x9e3779b1) >> 20;
+}
+
+void SearchQuery::Set(const string &text) {
+  string lower{text};
+  std::transform(lower.begin(), lower.end(), lower.begin(), absl::ascii_tolower);
+
+  if (m_text.empty() || lower.find(m_text) == string::npos) {
+    m_excluded.clear();
+  }
+
+  m_text = lower;
+  m_length = utf8::unchecked::distance(m_text.begin(), m_text.end());
+
+  m_bigrams.clear();
+  for (size_t i = 0; i + 1 < m_text.size(); i++) {
+    m_bigrams.push_back(BigramFilter::Hash(m_text[i], m_text[i + 1]));
+  }
+}
+
+// Like memchr, but returns end instead of nullptr if c isn't found.
+static const char * Find(const char *begin, const char *end, char c) {
+  const char *p = static_cast<const char*>(memchr(begin, c, end - begin));
+  return p != nullptr ? p : end;
+}
+
+size_t SearchQuery::Find(const char *text, size_t len, size_t from) const {
+  size_t size = m_text.size();
+  if (size == 0 || len < size || from > len - size) {
+    return string::npos;
+  }
+
+  // Both cases of the first byte are found via memchr, remembering where the next one
+  // of each is so neither has to be searched for again until it's been passed.
+  const char *end = text + len - size + 1;
+  char firsts[] = {m_text[0], absl::ascii_toupper(m_text[0])};
+  int variants = firsts[0] == firsts[1] ? 1 : 2;
+  const char *next[] = {end, end};
+
+  const char *p = text + from;
+  for (int i = 0; i < variants; i++) {
+    next[i] = ::Find(p, end, firsts[i]);
+  }
+
+  for (;;) {
+    const char *candidate = std::min(next[0], next[1]);
+    if (candidate == end) {
+      return string::npos;
+    }
+
+    bool equal = true;
+    for (size_t i = 1; i < size && equal; i++) {
+      equal = absl::ascii_tolower(candidate[i]) == m_text[i];
+    }
+
+    if (equal) {
+      return candidate - text;
+    }
+
+    p = candidate + 1;
+    for (int i = 0; i < variants; i++) {
+      if (next[i] == candidate) {
+        next[i] = ::Find(p, end, firsts[i]);
+      }
+    }
+  }
+}
+
+bool SearchQuery::MayMatch(const BigramFilter &filter) const {
+  return std::all_of(m_bigrams.begin(), m_bigrams.end(),
+                     [&](uint16_t bigram) { return filter.Test(bigram); });
+}
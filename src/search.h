@@ -0,0 +1,52 @@
+#pragma once
+
+#include "base.h"
+
+#include <sparsepp/spp.h>
+
+#include <bitset>
+#include <vector>
+
+// A BigramFilter is a small Bloom filter over the pairs of adjacent bytes in some text,
+// ignoring ASCII case. If a query has a bigram that isn't in the filter, the text can't
+// contain the query, so it doesn't have to be looked at.
+class BigramFilter {
+public:
+  void Add(const char *text, size_t len);
+  bool Test(uint16_t bigram) const { return m_bits.test(bigram); }
+
+  // Returns the bit used for the given (already lowercased) bigram.
+  static uint16_t Hash(char a, char b);
+private:
+  static constexpr size_t kBits = 4096;
+  std::bitset<kBits> m_bits;
+};
+
+// A SearchQuery finds UTF-8 text, ignoring ASCII case. It also remembers which full
+// blocks of scrollback are known not to contain it, so that when the query is extended
+// (as it is on every keystroke while typing it), those blocks are skipped right away.
+class SearchQuery {
+public:
+  const string & text() const { return m_text; }
+  bool empty() const { return m_text.empty(); }
+  // The length of the query in codepoints, i.e. the number of cells a match covers.
+  uint length() const { return m_length; }
+
+  // Sets the text to search for. If the new text contains the old one, the blocks
+  // excluded so far stay excluded.
+  void Set(const string &text);
+
+  // Returns the offset of the first match in text at or after from, or string::npos.
+  size_t Find(const char *text, size_t len, size_t from) const;
+  // Whether text that was added to filter can contain the query.
+  bool MayMatch(const BigramFilter &filter) const;
+
+  void Exclude(uint64_t block) { m_excluded.insert(block); }
+  bool excluded(uint64_t block) const { return m_excluded.count(block) != 0; }
+private:
+  // Lowercased.
+  string m_text;
+  uint m_length{0};
+  std::vector<uint16_t> m_bigrams;
+  spp::sparse_hash_set<uint64_t> m_excluded;
+};
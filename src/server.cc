@@ -0,0 +1,265 @@
+#include "server.h"
+
+#include <cstdlib>
+#include <cstring>
+
+#include <sys/socket.h>
+#include <sys/time.h>
+#include <sys/un.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <poll.h>
+#include <unistd.h>
+
+constexpr int Server::kRequestTimeout;
+constexpr size_t Server::kMaxRequestSize;
+
+// Fills in addr for the given path, which has to fit in sun_path.
+static Error MakeAddress(const string &path, sockaddr_un *addr) {
+  memset(addr, 0, sizeof(*addr));
+  addr->sun_family = AF_UNIX;
+
+  if (path.size() >= sizeof(addr->sun_path)) {
+    return Error::New(fmt::format("socket path {} is too long", path));
+  }
+
+  memcpy(addr->sun_path, path.c_str(), path.size() + 1);
+  return Error::New();
+}
+
+// Returns a new socket connected to the given path, or -1.
+static int Connect(const string &path) {
+  sockaddr_un addr;
+  if (MakeAddress(path, &addr)) {
+    return -1;
+  }
+
+  int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (fd == -1) {
+    return -1;
+  }
+
+  if (connect(fd, reinterpret_cast<sockaddr*>(&addr), sizeof(addr)) == -1) {
+    close(fd);
+    return -1;
+  }
+
+  return fd;
+}
+
+static Error SetCloseOnExec(int fd) {
+  if (fcntl(fd, F_SETFD, FD_CLOEXEC) == -1) {
+    return Error::Errno().Extend("setting FD_CLOEXEC");
+  }
+
+  return Error::New();
+}
+
+Server::~Server() {
+  Stop();
+}
+
+Error Server::Listen(const string &path, WakeCb wake_cb) {
+  sockaddr_un addr;
+  if (auto err = MakeAddress(path, &addr)) {
+    return err;
+  }
+
+  int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (fd == -1) {
+    return Error::Errno().Extend("creating server socket");
+  }
+
+  // The shells spawned later shouldn't inherit the socket.
+  if (auto err = SetCloseOnExec(fd)) {
+    close(fd);
+    return err.Extend("on server socket");
+  }
+
+  auto addr_ptr = reinterpret_cast<sockaddr*>(&addr);
+  int bound = bind(fd, addr_ptr, sizeof(addr));
+  if (bound == -1 && errno == EADDRINUSE) {
+    // Either another server is using it, or one didn't get to clean up after itself.
+    int other = Connect(path);
+    if (other != -1) {
+      close(other);
+      close(fd);
+      return Error::New(fmt::format("another server is listening on {}", path));
+    }
+
+    unlink(path.c_str());
+    bound = bind(fd, addr_ptr, sizeof(addr));
+  }
+
+  if (bound == -1) {
+    close(fd);
+    return Error::Errno().Extend(fmt::format("binding server socket {}", path));
+  }
+
+  if (listen(fd, SOMAXCONN) == -1) {
+    close(fd);
+    return Error::Errno().Extend("listening on server socket");
+  }
+
+  if (pipe(m_wake_pipe) == -1) {
+    close(fd);
+    return Error::Errno().Extend("creating server wake pipe");
+  }
+
+  for (int pipe_fd : m_wake_pipe) {
+    if (auto err = SetCloseOnExec(pipe_fd)) {
+      err.Extend("on server wake pipe").Print();
+    }
+  }
+
+  m_path = path;
+  m_fd = fd;
+  m_wake_cb = wake_cb;
+  m_thread = std::thread{&Server::StaticRun, this};
+  return Error::New();
+}
+
+void Server::Stop() {
+  if (m_fd == -1) {
+    return;
+  }
+
+  m_done.store(true);
+  if (write(m_wake_pipe[1], "", 1) == -1) {
+    Error::Errno().Extend("waking up server thread").Print();
+  }
+  m_thread.join();
+
+  close(m_fd);
+  m_fd = -1;
+  unlink(m_path.c_str());
+
+  for (int &fd : m_wake_pipe) {
+    close(fd);
+    fd = -1;
+  }
+}
+
+void Server::TakeRequests(std::vector<WindowRequest> *requests) {
+  std::lock_guard<std::mutex> lock{m_requests_lock};
+  requests->insert(requests->end(), m_requests.begin(), m_requests.end());
+  m_requests.clear();
+}
+
+void Server::StaticRun() {
+  while (!m_done.load()) {
+    pollfd fds[2];
+    pollfd &poll_socket = fds[0], &poll_wake = fds[1];
+
+    poll_socket.fd = m_fd;
+    poll_socket.events = POLLIN;
+    poll_socket.revents = 0;
+
+    poll_wake.fd = m_wake_pipe[0];
+    poll_wake.events = POLLIN;
+    poll_wake.revents = 0;
+
+    if (poll(fds, 2, -1) == -1) {
+      if (errno != EINTR) {
+        Error::Errno().Extend("polling server socket").Print();
+        return;
+      }
+
+      continue;
+    }
+
+    if (poll_socket.revents & POLLIN) {
+      if (auto err = Accept()) {
+        err.Extend("handling window request").Print();
+      }
+    }
+  }
+}
+
+Error Server::Accept() {
+  int fd = accept(m_fd, nullptr, nullptr);
+  if (fd == -1) {
+    if (errno == EINTR || errno == EAGAIN || errno == ECONNABORTED) {
+      return Error::New();
+    }
+
+    return Error::Errno().Extend("accepting client");
+  }
+
+  timeval timeout;
+  timeout.tv_sec = kRequestTimeout;
+  timeout.tv_usec = 0;
+  setsockopt(fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+
+  WindowRequest request;
+  char buffer[256];
+
+  for (;;) {
+    ssize_t sz = read(fd, buffer, sizeof(buffer));
+    if (sz == -1 && errno == EINTR) {
+      continue;
+    } else if (sz == -1) {
+      close(fd);
+      return Error::Errno().Extend("reading request");
+    } else if (sz == 0) {
+      break;
+    }
+
+    request.cwd.append(buffer, sz);
+    if (request.cwd.size() > kMaxRequestSize) {
+      close(fd);
+      return Error::New("request is too large");
+    }
+  }
+
+  close(fd);
+
+  // Connections that don't send anything, e.g. another server checking whether this
+  // one is alive, aren't requests.
+  if (request.cwd.empty()) {
+    return Error::New();
+  }
+
+  {
+    std::lock_guard<std::mutex> lock{m_requests_lock};
+    m_requests.push_back(std::move(request));
+  }
+
+  m_wake_cb();
+  return Error::New();
+}
+
+string DefaultSocketPath() {
+  const char *runtime_dir = getenv("XDG_RUNTIME_DIR");
+  if (runtime_dir != nullptr && *runtime_dir != '\0') {
+    return fmt::format("{}/uterm.sock", runtime_dir);
+  }
+
+  return fmt::format("/tmp/uterm-{}.sock", getuid());
+}
+
+Error RequestWindow(const string &path) {
+  char cwd[PATH_MAX];
+  if (getcwd(cwd, sizeof(cwd)) == nullptr) {
+    return Error::Errno().Extend("getting the current directory");
+  }
+
+  int fd = Connect(path);
+  if (fd == -1) {
+    return Error::Errno().Extend(fmt::format("connecting to server {}", path));
+  }
+
+  size_t size = strlen(cwd);
+  for (size_t written = 0; written < size; ) {
+    ssize_t sz = write(fd, cwd + written, size - written);
+    if (sz == -1 && errno != EINTR) {
+      close(fd);
+      return Error::Errno().Extend("sending window request");
+    } else if (sz != -1) {
+      written += sz;
+    }
+  }
+
+  close(fd);
+  return Error::New();
+}
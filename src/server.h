@@ -0,0 +1,66 @@
+#pragma once
+
+#include "base.h"
+#include "error.h"
+
+#include <atomic>
+#include <functional>
+#include <mutex>
+#include <thread>
+#include <vector>
+
+// A client's request for a new window.
+struct WindowRequest {
+  // The directory the shell should be started in.
+  string cwd;
+};
+
+// A Server listens on a unix socket for clients asking for new windows, so one process
+// can host all of them (and only has to load fonts and fill glyph caches once).
+// Connections are accepted on a thread of its own, and the main thread picks up the
+// requests via TakeRequests.
+class Server {
+public:
+  using WakeCb = std::function<void()>;
+
+  ~Server();
+
+  // Starts listening on the given socket path. wake_cb is called (from the server
+  // thread) whenever a request arrives.
+  Error Listen(const string &path, WakeCb wake_cb);
+  // Stops listening, and removes the socket.
+  void Stop();
+
+  // Moves the requests that arrived since the last call into *requests.
+  void TakeRequests(std::vector<WindowRequest> *requests);
+private:
+  void StaticRun();
+  // Accepts a connection and reads its request, which is just the working directory,
+  // ended by the client shutting down its end.
+  Error Accept();
+
+  // Clients that connect but never finish their request are dropped after this long,
+  // so they can't hold up anyone else.
+  static constexpr int kRequestTimeout = 1;
+  static constexpr size_t kMaxRequestSize = 4096;
+
+  string m_path;
+  int m_fd{-1};
+  // Stop writes to this pipe to wake up the server thread.
+  int m_wake_pipe[2]{-1, -1};
+  WakeCb m_wake_cb;
+
+  std::mutex m_requests_lock;
+  std::vector<WindowRequest> m_requests;
+
+  std::atomic<bool> m_done{false};
+  std::thread m_thread;
+};
+
+// Returns the socket used if none is given: uterm.sock in $XDG_RUNTIME_DIR, or
+// /tmp/uterm-UID.sock if that isn't set.
+string DefaultSocketPath();
+
+// Asks the server listening on the given socket to open a window, with the shell
+// started in the current directory.
+Error RequestWindow(const string &path);
@@ -0,0 +1,188 @@
+#include "stats.h"
+
+#include <algorithm>
+#include <cstdio>
+
+Stats gStats;
+
+constexpr int Stats::kStages, Stats::kCounters, Stats::kMilestones;
+
+static const char *kStageNames[] = {
+  "pty_read", "parse", "term_draw", "display_draw", "flush", "upload",
+};
+
+static const char *kCounterNames[] = {
+  "bytes_parsed", "cells_redrawn", "frames",
+};
+
+static const char *kMilestoneNames[] = {
+  "font_loaded", "window_created", "first_frame", "first_output",
+};
+
+static_assert(sizeof(kStageNames) / sizeof(kStageNames[0]) ==
+              StageToInt(Stage::kEnd), "every stage needs a name.");
+static_assert(sizeof(kCounterNames) / sizeof(kCounterNames[0]) ==
+              CounterToInt(Counter::kEnd), "every counter needs a name.");
+static_assert(sizeof(kMilestoneNames) / sizeof(kMilestoneNames[0]) ==
+              MilestoneToInt(Milestone::kEnd), "every milestone needs a name.");
+
+static double NsToMs(double ns) {
+  return ns / 1e6;
+}
+
+Stats::Stats(): m_start{Clock::now()}, m_last_sample{m_start} {
+  for (auto &counter : m_counters) {
+    counter.store(0);
+  }
+
+  for (auto &milestone : m_milestones) {
+    milestone.store(-1);
+  }
+
+  m_last_stage_ns.fill(0);
+  m_last_counters.fill(0);
+}
+
+void Stats::Record(Stage stage, Clock::duration duration) {
+  StageTotals &totals = m_stages[StageToInt(stage)];
+  uint64_t ns = std::chrono::duration_cast<std::chrono::nanoseconds>(duration).count();
+
+  totals.count.fetch_add(1, std::memory_order_relaxed);
+  totals.total_ns.fetch_add(ns, std::memory_order_relaxed);
+
+  uint64_t max = totals.max_ns.load(std::memory_order_relaxed);
+  while (ns > max &&
+         !totals.max_ns.compare_exchange_weak(max, ns, std::memory_order_relaxed)) {}
+}
+
+void Stats::Count(Counter counter, uint64_t amount) {
+  m_counters[CounterToInt(counter)].fetch_add(amount, std::memory_order_relaxed);
+}
+
+void Stats::Mark(Milestone milestone) {
+  auto &reached = m_milestones[MilestoneToInt(milestone)];
+  if (reached.load(std::memory_order_relaxed) != -1) {
+    return;
+  }
+
+  int64_t ns = std::chrono::duration_cast<std::chrono::nanoseconds>(
+    Clock::now() - m_start).count();
+  int64_t expected = -1;
+  reached.compare_exchange_strong(expected, ns, std::memory_order_relaxed);
+}
+
+std::vector<string> Stats::Sample() {
+  auto now = Clock::now();
+  double seconds = std::chrono::duration<double>(now - m_last_sample).count();
+  m_last_sample = now;
+
+  std::array<double, kStages> stage_ns;
+  for (int i = 0; i < kStages; i++) {
+    uint64_t total = m_stages[i].total_ns.load(std::memory_order_relaxed);
+    stage_ns[i] = total - m_last_stage_ns[i];
+    m_last_stage_ns[i] = total;
+  }
+
+  std::array<double, kCounters> counters;
+  for (int i = 0; i < kCounters; i++) {
+    uint64_t total = m_counters[i].load(std::memory_order_relaxed);
+    counters[i] = total - m_last_counters[i];
+    m_last_counters[i] = total;
+  }
+
+  double frames = std::max(counters[CounterToInt(Counter::kFrames)], 1.0);
+  auto per_frame = [&](Stage stage) {
+    return NsToMs(stage_ns[StageToInt(stage)] / frames);
+  };
+
+  double parse = per_frame(Stage::kPtyRead) + per_frame(Stage::kParse),
+         raster = per_frame(Stage::kTermDraw) + per_frame(Stage::kDisplayDraw) +
+                  per_frame(Stage::kFlush),
+         upload = per_frame(Stage::kUpload);
+
+  const char *bound = "idle";
+  if (parse + raster + upload > 0) {
+    bound = parse >= raster && parse >= upload ? "parse" :
+            raster >= upload ? "raster" : "upload";
+  }
+
+  return {
+    fmt::format("{:.0f} fps  {:.0f} KB/frame  {:.0f} cells/frame  {}-bound",
+                counters[CounterToInt(Counter::kFrames)] / std::max(seconds, 1e-9),
+                counters[CounterToInt(Counter::kBytesParsed)] / 1024 / frames,
+                counters[CounterToInt(Counter::kCellsRedrawn)] / frames, bound),
+    fmt::format("ms/frame: read {:.2f}  parse {:.2f}  term {:.2f}",
+                per_frame(Stage::kPtyRead), per_frame(Stage::kParse),
+                per_frame(Stage::kTermDraw)),
+    fmt::format("display {:.2f}  flush {:.2f}  upload {:.2f}",
+                per_frame(Stage::kDisplayDraw), per_frame(Stage::kFlush),
+                per_frame(Stage::kUpload)),
+  };
+}
+
+string Stats::ToJson() {
+  double seconds = std::chrono::duration<double>(Clock::now() - m_start).count();
+  double frames = std::max(
+    m_counters[CounterToInt(Counter::kFrames)].load(std::memory_order_relaxed),
+    uint64_t{1});
+
+  string json = fmt::format("{{\n  \"uptime_seconds\": {:.3f},\n  \"stages\": {{\n",
+                            seconds);
+
+  for (int i = 0; i < kStages; i++) {
+    const StageTotals &totals = m_stages[i];
+    uint64_t count = totals.count.load(std::memory_order_relaxed),
+             total = totals.total_ns.load(std::memory_order_relaxed),
+             max = totals.max_ns.load(std::memory_order_relaxed);
+
+    json += fmt::format("    \"{}\": {{\"count\": {}, \"total_ms\": {:.3f}, "
+                        "\"avg_ms\": {:.4f}, \"max_ms\": {:.3f}, "
+                        "\"per_frame_ms\": {:.4f}}}{}\n",
+                        kStageNames[i], count, NsToMs(total),
+                        count ? NsToMs(static_cast<double>(total) / count) : 0,
+                        NsToMs(max), NsToMs(total / frames),
+                        i + 1 == kStages ? "" : ",");
+  }
+
+  json += "  },\n  \"startup_ms\": {\n";
+
+  for (int i = 0; i < kMilestones; i++) {
+    int64_t ns = m_milestones[i].load(std::memory_order_relaxed);
+    json += fmt::format("    \"{}\": {}{}\n", kMilestoneNames[i],
+                        ns == -1 ? "null" : fmt::format("{:.3f}", NsToMs(ns)),
+                        i + 1 == kMilestones ? "" : ",");
+  }
+
+  json += "  },\n  \"counters\": {\n";
+
+  for (int i = 0; i < kCounters; i++) {
+    uint64_t value = m_counters[i].load(std::memory_order_relaxed);
+    json += fmt::format("    \"{}\": {{\"total\": {}, \"per_frame\": {:.1f}}}{}\n",
+                        kCounterNames[i], value, value / frames,
+                        i + 1 == kCounters ? "" : ",");
+  }
+
+  json += "  }\n}\n";
+  return json;
+}
+
+Error Stats::Dump(const string &path) {
+  string json = ToJson();
+
+  if (path.empty()) {
+    fmt::print(stderr, "{}", json);
+    return Error::New();
+  }
+
+  FILE *fp = fopen(path.c_str(), "w");
+  if (fp == nullptr) {
+    return Error::Errno().Extend(fmt::format("opening {}", path));
+  }
+
+  bool ok = fwrite(json.data(), 1, json.size(), fp) == json.size();
+  if (fclose(fp) != 0 || !ok) {
+    return Error::Errno().Extend(fmt::format("writing {}", path));
+  }
+
+  return Error::New();
+}
@@ -0,0 +1,86 @@
+#pragma once
+
+#include "base.h"
+#include "error.h"
+
+#include <array>
+#include <atomic>
+#include <chrono>
+#include <vector>
+
+// The timed stages of the pipeline, from reading the pty to getting the frame on screen.
+enum class Stage { kPtyRead, kParse, kTermDraw, kDisplayDraw, kFlush, kUpload, kEnd };
+constexpr int StageToInt(Stage stage) { return static_cast<int>(stage); }
+
+enum class Counter { kBytesParsed, kCellsRedrawn, kFrames, kEnd };
+constexpr int CounterToInt(Counter counter) { return static_cast<int>(counter); }
+
+// Points during startup, the last of which is the shell's first output (usually the
+// prompt) being on screen.
+enum class Milestone { kFontLoaded, kWindowCreated, kFirstFrame, kFirstOutput, kEnd };
+constexpr int MilestoneToInt(Milestone milestone) {
+  return static_cast<int>(milestone);
+}
+
+// Stats collects timings of the pipeline stages and a few counters, which is enough to
+// tell whether uterm is bound by parsing, rasterizing, or uploading frames. Recording
+// only takes a few relaxed atomic operations, so it's always on, and it's safe to do
+// from any thread.
+class Stats {
+public:
+  using Clock = std::chrono::steady_clock;
+
+  Stats();
+
+  void Record(Stage stage, Clock::duration duration);
+  void Count(Counter counter, uint64_t amount = 1);
+  // Records the time since startup at which the milestone was reached, unless it was
+  // reached before.
+  void Mark(Milestone milestone);
+
+  // Returns a few lines describing the time since the last call, averaged per frame,
+  // for the overlay.
+  std::vector<string> Sample();
+  // Returns everything recorded since startup as a JSON object.
+  string ToJson();
+  // Writes ToJson to the given file, or to stderr if path is empty.
+  Error Dump(const string &path);
+
+  // Asks for a dump on the next main loop iteration. Safe to call from a signal handler.
+  void RequestDump() { m_dump_requested.store(true); }
+  // Returns whether a dump was requested, and clears the request.
+  bool TakeDumpRequest() { return m_dump_requested.exchange(false); }
+private:
+  static constexpr int kStages = StageToInt(Stage::kEnd),
+                       kCounters = CounterToInt(Counter::kEnd),
+                       kMilestones = MilestoneToInt(Milestone::kEnd);
+
+  struct StageTotals {
+    std::atomic<uint64_t> count{0}, total_ns{0}, max_ns{0};
+  };
+
+  Clock::time_point m_start;
+  std::array<StageTotals, kStages> m_stages;
+  std::array<std::atomic<uint64_t>, kCounters> m_counters;
+  // Nanoseconds since m_start, or -1 if not reached yet.
+  std::array<std::atomic<int64_t>, kMilestones> m_milestones;
+
+  // The totals as of the last call to Sample.
+  Clock::time_point m_last_sample;
+  std::array<uint64_t, kStages> m_last_stage_ns;
+  std::array<uint64_t, kCounters> m_last_counters;
+
+  std::atomic<bool> m_dump_requested{false};
+};
+
+extern Stats gStats;
+
+// Records the time between its construction and destruction for the given stage.
+class ScopedTimer {
+public:
+  explicit ScopedTimer(Stage stage): m_stage{stage}, m_start{Stats::Clock::now()} {}
+  ~ScopedTimer() { gStats.Record(m_stage, Stats::Clock::now() - m_start); }
+private:
+  Stage m_stage;
+  Stats::Clock::time_point m_start;
+};
@@ -1,10 +1,36 @@
 #include "terminal.h"
+#include "stats.h"
 
 #include <algorithm>
+#include <cstring>
+#include <limits>
 #include <unistd.h>
 
+#include <absl/strings/ascii.h>
+
 #include <utf8.h>
 
+#include <libtsm-sb.h>
+
+extern "C" {
+#include <libtsm-int.h>
+}
+
+constexpr size_t Terminal::kHotScrollback, Terminal::kMaxLinesPerInput;
+
+// Only the first codepoint of combined symbols is used, since that's all that's drawn
+// anyway.
+static char32_t CellChar(tsm_screen *screen, const struct cell &cell) {
+  if (cell.ch == 0) {
+    return 0;
+  }
+
+  tsm_symbol_t symbol = cell.ch;
+  size_t size;
+  const uint32_t *chars = tsm_symbol_get(screen->sym_table, &symbol, &size);
+  return size != 0 ? chars[0] : 0;
+}
+
 Terminal::Terminal() {
   tsm_screen_new(&m_screen, nullptr, nullptr);
   tsm_vte_new(&m_vte, m_screen, StaticWrite, static_cast<void*>(this), nullptr, nullptr);
@@ -14,16 +40,19 @@ Terminal::Terminal() {
   tattr.fccode = Colors::kForeground;
   tattr.bccode = Colors::kBackground;
 
-  tattr.bold = tattr.underline = tattr.inverse = tattr.protect = tattr.blink = 0;
+  tattr.bold = tattr.italic = tattr.underline = tattr.inverse = tattr.protect =
+    tattr.blink = 0;
   tsm_screen_set_def_attr(m_screen, &tattr);
 
-  constexpr int kMaxSb = 1024;
-  tsm_screen_set_max_sb(m_screen, kMaxSb);
+  SetScrollbackSize(kHotScrollback);
 
   ResetSelection();
 }
 
-void Terminal::set_theme(const Theme& theme) { m_theme = &theme; }
+void Terminal::set_theme(const Theme& theme) {
+  m_theme = &theme;
+  m_has_last_attr = false;
+}
 
 void Terminal::set_draw_cb(DrawCb draw_cb) { m_draw_cb = draw_cb; }
 void Terminal::set_copy_cb(CopyCb copy_cb) { m_copy_cb = copy_cb; }
@@ -42,18 +71,27 @@ void Terminal::SetSelection(Selection state, uint x, uint y) {
     tsm_screen_selection_start(m_screen, x, y);
     m_selection_range.begin = m_selection_range.end = m_selection_range.origin = {x, y};
     break;
-  case Selection::kUpdate:
+  case Selection::kUpdate: {
+    // The mouse moving within the same cell doesn't change anything.
+    Pos target = m_selection_range.begin == m_selection_range.origin
+                   ? m_selection_range.end : m_selection_range.begin;
+    if (target == Pos{x, y}) {
+      return;
+    }
+
     if (y < m_selection_range.origin.y ||
         (y == m_selection_range.origin.y && x < m_selection_range.origin.x)) {
       // Moving backwards: update the beginning offsets.
       m_selection_range.end = m_selection_range.origin;
       m_selection_range.begin = {x, y};
     } else {
+      m_selection_range.begin = m_selection_range.origin;
       m_selection_range.end = {x, y};
     }
 
     tsm_screen_selection_target(m_screen, x, y);
     break;
+  }
   case Selection::kEnd:
     assert(false);
   }
@@ -84,7 +122,15 @@ Error Terminal::Resize(int x, int y) {
   tsm_screen_resize(m_screen, x, y);
   m_has_updated = true;
 
-  if (auto err = m_pty->Resize(x, y)) {
+  // Everything has to be reported again to fill the new cell buffer.
+  m_age = 0;
+  m_cols = x;
+  m_cells.resize(x * y);
+  m_changed_rows.assign(y, RowRange{std::numeric_limits<uint>::max(), 0});
+
+  if (m_pty == nullptr) {
+    return Error::New();
+  } else if (auto err = m_pty->Resize(x, y)) {
     return err.Extend("resizing terminal");
   } else {
     return Error::New();
@@ -92,20 +138,406 @@ Error Terminal::Resize(int x, int y) {
 }
 
 void Terminal::Scroll(ScrollDirection direction, uint distance) {
-  switch (direction) {
-  case ScrollDirection::kUp:
-    tsm_screen_sb_up(m_screen, distance);
-    break;
-  case ScrollDirection::kDown:
-    tsm_screen_sb_down(m_screen, distance);
-    break;
+  for (; distance != 0; distance--) {
+    bool at_hot_top = m_screen->sb_count == 0 || m_screen->sb_pos == m_screen->sb_first;
+
+    if (direction == ScrollDirection::kUp) {
+      if (!at_hot_top) {
+        tsm_screen_sb_up(m_screen, 1);
+      } else if (m_cold_offset < m_scrollback.size()) {
+        m_cold_offset++;
+      } else {
+        break;
+      }
+    } else {
+      if (m_cold_offset != 0) {
+        m_cold_offset--;
+      } else if (tsm_screen_sb_is_scrolled(m_screen)) {
+        tsm_screen_sb_down(m_screen, 1);
+      } else {
+        break;
+      }
+    }
   }
 
+  // Everything moved, including the rows that libtsm doesn't know about.
+  m_age = 0;
   m_has_updated = true;
 }
 
-void Terminal::WriteToScreen(string text) {
-  tsm_vte_input(m_vte, text.c_str(), text.size());
+void Terminal::SetScrollbackSize(size_t lines) {
+  if (lines <= kHotScrollback) {
+    m_hot_scrollback = lines;
+    m_scrollback.set_max_lines(0);
+    tsm_screen_set_max_sb(m_screen, lines);
+  } else {
+    m_hot_scrollback = kHotScrollback;
+    m_scrollback.set_max_lines(lines - kHotScrollback);
+    tsm_screen_set_max_sb(m_screen, kHotScrollback + kMaxLinesPerInput);
+  }
+
+  m_cold_offset = std::min(m_cold_offset, m_scrollback.size());
+  MigrateScrollback();
+}
+
+void Terminal::WriteToScreen(const char *text, size_t len) {
+  ScopedTimer timer{Stage::kParse};
+  gStats.Count(Counter::kBytesParsed, len);
+
+  const char *end = text + len;
+
+  while (text != end) {
+    const char *chunk_end = m_hot_scrollback == kHotScrollback
+                            ? ScrollChunkEnd(text, end) : end;
+
+    m_modes.Feed(text, chunk_end - text);
+    tsm_vte_input(m_vte, text, chunk_end - text);
+    MigrateScrollback();
+    text = chunk_end;
+  }
+
+  m_has_updated = true;
+}
+
+const char *Terminal::ScrollChunkEnd(const char *text, const char *end) {
+  // Lines are counted generously rather than exactly, which would mean emulating
+  // libtsm: every control character or escape sequence counts as one line, since it
+  // could be a line feed, or move the cursor to the last column so that the next
+  // character wraps. Otherwise a line is counted every m_cols bytes, and CSI n S, which
+  // scrolls by up to a screenful at once, counts as n.
+  size_t rows = tsm_screen_get_height(m_screen);
+  // A sequence cut off by the previous chunk may still scroll, and the cursor's current
+  // row may wrap before m_cols bytes are through.
+  size_t lines = rows + 1;
+  size_t column = 0, param = 0;
+
+  enum class State { kGround, kEscape, kCsi };
+  State state = State::kGround;
+
+  const char *p = text;
+  while (p != end) {
+    unsigned char c = *p;
+    size_t size = 1, scroll = 0;
+
+    if (c < 0x20 || c == 0x7f) {
+      // Control characters are run even in the middle of a sequence, and ESC starts
+      // a new one.
+      scroll = 1;
+      column = 0;
+      if (c == 0x1b) {
+        state = State::kEscape;
+      }
+    } else if (state == State::kEscape) {
+      state = c == '[' ? State::kCsi : State::kGround;
+      param = 0;
+    } else if (state == State::kCsi) {
+      if (c >= '0' && c <= '9') {
+        param = std::min(param * 10 + (c - '0'), rows);
+      } else if (c >= 0x40 && c <= 0x7e) {
+        if (c == 'S') {
+          scroll = std::max(param, static_cast<size_t>(1));
+        }
+        state = State::kGround;
+      }
+    } else if (c == 0xc2 && end - p >= 2 && static_cast<unsigned char>(p[1]) < 0xa0) {
+      // C1 controls are UTF-8 encoded, and include IND, NEL, and CSI.
+      scroll = 1;
+      column = 0;
+      param = 0;
+      state = p[1] == '\x9b' ? State::kCsi : State::kGround;
+      size = 2;
+    } else if (++column == m_cols) {
+      scroll = 1;
+      column = 0;
+    }
+
+    if (lines + scroll > kMaxLinesPerInput && p != text) {
+      break;
+    }
+    lines += scroll;
+    p += size;
+  }
+
+  return p;
+}
+
+void Terminal::MigrateScrollback() {
+  if (m_hot_scrollback != kHotScrollback) {
+    return;
+  }
+
+  while (tsm_screen_sb_get_count(m_screen) > m_hot_scrollback) {
+    m_line_cells.clear();
+    if (tsm_screen_sb_pop(m_screen, StaticPopCell, static_cast<void*>(this)) == 1) {
+      // The view was at the top of libtsm's scrollback, so keep it where it is by
+      // showing the line from m_scrollback instead.
+      m_cold_offset++;
+      m_age = 0;
+    }
+
+    m_scrollback.Push(m_line_cells.data(), m_line_cells.size(), m_screen->def_attr);
+  }
+
+  m_cold_offset = std::min(m_cold_offset, m_scrollback.size());
+}
+
+void Terminal::StaticPopCell(tsm_screen *screen, const uint32 *chars, size_t len,
+                             const tsm_screen_attr *tattr, void *data) {
+  Terminal *term = static_cast<Terminal*>(data);
+
+  // Only the first codepoint of combined symbols is kept, like CellChar does.
+  char32_t c = len != 0 ? chars[0] : 0;
+  term->m_line_cells.push_back(ScrollbackCell{c, *tattr});
+}
+
+void Terminal::ResetScrollback() {
+  if (m_cold_offset != 0) {
+    m_cold_offset = 0;
+    m_age = 0;
+    m_has_updated = true;
+  }
+
+  // libtsm goes back to the bottom of its own scrollback on input too, which only
+  // changes anything if the view wasn't there already.
+  if (tsm_screen_sb_is_scrolled(m_screen)) {
+    m_has_updated = true;
+  }
+}
+
+void Terminal::StartSearch() {
+  m_searching = true;
+  m_has_match = false;
+  m_search_query.Set("");
+  m_search_chars.clear();
+}
+
+void Terminal::EndSearch() {
+  m_searching = false;
+  m_has_match = false;
+  m_hot_lines.clear();
+
+  // Get rid of the highlights.
+  m_age = 0;
+  m_has_updated = true;
+}
+
+bool Terminal::SetSearchQuery(const string &query) {
+  m_search_query.Set(query);
+  m_search_chars.clear();
+  utf8::utf8to32(m_search_query.text().begin(), m_search_query.text().end(),
+                 std::back_inserter(m_search_chars));
+  m_has_updated = true;
+
+  if (m_search_query.empty()) {
+    m_has_match = false;
+    return false;
+  }
+
+  CollectHotLines();
+  size_t size = m_scrollback.size() + m_hot_lines.size();
+  uint64_t dropped = m_scrollback.dropped();
+
+  SearchMatch match;
+  bool found;
+
+  if (m_has_match && m_match.line >= dropped && m_match.line - dropped < size) {
+    // Stay on the current match if it still matches, otherwise move up from it (or
+    // down, if there's nothing above).
+    size_t line = m_match.line - dropped;
+    found = FindMatch(line, m_match.begin + 1, ScrollDirection::kUp, false, &match) ||
+            FindMatch(line, m_match.begin, ScrollDirection::kDown, false, &match);
+  } else {
+    found = size != 0 && FindMatch(size - 1, 0, ScrollDirection::kUp, true, &match);
+  }
+
+  m_has_match = found;
+  if (found) {
+    m_match = match;
+    ScrollToMatch();
+  }
+
+  return found;
+}
+
+bool Terminal::SearchNext(ScrollDirection direction) {
+  if (m_search_query.empty()) {
+    return false;
+  }
+
+  CollectHotLines();
+  size_t size = m_scrollback.size() + m_hot_lines.size();
+  uint64_t dropped = m_scrollback.dropped();
+
+  SearchMatch match;
+  bool found;
+
+  if (m_has_match && m_match.line >= dropped && m_match.line - dropped < size) {
+    found = FindMatch(m_match.line - dropped, m_match.begin, direction, false, &match);
+  } else {
+    found = size != 0 && FindMatch(size - 1, 0, ScrollDirection::kUp, true, &match);
+  }
+
+  if (found) {
+    m_has_match = true;
+    m_match = match;
+    ScrollToMatch();
+    m_has_updated = true;
+  }
+
+  return found;
+}
+
+size_t Terminal::HistoryTop() {
+  size_t cold = m_scrollback.size();
+  if (m_cold_offset != 0) {
+    return cold - m_cold_offset;
+  }
+
+  size_t index = 0;
+  for (line *line = m_screen->sb_first; line != nullptr && line != m_screen->sb_pos;
+       line = line->next) {
+    index++;
+  }
+
+  return cold + index;
+}
+
+void Terminal::CollectHotLines() {
+  m_hot_lines.clear();
+
+  for (line *line = m_screen->sb_first; line != nullptr; line = line->next) {
+    m_hot_lines.push_back(line);
+  }
+  for (uint y = 0; y < m_screen->size_y; y++) {
+    m_hot_lines.push_back(m_screen->lines[y]);
+  }
+}
+
+void Terminal::GetHistoryText(size_t line, const char **text, size_t *len) {
+  size_t cold = m_scrollback.size();
+  if (line < cold) {
+    m_scrollback.GetText(line, text, len);
+    return;
+  }
+
+  // Encode the same way as the scrollback does, so columns are found the same way.
+  const struct line *hot_line = m_hot_lines[line - cold];
+  m_line_text.clear();
+  auto out = std::back_inserter(m_line_text);
+  for (uint i = 0; i < hot_line->size; i++) {
+    out = utf8::unchecked::append(CellChar(m_screen, hot_line->cells[i]), out);
+  }
+
+  *text = m_line_text.data();
+  *len = m_line_text.size();
+}
+
+bool Terminal::FindMatch(size_t line, uint col, ScrollDirection direction,
+                         bool whole_line, SearchMatch *match) {
+  size_t cold = m_scrollback.size(), size = cold + m_hot_lines.size();
+  bool down = direction == ScrollDirection::kDown;
+
+  // Going up past line 0 wraps around to a huge value, which ends the loop as well.
+  while (line < size) {
+    if (line < cold) {
+      size_t begin, end;
+      uint64_t id;
+      bool full;
+
+      if (!m_scrollback.MayMatch(line, m_search_query, &begin, &end, &id, &full)) {
+        line = down ? end : begin - 1;
+        whole_line = true;
+        continue;
+      }
+
+      if (whole_line && line == (down ? begin : end - 1)) {
+        // The whole block is going to be searched, so if nothing is found, it can be
+        // skipped while the query is being narrowed down.
+        for (; line >= begin && line < end; down ? line++ : line--) {
+          if (FindMatchInLine(line, col, direction, true, match)) {
+            return true;
+          }
+        }
+
+        if (full) {
+          m_search_query.Exclude(id);
+        }
+        continue;
+      }
+    }
+
+    if (FindMatchInLine(line, col, direction, whole_line, match)) {
+      return true;
+    }
+
+    whole_line = true;
+    down ? line++ : line--;
+  }
+
+  return false;
+}
+
+bool Terminal::FindMatchInLine(size_t line, uint col, ScrollDirection direction,
+                               bool whole_line, SearchMatch *match) {
+  const char *text;
+  size_t len;
+  GetHistoryText(line, &text, &len);
+
+  bool down = direction == ScrollDirection::kDown, found = false;
+  size_t offset = 0;
+  uint offset_col = 0;
+
+  for (size_t pos = m_search_query.Find(text, len, 0); pos != string::npos;
+       pos = m_search_query.Find(text, len, pos + 1)) {
+    offset_col += utf8::unchecked::distance(text + offset, text + pos);
+    offset = pos;
+
+    if (down) {
+      if (whole_line || offset_col > col) {
+        match->begin = offset_col;
+        found = true;
+        break;
+      }
+    } else {
+      if (!whole_line && offset_col >= col) {
+        break;
+      }
+
+      // Keep going, the last one before col is the closest.
+      match->begin = offset_col;
+      found = true;
+    }
+  }
+
+  if (found) {
+    match->line = m_scrollback.dropped() + line;
+    match->end = match->begin + m_search_query.length();
+  }
+
+  return found;
+}
+
+void Terminal::ScrollToMatch() {
+  size_t line = m_match.line - m_scrollback.dropped();
+  size_t top = HistoryTop(), rows = m_screen->size_y;
+  if (line >= top && line < top + rows) {
+    return;
+  }
+
+  // Put the match in the middle of the screen, as far as possible.
+  size_t cold = m_scrollback.size(), bottom = cold + m_screen->sb_count;
+  size_t target = std::min(line - std::min(line, rows / 2), bottom);
+
+  tsm_screen_sb_reset(m_screen);
+  if (target < cold) {
+    m_cold_offset = cold - target;
+    tsm_screen_sb_up(m_screen, m_screen->sb_count);
+  } else {
+    m_cold_offset = 0;
+    tsm_screen_sb_up(m_screen, bottom - target);
+  }
+
+  m_age = 0;
   m_has_updated = true;
 }
 
@@ -117,15 +549,7 @@ bool Terminal::WriteKeysymToPty(uint32 keysym, int mods) {
     return true;
   } else if (keysym == XKB_KEY_V && mods & KeyboardModifier::kControl) {
     // Paste.
-    auto u8 = m_paste_cb();
-    u32string u32;
-    utf8::utf8to32(u8.begin(), u8.end(), std::back_inserter(u32));
-
-    for (auto c : u32) {
-      WriteUnicodeToPty(c);
-    }
-
-    m_has_updated = true;
+    Paste(m_paste_cb());
     return true;
   } else if (keysym == XKB_KEY_Up && mods & KeyboardModifier::kShift) {
     Scroll(ScrollDirection::kUp, 1);
@@ -134,23 +558,146 @@ bool Terminal::WriteKeysymToPty(uint32 keysym, int mods) {
     Scroll(ScrollDirection::kDown, 1);
     return true;
   } else {
-    m_has_updated = true;
+    // libtsm jumps back to the bottom on input, so this has to as well. Anything the
+    // key changes on screen is echoed back through WriteToScreen.
+    ResetScrollback();
     return tsm_vte_handle_keyboard(m_vte, keysym, keysym, mods, TSM_VTE_INVALID);
   }
 }
 
 bool Terminal::WriteUnicodeToPty(uint32 code) {
-  m_has_updated = true;
+  ResetScrollback();
   return tsm_vte_handle_keyboard(m_vte, XKB_KEY_NoSymbol, XKB_KEY_NoSymbol, 0, code);
 }
 
+void Terminal::Paste(const string &text) {
+  static const string kPasteBegin{"\x1b[200~"}, kPasteEnd{"\x1b[201~"};
+
+  bool bracketed = m_modes.bracketed_paste();
+
+  string data;
+  data.reserve(text.size() + kPasteBegin.size() + kPasteEnd.size());
+  if (bracketed) {
+    data += kPasteBegin;
+  }
+
+  // Newlines are sent as carriage returns, like the Enter key would.
+  for (size_t i = 0; i < text.size(); i++) {
+    if (text[i] == '\r' && i + 1 < text.size() && text[i + 1] == '\n') {
+      continue;
+    }
+
+    // Don't let the pasted text end the paste early. Removing just the end sequence
+    // could put together another one from what's around it, so every ESC goes.
+    if (bracketed && text[i] == '\x1b') {
+      continue;
+    }
+
+    data.push_back(text[i] == '\n' ? '\r' : text[i]);
+  }
+
+  if (bracketed) {
+    data += kPasteEnd;
+  }
+
+  ResetScrollback();
+
+  if (m_pty != nullptr) {
+    if (auto err = m_pty->Write(data)) {
+      err.Extend("while pasting").Print();
+    }
+  }
+}
+
 void Terminal::Draw() {
   if (!m_has_updated) {
     return;
   }
 
+  ScopedTimer timer{Stage::kTermDraw};
+
+  if (m_searching) {
+    // Matches can appear and disappear anywhere, so just draw everything again.
+    m_age = 0;
+  }
+
+  bool full_redraw = m_age == 0;
   m_age = tsm_screen_draw(m_screen, StaticDraw, static_cast<void*>(this));
   m_has_updated = false;
+
+  if (full_redraw && m_cold_offset != 0) {
+    DrawColdRows();
+  }
+
+  if (m_searching && !m_search_chars.empty()) {
+    HighlightMatches();
+  }
+
+  for (uint row = 0; row < m_changed_rows.size(); row++) {
+    RowRange &range = m_changed_rows[row];
+    if (range.begin >= range.end) {
+      continue;
+    }
+
+    m_draw_cb(row, range.begin, range.end, &m_cells[row * m_cols + range.begin]);
+    range = RowRange{std::numeric_limits<uint>::max(), 0};
+  }
+}
+
+void Terminal::DrawColdRows() {
+  size_t rows = std::min(m_cold_offset, m_changed_rows.size());
+  size_t first_line = m_scrollback.size() - m_cold_offset;
+
+  for (size_t row = 0; row < rows; row++) {
+    m_scrollback.Get(first_line + row, &m_line_cells);
+
+    for (uint x = 0; x < m_cols; x++) {
+      Cell &cell = m_cells[row * m_cols + x];
+
+      if (x < m_line_cells.size()) {
+        char32_t c = m_line_cells[x].c;
+        cell.c = c != 0 ? c : ' ';
+        ConvertAttr(&m_line_cells[x].attr, &cell.attr);
+      } else {
+        cell.c = ' ';
+        ConvertAttr(&m_screen->def_attr, &cell.attr);
+      }
+    }
+
+    m_changed_rows[row] = RowRange{0, m_cols};
+  }
+}
+
+void Terminal::HighlightMatches() {
+  size_t top = HistoryTop(), length = m_search_chars.size();
+  uint64_t dropped = m_scrollback.dropped();
+
+  for (uint row = 0; row < m_changed_rows.size(); row++) {
+    Cell *cells = &m_cells[row * m_cols];
+
+    for (uint x = 0; x + length <= m_cols; x++) {
+      bool equal = true;
+      for (size_t i = 0; i < length && equal; i++) {
+        char32_t c = cells[x + i].c;
+        equal = (c < 0x80 ? absl::ascii_tolower(c) : c) == m_search_chars[i];
+      }
+
+      if (!equal) {
+        continue;
+      }
+
+      bool current = m_has_match && m_match.line == dropped + top + row &&
+                     m_match.begin == x;
+      for (size_t i = 0; i < length; i++) {
+        Attr &attr = cells[x + i].attr;
+        attr.foreground = (*m_theme)[Colors::kBlack];
+        attr.background = (*m_theme)[current ? Colors::kCyan : Colors::kYellow];
+        attr.flags &= ~Attr::kInverse;
+      }
+
+      m_changed_rows[row] = RowRange{0, m_cols};
+    }
+  }
 }
 
 static SkColor TsmAttrColorCodeToSkColor(const Theme& theme, int code, bool bold) {
@@ -160,62 +707,75 @@ static SkColor TsmAttrColorCodeToSkColor(const Theme& theme, int code, bool bold
   return theme[std::min(code, Colors::kMax)];
 }
 
-int Terminal::StaticDraw(tsm_screen *screen, uint32 id, const uint32 *chars, size_t len,
-                         uint width, uint posx, uint posy, const tsm_screen_attr *tattr,
-                         tsm_age_t age, void *data) {
-  Terminal *term = static_cast<Terminal*>(data);
-
-  if (term->m_age != 0 && age != 0 && age <= term->m_age) {
-    return 0;
+void Terminal::ConvertAttr(const tsm_screen_attr *tattr, Attr *attr) {
+  if (m_has_last_attr && memcmp(tattr, &m_last_tattr, sizeof(*tattr)) == 0) {
+    *attr = m_last_attr;
+    return;
   }
 
-  u32string utf32(len, '\0');
-  std::copy(chars, chars + len, utf32.begin());
-
-  Pos pos{posx, posy};
-
-  Attr attr;
-
   if (tattr->fccode >= 0) {
-    attr.foreground = TsmAttrColorCodeToSkColor(*term->m_theme, tattr->fccode,
-                                                tattr->bold);
+    attr->foreground = TsmAttrColorCodeToSkColor(*m_theme, tattr->fccode, tattr->bold);
   } else {
-    attr.foreground = SkColorSetRGB(tattr->fr, tattr->fg, tattr->fb);
+    attr->foreground = SkColorSetRGB(tattr->fr, tattr->fg, tattr->fb);
   }
   if (tattr->bccode >= 0) {
-    attr.background = TsmAttrColorCodeToSkColor(*term->m_theme, tattr->bccode,
-                                                tattr->bold);
+    attr->background = TsmAttrColorCodeToSkColor(*m_theme, tattr->bccode, tattr->bold);
   } else {
-    attr.background = SkColorSetRGB(tattr->br, tattr->bg, tattr->bb);
+    attr->background = SkColorSetRGB(tattr->br, tattr->bg, tattr->bb);
   }
 
-  attr.flags = 0;
+  attr->flags = 0;
   if (tattr->bold) {
-    attr.flags |= Attr::kBold;
+    attr->flags |= Attr::kBold;
   }
   if (tattr->italic) {
-    attr.flags |= Attr::kItalic;
+    attr->flags |= Attr::kItalic;
   }
   if (tattr->underline) {
-    attr.flags |= Attr::kUnderline;
+    attr->flags |= Attr::kUnderline;
   }
   if (tattr->inverse) {
-    attr.flags |= Attr::kInverse;
+    attr->flags |= Attr::kInverse;
   }
   if (tattr->protect) {
-    attr.flags |= Attr::kProtect;
+    attr->flags |= Attr::kProtect;
   }
 
-  term->m_draw_cb(utf32, pos, attr, width);
+  m_last_tattr = *tattr;
+  m_last_attr = *attr;
+  m_has_last_attr = true;
+}
+
+int Terminal::StaticDraw(tsm_screen *screen, uint32 id, const uint32 *chars, size_t len,
+                         uint width, uint posx, uint posy, const tsm_screen_attr *tattr,
+                         tsm_age_t age, void *data) {
+  Terminal *term = static_cast<Terminal*>(data);
+
+  if (term->m_age != 0 && age != 0 && age <= term->m_age) {
+    return 0;
+  }
+
+  // libtsm's view is pushed down by the rows shown from the compact scrollback.
+  posy += term->m_cold_offset;
+  if (posx >= term->m_cols || posy >= term->m_changed_rows.size()) {
+    return 0;
+  }
+
+  Cell &cell = term->m_cells[posy * term->m_cols + posx];
+  cell.c = len != 0 && chars[0] != 0 ? chars[0] : ' ';
+  term->ConvertAttr(tattr, &cell.attr);
+
+  RowRange &range = term->m_changed_rows[posy];
+  range.begin = std::min(range.begin, posx);
+  range.end = std::max(range.end, posx + 1);
   return 0;
 }
 
 void Terminal::StaticWrite(tsm_vte *vte, const char *u8, size_t len, void *data) {
   Terminal *term = static_cast<Terminal*>(data);
 
-  string text(u8, len);
   if (term->m_pty != nullptr) {
-    if (auto err = term->m_pty->Write(text)) {
+    if (auto err = term->m_pty->Write(u8, len)) {
       err.Extend("in StaticWrite").Print();
     }
   }
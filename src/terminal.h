@@ -4,11 +4,17 @@
 #include "error.h"
 #include "pty.h"
 #include "attrs.h"
+#include "scrollback.h"
+#include "mode_tracker.h"
 
 #include <functional>
+#include <vector>
 
 #include <libtsm.h>
 
+// A line of libtsm's screen or scrollback, from libtsm-int.h.
+struct line;
+
 namespace KeyboardModifier {
   constexpr int kShift = TSM_SHIFT_MASK,
                 kControl = TSM_CONTROL_MASK,
@@ -25,11 +31,21 @@ struct Pos {
 
 struct SelectionRange { Pos begin{0, 0}, end{0, 0}, origin{0, 0}; };
 
+// The contents of a single cell on the screen.
+struct Cell {
+  char32_t c;
+  Attr attr;
+
+  bool operator==(const Cell &rhs) const { return c == rhs.c && attr == rhs.attr; }
+};
+
 class Terminal {
 public:
   Terminal();
 
-  using DrawCb = std::function<void(const u32string&, Pos, Attr, int)>;
+  // Called once per changed row on every Draw, with the changed cells [begin, end) of
+  // that row. cells points to the first of them, and is only valid during the call.
+  using DrawCb = std::function<void(uint row, uint begin, uint end, const Cell *cells)>;
   using CopyCb = std::function<void(const string&)>;
   using PasteCb = std::function<string()>;
   using TitleCb = std::function<void(const string&)>;
@@ -48,17 +64,74 @@ public:
   void ResetSelection();
 
   void Scroll(ScrollDirection direction, uint distance);
+  // Sets the total number of lines of scrollback to keep.
+  void SetScrollbackSize(size_t lines);
+  const Scrollback & scrollback() const { return m_scrollback; }
+
+  // Incremental search through the scrollback and the screen. While searching, the
+  // matches on screen are highlighted.
+  void StartSearch();
+  void EndSearch();
+  bool searching() const { return m_searching; }
+  // Sets the text to search for, and jumps to the closest match at or above the current
+  // one (or above the bottom, if there's none yet). Returns whether anything matched.
+  bool SetSearchQuery(const string &query);
+  // Jumps to the next match above (kUp) or below (kDown) the current one. Returns
+  // whether there was one.
+  bool SearchNext(ScrollDirection direction);
 
   const Attr & default_attr() { return m_default_attr; }
+  // Whether anything changed since the last call to Draw.
+  bool has_updated() { return m_has_updated; }
   Error Resize(int x, int y);
-  void WriteToScreen(string text);
+  void WriteToScreen(const char *text, size_t len);
   bool WriteKeysymToPty(uint32 keysym, int mods);
   bool WriteUnicodeToPty(uint32 code);
+  // Sends pasted text to the pty all at once, wrapped in bracketed paste markers if
+  // the application asked for them.
+  void Paste(const string &text);
   void Draw();
 private:
   static int StaticDraw(tsm_screen *screen, uint32 id, const uint32 *chars, size_t len,
                         uint width, uint posx, uint posy, const tsm_screen_attr *tattr,
                         tsm_age_t age, void *data);
+  void ConvertAttr(const tsm_screen_attr *tattr, Attr *attr);
+  static void StaticPopCell(tsm_screen *screen, const uint32 *chars, size_t len,
+                            const tsm_screen_attr *tattr, void *data);
+  // Returns the end of the longest prefix of [text, end) that can't scroll more than
+  // kMaxLinesPerInput lines into libtsm's scrollback (but at least one byte).
+  const char *ScrollChunkEnd(const char *text, const char *end);
+  // Moves the lines past the hot window from libtsm's scrollback into m_scrollback.
+  void MigrateScrollback();
+  // Fills the rows above libtsm's view from m_scrollback.
+  void DrawColdRows();
+  // Returns to the bottom of the scrollback.
+  void ResetScrollback();
+
+  // A search match. line is a history line number (see below) plus
+  // m_scrollback.dropped(), so it stays valid while lines are dropped.
+  struct SearchMatch {
+    uint64_t line;
+    uint begin, end;
+  };
+
+  // The history is numbered from the oldest line of m_scrollback, through libtsm's
+  // scrollback, to the last row of the screen.
+  size_t HistoryTop();
+  void CollectHotLines();
+  void GetHistoryText(size_t line, const char **text, size_t *len);
+  // Searches for the first match starting at the given history line in the given
+  // direction. On the first line, only matches starting after col (when going down) or
+  // before it (when going up) count, unless whole_line is true.
+  bool FindMatch(size_t line, uint col, ScrollDirection direction, bool whole_line,
+                 SearchMatch *match);
+  bool FindMatchInLine(size_t line, uint col, ScrollDirection direction,
+                       bool whole_line, SearchMatch *match);
+  // Scrolls to the current match, if it isn't visible already.
+  void ScrollToMatch();
+  // Colors the matches in the drawn rows.
+  void HighlightMatches();
+
   static void StaticWrite(tsm_vte *vte, const char *u8, size_t len, void *data);
   static void StaticOsc(tsm_vte *vte, const char *u8, size_t len, void *data);
 
@@ -77,5 +150,40 @@ private:
   bool m_has_updated{false};
   int m_age{0};
   Attr m_default_attr;
-  Pty *m_pty;
+  Pty *m_pty{nullptr};
+  ModeTracker m_modes;
+
+  // tsm_screen_draw reports cells one at a time; they're collected here and handed to
+  // the draw callback a row at a time. Both are preallocated on resize.
+  struct RowRange { uint begin, end; };
+  uint m_cols{0};
+  std::vector<Cell> m_cells;
+  std::vector<RowRange> m_changed_rows;
+
+  // libtsm keeps the most recent kHotScrollback lines of scrollback itself, and older
+  // lines are moved to m_scrollback. libtsm's limit is a bit higher, since lines can
+  // only be moved in between calls to tsm_vte_input; WriteToScreen splits its input so
+  // that each call adds at most kMaxLinesPerInput lines (see ScrollChunkEnd).
+  static constexpr size_t kHotScrollback = 1000, kMaxLinesPerInput = 1024;
+  size_t m_hot_scrollback{kHotScrollback};
+  Scrollback m_scrollback{0};
+  // How many lines of m_scrollback are shown above libtsm's view (which is then at the
+  // top of its own scrollback).
+  size_t m_cold_offset{0};
+  std::vector<ScrollbackCell> m_line_cells;
+
+  bool m_searching{false};
+  SearchQuery m_search_query;
+  // The query decoded, for matching against cells.
+  u32string m_search_chars;
+  bool m_has_match{false};
+  SearchMatch m_match;
+  // libtsm's scrollback and screen lines, collected at the start of a search.
+  std::vector<line*> m_hot_lines;
+  string m_line_text;
+
+  // Neighboring cells usually share attributes, so the last conversion is remembered.
+  tsm_screen_attr m_last_tattr;
+  Attr m_last_attr;
+  bool m_has_last_attr{false};
 };
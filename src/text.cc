@@ -1,6 +1,7 @@
 #include "text.h"
+#include "stats.h"
 
-#include <SkPath.h>
+#include <absl/memory/memory.h>
 
 FontStyle AttrsToFontStyle(Attr attrs) {
   if (attrs.flags & Attr::kBold) {
@@ -12,7 +13,9 @@ FontStyle AttrsToFontStyle(Attr attrs) {
   }
 }
 
-GlyphRenderer::GlyphRenderer() {
+constexpr SkGlyphID GlyphRenderer::kNoGlyph;
+
+Font::Font(string name, int size): m_name{name}, m_size{size} {
   for (auto &styled_font : m_styled_fonts) {
     SkPaint &paint = styled_font.paint;
 
@@ -24,11 +27,14 @@ GlyphRenderer::GlyphRenderer() {
   }
 }
 
-void GlyphRenderer::Resize(int size) {
-  m_glyphs.resize(size);
+void Font::Load() {
+  std::call_once(m_loaded, [this]() {
+    SetFont(m_name);
+    SetTextSize(m_size);
+  });
 }
 
-void GlyphRenderer::SetTextSize(int height) {
+void Font::SetTextSize(int height) {
   for (auto &styled_font : m_styled_fonts) {
     styled_font.paint.setTextSize(SkIntToScalar(height));
   }
@@ -36,7 +42,7 @@ void GlyphRenderer::SetTextSize(int height) {
   UpdateForFontChange();
 }
 
-void GlyphRenderer::SetFont(string name) {
+void Font::SetFont(string name) {
   SkFontStyle styles[] = {
     SkFontStyle::Normal(),
     SkFontStyle::Bold(),
@@ -51,32 +57,28 @@ void GlyphRenderer::SetFont(string name) {
   UpdateForFontChange();
 }
 
-bool GlyphRenderer::UpdateGlyph(char32_t c, int index, FontStyle style) {
-  auto &styled_font = m_styled_fonts[FontStyleToInt(style)];
-
-  if (c < kCharMax) {
-    auto glyph = styled_font.glyph_cache[c];
-    if (glyph) {
-      m_glyphs[index] = glyph;
-      return true;
-    }
-  }
-
-  styled_font.paint.setTextEncoding(SkPaint::kUTF32_TextEncoding);
-  styled_font.paint.textToGlyphs(&c, sizeof(c), &m_glyphs[index]);
-  return m_glyphs[index] != 0;
+SkGlyphID Font::LookupGlyph(char32_t c, FontStyle style) {
+  Load();
+  return FindGlyph(c, style);
 }
 
-void GlyphRenderer::ClearGlyph(int index) {
-  m_glyphs[index] = m_styled_fonts[kStyleNormal].glyph_cache[' '];
+SkGlyphID Font::FindGlyph(char32_t c, FontStyle style) {
+  auto &paint = m_styled_fonts[FontStyleToInt(style)].paint;
+
+  SkGlyphID glyph;
+  paint.setTextEncoding(SkPaint::kUTF32_TextEncoding);
+  paint.textToGlyphs(&c, sizeof(c), &glyph);
+  return glyph;
 }
 
-int GlyphRenderer::GetHeight() {
+int Font::GetHeight() {
+  Load();
   return m_styled_fonts[kStyleNormal].paint.getTextSize() +
          m_styled_fonts[kStyleNormal].metrics.fBottom;
 }
 
-int GlyphRenderer::GetWidth() {
+int Font::GetWidth() {
+  Load();
   auto &styled_font = m_styled_fonts[kStyleNormal];
 
   if (styled_font.metrics.fAvgCharWidth) {
@@ -90,31 +92,72 @@ int GlyphRenderer::GetWidth() {
   return bounds.width();
 }
 
-int GlyphRenderer::GetBaselineOffset() {
+int Font::GetBaselineOffset() {
+  Load();
   return m_styled_fonts[kStyleNormal].metrics.fBottom;
 }
 
-void GlyphRenderer::DrawRange(SkCanvas *canvas, SkPoint *positions, Attr attrs,
-                              size_t begin, size_t end, bool is_primary) {
-  auto style = AttrsToFontStyle(attrs);
-  auto &styled_font = m_styled_fonts[FontStyleToInt(style)];
+void Font::UpdateForFontChange() {
+  for (int i = 0; i < kStyleEnd; i++) {
+    auto &styled_font = m_styled_fonts[i];
+    styled_font.paint.getFontMetrics(&styled_font.metrics);
+    styled_font.space_glyph = FindGlyph(' ', static_cast<FontStyle>(i));
+  }
+}
+
+GlyphRenderer::GlyphRenderer(Font *font): m_font{font} {}
+
+void GlyphRenderer::Resize(int size) {
+  m_glyphs.resize(size, kNoGlyph);
+}
 
-  auto &paint = styled_font.paint;
-  auto &metrics = styled_font.metrics;
+void GlyphRenderer::SetGlyph(int index, SkGlyphID glyph) {
+  m_glyphs[index] = glyph;
+}
+
+void GlyphRenderer::ClearGlyph(int index) {
+  m_glyphs[index] = kNoGlyph;
+}
+
+void GlyphRenderer::AddRange(PaintBatch *batch, SkPoint *positions, Attr attrs,
+                             size_t begin, size_t end, bool is_primary) {
+  auto style = AttrsToFontStyle(attrs);
   SkColor color = attrs.flags & Attr::kInverse ? attrs.background : attrs.foreground;
 
-  paint.setTextEncoding(SkPaint::kGlyphID_TextEncoding);
-  paint.setColor(color);
-  canvas->drawPosText(m_glyphs.data() + begin, (end - begin) * sizeof(m_glyphs[0]),
-                      positions + begin, paint);
+  // Cells drawn by another renderer, and spaces, don't need to be in the run at all.
+  // If this renderer has nothing to draw, its font might not even be loaded.
+  SkGlyphID space_glyph = m_font->space_glyph(style);
+  auto is_blank = [&](SkGlyphID glyph) {
+    return glyph == kNoGlyph || glyph == space_glyph;
+  };
 
-  if (is_primary && attrs.flags & Attr::kUnderline) {
-    SkScalar last_y = positions[begin].y();
-    paint.setStyle(SkPaint::kStroke_Style);
+  int count = 0;
+  for (size_t i = begin; i < end; i++) {
+    if (!is_blank(m_glyphs[i])) {
+      count++;
+    }
+  }
+
+  if (count != 0) {
+    auto &paint = m_font->paint(style);
+    paint.setTextEncoding(SkPaint::kGlyphID_TextEncoding);
+    auto &run = batch->TextBuilder(color)->allocRunPos(paint, count);
+
+    int run_index = 0;
+    for (size_t i = begin; i < end; i++) {
+      if (!is_blank(m_glyphs[i])) {
+        run.glyphs[run_index] = m_glyphs[i];
+        run.pos[run_index * 2] = positions[i].x();
+        run.pos[run_index * 2 + 1] = positions[i].y();
+        run_index++;
+      }
+    }
+  }
 
+  if (is_primary && attrs.flags & Attr::kUnderline) {
     SkScalar y_offset = 0;
-    SkScalar stroke_width = SkIntToScalar(GetHeight()) / 15.0;
-    auto &metrics = styled_font.metrics;
+    SkScalar stroke_width = SkIntToScalar(m_font->GetHeight()) / 15.0;
+    auto &metrics = m_font->metrics(style);
 
     if (metrics.fFlags & SkPaint::FontMetrics::kUnderlinePositionIsValid_Flag) {
       y_offset = metrics.fUnderlinePosition;
@@ -124,51 +167,114 @@ void GlyphRenderer::DrawRange(SkCanvas *canvas, SkPoint *positions, Attr attrs,
       stroke_width = metrics.fUnderlineThickness;
     }
 
+    // One underline per row the range covers.
     for (size_t i = begin; i < end; ) {
+      SkScalar y = positions[i].y();
       SkScalar begin_x = positions[i].x();
-      while (positions[i].y() == last_y && i < end) {
+      while (i < end && positions[i].y() == y) {
         i++;
       }
-      SkScalar end_x = positions[i - 1].x() + GetWidth();
+      SkScalar end_x = positions[i - 1].x() + m_font->GetWidth();
+
+      batch->AddDecoration(SkRect::MakeLTRB(begin_x, y + y_offset - stroke_width / 2,
+                                            end_x, y + y_offset + stroke_width / 2),
+                           color);
+    }
+  }
+}
 
-      SkPath path;
-      path.moveTo(begin_x, last_y + y_offset);
-      path.lineTo(end_x, last_y + y_offset);
+GlyphCache::GlyphCache(size_t capacity): m_capacity{capacity} {}
 
-      paint.setStrokeWidth(stroke_width);
-      canvas->drawPath(path, paint);
+bool GlyphCache::Lookup(char32_t c, Entry *entry) {
+  auto it = m_entries.find(c);
+  if (it == m_entries.end()) {
+    return false;
+  }
 
-      if (i < end) {
-        last_y = positions[i].y();
-        i++;
-      }
-    }
+  m_lru.splice(m_lru.begin(), m_lru, it->second);
+  *entry = it->second->second;
+  return true;
+}
 
-    paint.setStyle(SkPaint::kFill_Style);
+void GlyphCache::Insert(char32_t c, Entry entry) {
+  auto it = m_entries.find(c);
+  if (it != m_entries.end()) {
+    it->second->second = entry;
+    m_lru.splice(m_lru.begin(), m_lru, it->second);
+    return;
   }
+
+  if (m_entries.size() >= m_capacity) {
+    m_entries.erase(m_lru.back().first);
+    m_lru.pop_back();
+  }
+
+  m_lru.emplace_front(c, entry);
+  m_entries[c] = m_lru.begin();
 }
 
-void GlyphRenderer::UpdateForFontChange() {
-  for (auto &styled_font : m_styled_fonts) {
-    styled_font.paint.getFontMetrics(&styled_font.metrics);
+void GlyphCache::Clear() {
+  m_lru.clear();
+  m_entries.clear();
+}
+
+constexpr size_t FontSet::kGlyphCacheSize;
+
+FontSet::FontSet():
+  m_glyph_caches(FontStyleToInt(FontStyle::kEnd), GlyphCache{kGlyphCacheSize}) {}
+
+FontSet::~FontSet() {
+  if (m_preload_thread.joinable()) {
+    m_preload_thread.join();
   }
+}
 
-  for (auto &styled_font : m_styled_fonts) {
-    SkPaint &paint = styled_font.paint;
-    auto &glyph_cache = styled_font.glyph_cache;
+void FontSet::Add(string name, int size) {
+  m_fonts.push_back(absl::make_unique<Font>(name, size));
 
-    paint.setTextEncoding(SkPaint::kUTF8_TextEncoding);
+  // The new font might have glyphs that previously came from a fallback (or weren't
+  // found at all).
+  for (auto &cache : m_glyph_caches) {
+    cache.Clear();
+  }
+}
 
-    for (char c = 0; c < kCharMax; c++) {
-      if (isprint(c)) {
-        SkGlyphID glyph;
-        paint.textToGlyphs(&c, sizeof(c), &glyph);
-        if (glyph) {
-          glyph_cache[c] = glyph;
-        }
-      }
+void FontSet::Preload() {
+  assert(!m_fonts.empty() && !m_preload_thread.joinable());
+
+  Font *font = m_fonts[0].get();
+  m_preload_thread = std::thread{[font]() {
+    font->Load();
+    gStats.Mark(Milestone::kFontLoaded);
+  }};
+}
+
+GlyphCache::Entry FontSet::Resolve(char32_t c, FontStyle style) {
+  auto &cache = m_glyph_caches[FontStyleToInt(style)];
+  GlyphCache::Entry entry;
+  if (cache.Lookup(c, &entry)) {
+    return entry;
+  }
+
+  entry = GlyphCache::Entry{-1, 0};
+  for (int i = 0; i < m_fonts.size(); i++) {
+    SkGlyphID glyph = m_fonts[i]->LookupGlyph(c, style);
+    if (glyph != 0) {
+      entry = GlyphCache::Entry{i, glyph};
+      break;
     }
   }
+
+  cache.Insert(c, entry);
+  return entry;
+}
+
+sk_sp<SkTypeface> FontSet::OverlayTypeface() {
+  if (m_overlay_typeface == nullptr) {
+    m_overlay_typeface = SkTypeface::MakeFromName("monospace", SkFontStyle::Normal());
+  }
+
+  return m_overlay_typeface;
 }
 
 TextManager::TextManager() {}
@@ -207,8 +313,8 @@ void TextManager::UpdatePositions(int height, int width) {
   }
 }
 
-void TextManager::DrawRangeWithRenderer(SkCanvas *canvas, GlyphRenderer *renderer,
-                                        Attr attrs, size_t begin, size_t end,
-                                        bool is_primary) {
-  renderer->DrawRange(canvas, m_positions.data(), attrs, begin, end, is_primary);
+void TextManager::AddRangeWithRenderer(PaintBatch *batch, GlyphRenderer *renderer,
+                                       Attr attrs, size_t begin, size_t end,
+                                       bool is_primary) {
+  renderer->AddRange(batch, m_positions.data(), attrs, begin, end, is_primary);
 }
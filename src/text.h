@@ -4,40 +4,66 @@
 #include <SkCanvas.h>
 #include <SkPaint.h>
 
+#include <sparsepp/spp.h>
+
 #include <array>
 #include <limits>
+#include <list>
+#include <memory>
+#include <mutex>
+#include <thread>
 
 #include "base.h"
 #include "terminal.h"
+#include "paint_batch.h"
 
 enum class FontStyle { kNormal, kBold, kItalic, kEnd };
 constexpr int FontStyleToInt(FontStyle style) { return static_cast<int>(style); }
 
 FontStyle AttrsToFontStyle(Attr attrs);
 
-// A GlyphRenderer knows little about its textual contents. Its sole goal is to store
-// glyphs in a horizontal array, and then render them using the given positions when
-// requested.
-class GlyphRenderer {
+// A Font is a typeface, in each FontStyle, at a given size. Loading one is slow (it
+// goes through fontconfig), so they live in a FontSet shared by every display, and are
+// only loaded once they're needed.
+class Font {
 public:
-  GlyphRenderer();
+  Font(string name, int size);
 
-  void Resize(int size);
-  void SetTextSize(int height);
-  void SetFont(string name);
-  bool UpdateGlyph(char32_t c, int index, FontStyle style);
-  void ClearGlyph(int index);
+  // Loads the typefaces, unless that was done already (possibly on another thread, in
+  // which case this waits for it). Everything below but space_glyph calls it first.
+  void Load();
+
+  // Returns the glyph for c in the given style, or 0 if the font doesn't have one.
+  SkGlyphID LookupGlyph(char32_t c, FontStyle style);
 
   int GetHeight();
   int GetWidth();
   int GetBaselineOffset();
 
-  void DrawRange(SkCanvas *canvas, SkPoint *positions, Attr attrs, size_t begin,
-                 size_t end, bool is_primary);
+  // The glyph for a space in the given style, or 0 if the font isn't loaded yet.
+  SkGlyphID space_glyph(FontStyle style) const {
+    return m_styled_fonts[FontStyleToInt(style)].space_glyph;
+  }
+  SkPaint & paint(FontStyle style) {
+    Load();
+    return m_styled_fonts[FontStyleToInt(style)].paint;
+  }
+  const SkPaint::FontMetrics & metrics(FontStyle style) {
+    Load();
+    return m_styled_fonts[FontStyleToInt(style)].metrics;
+  }
 private:
+  // LookupGlyph without loading the font first, for use while it's being loaded (Load
+  // can't be called again from there).
+  SkGlyphID FindGlyph(char32_t c, FontStyle style);
+  void SetTextSize(int height);
+  void SetFont(string name);
   void UpdateForFontChange();
 
-  static constexpr char kCharMax = std::numeric_limits<char>::max();
+  string m_name;
+  int m_size;
+  std::once_flag m_loaded;
+
   static constexpr int kStyleNormal = FontStyleToInt(FontStyle::kNormal),
                        kStyleEnd = FontStyleToInt(FontStyle::kEnd);
 
@@ -45,14 +71,100 @@ private:
     sk_sp<SkTypeface> font;
     SkPaint paint;
     SkPaint::FontMetrics metrics;
-    std::array<SkGlyphID, kCharMax> glyph_cache;
+    SkGlyphID space_glyph{0};
   };
 
   std::array<StyledFont, kStyleEnd> m_styled_fonts;
+};
+
+// A GlyphRenderer knows little about its textual contents. Its sole goal is to store
+// glyphs of its font in a horizontal array, and then render them using the given
+// positions when requested.
+class GlyphRenderer {
+public:
+  // Marks cells drawn by another renderer. Glyph IDs are below the number of glyphs in
+  // the font, which can't be more than this.
+  static constexpr SkGlyphID kNoGlyph = std::numeric_limits<SkGlyphID>::max();
+
+  explicit GlyphRenderer(Font *font);
+
+  void Resize(int size);
+  void SetGlyph(int index, SkGlyphID glyph);
+  void ClearGlyph(int index);
 
+  // Adds the glyphs (and decorations, if is_primary) in the given range to the batch.
+  void AddRange(PaintBatch *batch, SkPoint *positions, Attr attrs, size_t begin,
+                size_t end, bool is_primary);
+private:
+  Font *m_font;
   std::vector<SkGlyphID> m_glyphs;
 };
 
+// A GlyphCache remembers which renderer (and which glyph in it) a codepoint resolved to,
+// so the fallback chain only has to be walked once per codepoint. Once it's full, the
+// least recently used entries are evicted.
+class GlyphCache {
+public:
+  struct Entry {
+    // The index of the renderer the glyph was found in, or -1 if none of them had it.
+    int renderer;
+    SkGlyphID glyph;
+  };
+
+  explicit GlyphCache(size_t capacity);
+
+  // Sets *entry to the cached entry for c and returns true, or returns false if c isn't
+  // cached.
+  bool Lookup(char32_t c, Entry *entry);
+  void Insert(char32_t c, Entry entry);
+  void Clear();
+private:
+  using LruList = std::list<std::pair<char32_t, Entry>>;
+
+  size_t m_capacity;
+  // The most recently used entries are at the front.
+  LruList m_lru;
+  spp::sparse_hash_map<char32_t, LruList::iterator> m_entries;
+};
+
+// A FontSet is the chain of fonts glyphs are looked up in, in order, along with the
+// caches of where each codepoint was found. It's shared by all the displays in the
+// process, so fonts are only loaded (and the caches filled) once.
+class FontSet {
+public:
+  FontSet();
+  ~FontSet();
+
+  // Adds a font to the end of the chain. Fonts can only be added before any display
+  // using the set is created. Nothing is loaded yet: the first font is loaded once
+  // it's measured (or by Preload), and the others once a glyph isn't found in the ones
+  // before them.
+  void Add(string name, int size);
+  // Starts loading the first font on another thread, so it can happen while the window
+  // is being created and the shell is starting.
+  void Preload();
+
+  size_t size() const { return m_fonts.size(); }
+  Font & font(size_t index) { return *m_fonts[index]; }
+
+  // Returns the font (and the glyph in it) that draws c in the given style.
+  GlyphCache::Entry Resolve(char32_t c, FontStyle style);
+
+  // Returns the typeface for overlays, which is only loaded once one is shown.
+  sk_sp<SkTypeface> OverlayTypeface();
+private:
+  // Fonts are referenced by the displays' renderers, so they must never move.
+  std::vector<std::unique_ptr<Font>> m_fonts;
+
+  // One cache per FontStyle, mapping codepoints to the font that draws them.
+  static constexpr size_t kGlyphCacheSize = 4096;
+  std::vector<GlyphCache> m_glyph_caches;
+
+  sk_sp<SkTypeface> m_overlay_typeface;
+
+  std::thread m_preload_thread;
+};
+
 // A TextManager is the bridge between a terminal's contents and a GlyphRenderer. It
 // contains the text itself, as well as the text positions. When drawn, it hands down the
 // positions to the GlyphRenderer. Note that a GlyphRenderer does not know when a
@@ -72,8 +184,8 @@ public:
   uint PosToOffset(Pos pos) { return PosToOffset(pos.x, pos.y); }
   Pos OffsetToPos(uint offset) { return {offset % m_cols, offset / m_cols}; }
 
-  void DrawRangeWithRenderer(SkCanvas *canvas, GlyphRenderer *renderer, Attr attrs,
-                             size_t begin, size_t end, bool is_primary);
+  void AddRangeWithRenderer(PaintBatch *batch, GlyphRenderer *renderer, Attr attrs,
+                            size_t begin, size_t end, bool is_primary);
 private:
   uint m_cols{0}, m_rows{0};
   std::u32string m_text;
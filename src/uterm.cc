@@ -1,23 +1,41 @@
 #include "uterm.h"
+#include "stats.h"
 
+#include <absl/memory/memory.h>
+#include <utf8.h>
+
+#include <algorithm>
 #include <sys/wait.h>
 #include <signal.h>
 
 Uterm gUterm;
 
-void ProtectedBuffer::Append(string text) {
-  std::unique_lock<std::mutex> lock{m_lock};
-  m_buffer += text;
-}
-
-string ProtectedBuffer::ReadAndClear() {
-  std::unique_lock<std::mutex> lock{m_lock};
-  string result = m_buffer;
-  m_buffer.clear();
-  return result;
-}
-
-ReaderThread::ReaderThread(Pty *pty): m_thread{&ReaderThread::StaticRun, this, pty} {}
+// Output is parsed in slices of at most kParseSlice bytes, for at most kParseBudget
+// seconds per main loop iteration, so that huge bursts can't block input handling.
+constexpr size_t kParseSlice = 64 * 1024;
+constexpr double kParseBudget = 0.008;
+
+// Once more than kFastScrollBacklog bytes are waiting to be parsed, intermediate frames
+// are skipped, and the screen is only redrawn every kFastScrollInterval seconds until
+// parsing catches up.
+constexpr size_t kFastScrollBacklog = 256 * 1024;
+constexpr double kFastScrollInterval = 0.25;
+
+// Dragging a window's edge resizes it dozens of times a second. Until the size has
+// stayed the same for kResizeSettleTime seconds, the old contents are just shown
+// cropped (or padded), rather than laying out the display and making the shell redraw
+// for every step.
+constexpr double kResizeSettleTime = 0.1;
+
+constexpr size_t ReaderThread::kMinBufferSize;
+constexpr double Uterm::kStatsOverlayInterval;
+
+ReaderThread::ReaderThread(Pty *pty, size_t read_size, int read_latency,
+                           WakeCb wake_cb, CastWriter *recorder):
+  m_pty{pty}, m_read_size{read_size}, m_read_latency{read_latency}, m_wake_cb{wake_cb},
+  m_recorder{recorder},
+  m_buffer{std::max(kMinBufferSize, read_size * 4)},
+  m_thread{&ReaderThread::StaticRun, this} {}
 
 void ReaderThread::Interrupt() {
   pthread_kill(m_thread.native_handle(), SIGUSR1);
@@ -25,153 +43,626 @@ void ReaderThread::Interrupt() {
 
 void ReaderThread::Stop() {
   m_done_flag.set();
+  m_buffer.Close();
   Interrupt();
   m_thread.join();
 }
 
-void ReaderThread::StaticRun(Pty *pty) {
+void ReaderThread::HandleChildExit(int pid) {
+  if (m_pty->HandleExit(pid)) {
+    Interrupt();
+  }
+}
+
+void ReaderThread::StaticRun() {
   bool eof = false;
+
+  while (!m_done_flag.get()) {
+    // Once the child has exited, whatever it wrote beforehand still needs to be
+    // drained, but there's no point in waiting for more.
+    bool exited = m_pty->exited();
+
+    if (!exited) {
+      if (auto err = m_pty->Wait(&eof)) {
+        err.Extend("waiting for data from pty").Print();
+      }
+
+      // Writes are queued by the main thread, and written here whenever the pty has
+      // room, so that neither a slow child nor a flood of input can stall rendering.
+      if (auto err = m_pty->FlushWrites()) {
+        err.Extend("writing queued data to pty").Print();
+      }
+    }
+
+    bool wake = false;
+    size_t read = ReadBatch(&eof, &wake);
+    if (wake) {
+      m_wake_cb();
+    }
+
+    if (eof || (exited && read == 0)) {
+      m_done_flag.set();
+    }
+  }
+
+  m_wake_cb();
+}
+
+size_t ReaderThread::ReadBatch(bool *eof, bool *wake) {
+  auto deadline = std::chrono::steady_clock::now() + m_read_latency;
+  size_t total = 0;
+
   while (!m_done_flag.get()) {
-    if (auto e_text = pty->Read(&eof)) {
-      if (!e_text->empty()) {
-        m_buffer.Append(*e_text);
-        // Do a short (0.5ms) sleep to avoid high CPU usage because of short polls.
-        usleep(500);
-      } else if (eof) {
-        m_done_flag.set();
+    char *region;
+    size_t space = m_buffer.WriteRegion(&region);
+    if (space == 0) {
+      // Let the main thread know about what's already here before waiting for it.
+      if (*wake) {
+        m_wake_cb();
+        *wake = false;
+      }
+
+      if (!m_buffer.WaitForSpace()) {
+        break;
+      }
+      continue;
+    }
+
+    auto e_size = m_pty->Read(region, std::min(space, m_read_size), eof);
+    if (!e_size) {
+      e_size.Error().Extend("reading data from pty").Print();
+      break;
+    } else if (*e_size == 0) {
+      // Either the pty is empty, or it hit EOF.
+      break;
+    }
+
+    total += *e_size;
+
+    if (m_recorder->is_open()) {
+      if (auto err = m_recorder->WriteOutput(region, *e_size)) {
+        err.Extend("recording pty output").Print();
       }
-    } else {
-      e_text.Error().Extend("reading data from pty").Print();
+    }
+
+    // Only wake up the main thread if it's about to wait for more; otherwise, it's
+    // going to read the new data anyway.
+    if (m_buffer.CommitWrite(*e_size)) {
+      *wake = true;
+    }
+
+    if (std::chrono::steady_clock::now() >= deadline) {
+      break;
     }
   }
+
+  return total;
 }
 
-static void CatchSigchld(int sig) {
-  waitpid(-1, nullptr, WNOHANG);
-  gUterm.InterruptReader();
+// SIGCHLD is blocked in every thread and waited for here instead of in a handler, since
+// waking up the main loop isn't async-signal-safe.
+static void WaitForSigchld(sigset_t set) {
+  for (;;) {
+    int sig;
+    if (sigwait(&set, &sig) == 0) {
+      gUterm.RequestReap();
+      Window::Wake();
+    }
+  }
 }
 
-int Uterm::Run() {
-  using namespace std::placeholders;
+int Uterm::Run(const UtermOptions &options) {
+  string socket = options.socket.empty() ? DefaultSocketPath() : options.socket;
+
+  if (options.client) {
+    // If there's no server, the window is opened here instead.
+    if (!RequestWindow(socket)) {
+      return 0;
+    }
+  }
 
   if (auto err = m_config.Parse()) {
     err.Extend("while parsing config file").Print();
   }
 
-  constexpr int kWidth = 800, kHeight = 600;
+  // This has to happen before any threads are started, so that they inherit the mask.
+  sigset_t sigchld;
+  sigemptyset(&sigchld);
+  sigaddset(&sigchld, SIGCHLD);
+  pthread_sigmask(SIG_BLOCK, &sigchld, nullptr);
+  // The handler never runs, but with the default disposition, some systems discard
+  // SIGCHLD instead of leaving it pending.
+  signal(SIGCHLD, [](int sig) {});
 
-  signal(SIGCHLD, CatchSigchld);
   signal(SIGUSR1, [](int sig) {});
+  // The dump itself happens the next time the main loop wakes up.
+  signal(SIGUSR2, [](int sig) { gStats.RequestDump(); });
 
-  Pty pty;
-  if (auto err = pty.Spawn({m_config.shell(), "-i"})) {
-    err.Extend("while initializing pty").Print();
+  // Fonts are loaded once, and shared by every window. The first one loads in the
+  // background while the shell is spawned and the window created; the others only
+  // load if a glyph is missing from the ones before them.
+  for (auto &font : m_config.fonts()) {
+    m_fonts.Add(font.name, font.size);
+  }
+
+  m_fonts.Add("monospace", m_config.font_defaults_size());
+  m_fonts.Preload();
+
+  if (auto err = Window::InitializeGlfw()) {
+    err.Print();
     return 1;
   }
 
-  ReaderThread reader{&pty};
-  m_current_reader = &reader;
+  // Children that exit before this starts leave SIGCHLD pending, so none are missed.
+  std::thread{WaitForSigchld, sigchld}.detach();
 
-  if (auto err = m_window.Initialize(kWidth, kHeight, m_config.vsync(),
-                                     m_config.theme())) {
-    err.Extend("while initializing window").Print();
+  if (options.server) {
+    if (auto err = m_server.Listen(socket, Window::Wake)) {
+      err.Extend("while starting server").Print();
+      return 1;
+    }
+  } else if (auto err = OpenSession(options, "")) {
+    err.Print();
     return 1;
   }
 
+  // A server keeps running once its last window is closed, waiting for more requests.
+  while (options.server || !m_sessions.empty()) {
+    std::vector<WindowRequest> requests;
+    m_server.TakeRequests(&requests);
+    for (auto &request : requests) {
+      if (auto err = OpenSession(UtermOptions{}, request.cwd)) {
+        err.Extend("while opening a requested window").Print();
+      }
+    }
+
+    if (m_reap_requested.exchange(false)) {
+      ReapChildren();
+    }
+
+    if (gStats.TakeDumpRequest()) {
+      DumpStats();
+    }
+
+    // Block until either a reader, a client, or the user has something for us, or until
+    // a pending frame is due.
+    Window::WaitEvents(UpdateSessions());
+  }
+
+  m_server.Stop();
+
+  if (!m_config.stats_file().empty()) {
+    DumpStats();
+  }
+
+  Window::TerminateGlfw();
+  return 0;
+}
+
+void Uterm::ReapChildren() {
+  int pid;
+  while ((pid = waitpid(-1, nullptr, WNOHANG)) > 0) {
+    for (auto &session : m_sessions) {
+      session->HandleChildExit(pid);
+    }
+  }
+}
+
+Error Uterm::OpenSession(const UtermOptions &options, const string &cwd) {
+  auto session = absl::make_unique<Session>(m_config, &m_fonts);
+  if (auto err = session->Start(options, cwd)) {
+    return err.Extend("while opening window");
+  }
+
+  m_sessions.push_back(std::move(session));
+  return Error::New();
+}
+
+double Uterm::UpdateSessions() {
+  double current = glfwGetTime();
+
+  bool overlay = std::any_of(m_sessions.begin(), m_sessions.end(),
+                             [](const std::unique_ptr<Session> &session) {
+    return session->stats_overlay();
+  });
+
+  bool sample_overlay = false;
+  if (overlay && !m_sampling_stats) {
+    // Start from a fresh sample rather than one covering the time it was off.
+    gStats.Sample();
+    m_overlay_lines.clear();
+    m_next_overlay_sample = current + kStatsOverlayInterval;
+  } else if (overlay && current >= m_next_overlay_sample) {
+    m_overlay_lines = gStats.Sample();
+    m_next_overlay_sample = current + kStatsOverlayInterval;
+    sample_overlay = true;
+  }
+  m_sampling_stats = overlay;
+
+  double timeout = -1;
+  for (auto &session : m_sessions) {
+    double session_timeout = session->Update(m_overlay_lines, sample_overlay);
+    if (session_timeout >= 0) {
+      timeout = timeout < 0 ? session_timeout : std::min(timeout, session_timeout);
+    }
+  }
+
+  if (overlay) {
+    double until_sample = std::max(m_next_overlay_sample - glfwGetTime(), 0.0);
+    timeout = timeout < 0 ? until_sample : std::min(timeout, until_sample);
+  }
+
+  auto it = std::stable_partition(m_sessions.begin(), m_sessions.end(),
+                                  [](const std::unique_ptr<Session> &session) {
+    return !session->done();
+  });
+  bool closed = it != m_sessions.end();
+  m_sessions.erase(it, m_sessions.end());
+
+  // If the last window was just closed, the main loop has to find out before waiting.
+  return closed ? 0 : timeout;
+}
+
+void Uterm::DumpStats() {
+  if (auto err = gStats.Dump(m_config.stats_file())) {
+    err.Extend("while dumping stats").Print();
+  }
+}
+
+Session::Session(const Config &config, FontSet *fonts):
+  m_config{config}, m_display{&m_term, fonts} {}
+
+Session::~Session() {
+  if (m_reader != nullptr) {
+    m_reader->Stop();
+  }
+}
+
+Error Session::Start(const UtermOptions &options, const string &cwd) {
+  using namespace std::placeholders;
+
+  constexpr int kWidth = 800, kHeight = 600;
+
+  m_stats_overlay = m_config.stats_overlay();
+
+  bool replaying = !options.replay.empty();
+
+  Cast cast;
+  if (replaying) {
+    if (auto err = ReadCast(options.replay, &cast)) {
+      return err.Extend("while loading replay");
+    }
+  } else if (auto err = m_pty.Spawn({m_config.shell(), "-i"}, cwd)) {
+    return err.Extend("while initializing pty");
+  }
+
+  if (auto err = m_window.Initialize(kWidth, kHeight, m_config.vsync(), m_config.gpu(),
+                                     m_config.theme())) {
+    return err.Extend("while initializing window");
+  }
+
+  gStats.Mark(Milestone::kWindowCreated);
+
   m_term.set_theme(m_config.theme());
+  m_term.SetScrollbackSize(m_config.scrollback());
 
-  m_term.set_pty(&pty);
-  m_term.set_copy_cb(std::bind(&Uterm::HandleCopy, this, _1));
-  m_term.set_paste_cb(std::bind(&Uterm::HandlePaste, this));
-  m_term.set_title_cb(std::bind(&Uterm::HandleTitle, this, _1));
+  if (!replaying) {
+    m_term.set_pty(&m_pty);
+  }
+  m_term.set_copy_cb(std::bind(&Session::HandleCopy, this, _1));
+  m_term.set_paste_cb(std::bind(&Session::HandlePaste, this));
+  m_term.set_title_cb(std::bind(&Session::HandleTitle, this, _1));
 
-  for (auto &font : m_config.fonts()) {
-    m_display.AddFont(font.name, font.size);
+  ApplyResize(kWidth, kHeight);
+
+  if (!options.record.empty()) {
+    if (auto err = m_recorder.Open(options.record, m_display.cols(), m_display.rows())) {
+      return err.Extend("while starting recording");
+    }
   }
 
-  m_display.AddFont("monospace", m_config.font_defaults_size());
+  // The reader wakes up the main loop, so it can only be started once the window
+  // exists.
+  if (replaying) {
+    m_replay_events = std::move(cast.events);
+    m_replay_fast = options.replay_fast;
+    m_replay_start = glfwGetTime();
+  } else {
+    m_reader = absl::make_unique<ReaderThread>(
+      &m_pty, static_cast<size_t>(m_config.read_size()), m_config.read_latency(),
+      Window::Wake, &m_recorder);
+  }
 
-  HandleResize(kWidth, kHeight);
+  m_window.set_key_cb(std::bind(&Session::HandleKey, this, _1, _2));
+  m_window.set_char_cb(std::bind(&Session::HandleChar, this, _1));
+  m_window.set_resize_cb(std::bind(&Session::HandleResize, this, _1, _2));
+  m_window.set_surface_cb(std::bind(&Session::HandleSurfaceReset, this));
+  m_window.set_selection_cb(std::bind(&Session::HandleSelection, this, _1, _2, _3));
+  m_window.set_scroll_cb(std::bind(&Session::HandleScroll, this, _1, _2));
 
-  m_window.set_key_cb(std::bind(&Uterm::HandleKey, this, _1, _2));
-  m_window.set_char_cb(std::bind(&Uterm::HandleChar, this, _1));
-  m_window.set_resize_cb(std::bind(&Uterm::HandleResize, this, _1, _2));
-  m_window.set_selection_cb(std::bind(&Uterm::HandleSelection, this, _1, _2, _3));
-  m_window.set_scroll_cb(std::bind(&Uterm::HandleScroll, this, _1, _2));
+  return Error::New();
+}
+
+double Session::Update(const std::vector<string> &overlay_lines, bool sample_overlay) {
+  // Output is coalesced into at most one frame per frame interval, but anything the
+  // user does (e.g. a keystroke and its echo) is shown right away.
+  double frame_interval = 1.0 / std::max(m_config.fps(), 1);
 
-  double mark = 0;
-  double fps = m_config.fps();
-  int frames_current_second = 0;
+  if (m_has_pending_resize && glfwGetTime() >= m_resize_deadline) {
+    ApplyResize(m_pending_width, m_pending_height);
+  }
 
-  while (m_window.isopen() && !reader.done()) {
-    SkCanvas *canvas = m_window.canvas();
+  size_t backlog;
+  if (m_reader != nullptr) {
+    RingBuffer &buffer = m_reader->buffer();
+    ParseOutput(&buffer, glfwGetTime() + kParseBudget);
+    // Whatever arrives after this wakes the main loop up; whatever arrived before it
+    // (possibly while parsing) is a backlog.
+    backlog = buffer.PrepareToWait() ? 0 : buffer.size();
+  } else {
+    backlog = ReplayOutput(glfwGetTime() + kParseBudget);
+  }
 
-    double current = glfwGetTime();
-    if (current - 1 >= mark) {
-      frames_current_second = 0;
-      mark = glfwGetTime();
-    } else {
-      frames_current_second++;
-      double since_last_second = current - mark;
+  double current = glfwGetTime();
+  double timeout = -1;
 
-      int expected_frames = since_last_second * fps;
-      double expected_position = expected_frames / fps;
-      double actual_position = frames_current_second / fps;
+  sample_overlay = sample_overlay && m_stats_overlay;
 
-      if (actual_position > expected_position) {
-        usleep((actual_position - expected_position) * 1000000);
+  if (backlog >= kFastScrollBacklog &&
+      current < m_last_frame + kFastScrollInterval) {
+    // Fast scroll: don't bother rendering states that are about to be overwritten.
+  } else if (current >= m_next_frame || sample_overlay) {
+    m_term.Draw();
+
+    bool significant_redraw = m_display.Draw(m_window.canvas());
+    SkIRect damage = m_display.damage();
+    if (m_stats_overlay && (significant_redraw || sample_overlay)) {
+      damage.join(m_display.DrawOverlay(m_window.canvas(), overlay_lines));
+    }
+
+    m_window.Draw(damage);
+
+    if (significant_redraw) {
+      gStats.Mark(Milestone::kFirstFrame);
+      if (m_has_output) {
+        gStats.Mark(Milestone::kFirstOutput);
       }
+
+      gStats.Count(Counter::kFrames);
+      m_last_frame = current;
+      m_next_frame = current + frame_interval;
     }
+  } else if (m_term.has_updated()) {
+    timeout = m_next_frame - current;
+  }
 
-    string buffer = reader.buffer().ReadAndClear();
-    if (!buffer.empty()) {
-      m_term.WriteToScreen(buffer);
+  if (backlog != 0) {
+    // There's a backlog left to parse, so just handle whatever input is pending and
+    // get back to it.
+    timeout = 0;
+  } else if (m_reader == nullptr) {
+    double until_output = NextReplayOutput();
+    if (until_output >= 0) {
+      timeout = timeout < 0 ? until_output : std::min(timeout, until_output);
     }
+  }
 
-    m_term.Draw();
+  if (m_has_pending_resize) {
+    double until_resize = std::max(m_resize_deadline - glfwGetTime(), 0.0);
+    timeout = timeout < 0 ? until_resize : std::min(timeout, until_resize);
+  }
+
+  return timeout;
+}
+
+bool Session::done() {
+  // A replay keeps the window open once it's done, so the result can be looked at.
+  return !m_window.isopen() || (m_reader != nullptr && m_reader->done());
+}
 
-    bool significant_redraw = m_display.Draw(canvas);
-    m_window.DrawAndPoll(significant_redraw);
+void Session::HandleChildExit(int pid) {
+  if (m_reader != nullptr) {
+    m_reader->HandleChildExit(pid);
   }
+}
 
-  std::unique_lock<std::mutex> lock{m_current_reader_lock};
-  m_current_reader = nullptr;
-  reader.Stop();
+void Session::ParseOutput(RingBuffer *buffer, double deadline) {
+  // Only parse what's already there: if the reader keeps refilling the buffer, it
+  // would otherwise never be left.
+  for (size_t pending = buffer->size(); pending != 0; ) {
+    const char *data;
+    size_t size = std::min(std::min(buffer->ReadRegion(&data), pending), kParseSlice);
 
-  return 0;
+    m_term.WriteToScreen(data, size);
+    buffer->CommitRead(size);
+    pending -= size;
+    m_has_output = true;
+
+    if (glfwGetTime() >= deadline) {
+      break;
+    }
+  }
 }
 
-void Uterm::InterruptReader() {
-  std::unique_lock<std::mutex> lock{m_current_reader_lock};
+size_t Session::ReplayOutput(double deadline) {
+  double elapsed = glfwGetTime() - m_replay_start;
+
+  while (m_replay_index < m_replay_events.size() && glfwGetTime() < deadline) {
+    const CastEvent &event = m_replay_events[m_replay_index];
+    if (!m_replay_fast && event.time > elapsed) {
+      break;
+    }
+
+    // The window keeps its own size, so resizes are skipped.
+    if (event.type == "o") {
+      size_t size = std::min(event.data.size() - m_replay_offset, kParseSlice);
+      m_term.WriteToScreen(event.data.data() + m_replay_offset, size);
+      m_replay_offset += size;
+      m_has_output = true;
+    }
+
+    if (event.type != "o" || m_replay_offset == event.data.size()) {
+      m_replay_index++;
+      m_replay_offset = 0;
+    }
+  }
+
+  size_t backlog = 0;
+  for (size_t i = m_replay_index;
+       i < m_replay_events.size() && backlog < kFastScrollBacklog; i++) {
+    const CastEvent &event = m_replay_events[i];
+    if (!m_replay_fast && event.time > elapsed) {
+      break;
+    }
 
-  if (m_current_reader != nullptr) {
-    m_current_reader->Interrupt();
+    backlog += event.data.size() - (i == m_replay_index ? m_replay_offset : 0);
   }
+
+  return backlog;
+}
+
+double Session::NextReplayOutput() {
+  if (m_replay_index == m_replay_events.size()) {
+    return -1;
+  }
+
+  double elapsed = glfwGetTime() - m_replay_start;
+  return std::max(m_replay_events[m_replay_index].time - elapsed, 0.0);
 }
 
-void Uterm::HandleCopy(const string &str) {
+void Session::RequestImmediateFrame() {
+  m_next_frame = 0;
+}
+
+void Session::HandleCopy(const string &str) {
   m_window.ClipboardWrite(str);
 }
 
-string Uterm::HandlePaste() {
+string Session::HandlePaste() {
   return m_window.ClipboardRead();
 }
 
-void Uterm::HandleKey(uint32 keysym, int mods) {
-  m_term.WriteKeysymToPty(keysym, mods);
+void Session::HandleKey(uint32 keysym, int mods) {
+  RequestImmediateFrame();
+
+  if (m_term.searching()) {
+    HandleSearchKey(keysym, mods);
+  } else if (keysym == XKB_KEY_F && mods & KeyboardModifier::kControl &&
+             mods & KeyboardModifier::kShift) {
+    m_search_query.clear();
+    m_term.StartSearch();
+    UpdateSearch(true);
+  } else if (keysym == XKB_KEY_P && mods & KeyboardModifier::kControl &&
+             mods & KeyboardModifier::kShift) {
+    ToggleStatsOverlay();
+  } else {
+    m_term.WriteKeysymToPty(keysym, mods);
+  }
 }
 
-void Uterm::HandleChar(uint code) {
-  m_term.WriteUnicodeToPty(code);
+void Session::HandleChar(uint code) {
+  RequestImmediateFrame();
+
+  if (m_term.searching()) {
+    utf8::append(code, std::back_inserter(m_search_query));
+    UpdateSearch(m_term.SetSearchQuery(m_search_query));
+  } else {
+    m_term.WriteUnicodeToPty(code);
+  }
 }
 
-void Uterm::HandleResize(int width, int height) {
+void Session::HandleSearchKey(uint32 keysym, int mods) {
+  switch (keysym) {
+  case XKB_KEY_Escape:
+    m_term.EndSearch();
+    m_window.SetTitle(m_title);
+    break;
+  case XKB_KEY_BackSpace:
+    if (!m_search_query.empty()) {
+      // Drop the continuation bytes of the last codepoint, then its first byte.
+      while ((m_search_query.back() & 0xC0) == 0x80) {
+        m_search_query.pop_back();
+      }
+      m_search_query.pop_back();
+    }
+
+    UpdateSearch(m_term.SetSearchQuery(m_search_query));
+    break;
+  case XKB_KEY_Return:
+    // Enter goes to the next older match, and Shift+Enter to the next newer one.
+    UpdateSearch(m_term.SearchNext(mods & KeyboardModifier::kShift ?
+                                   ScrollDirection::kDown : ScrollDirection::kUp));
+    break;
+  case XKB_KEY_Up:
+    UpdateSearch(m_term.SearchNext(ScrollDirection::kUp));
+    break;
+  case XKB_KEY_Down:
+    UpdateSearch(m_term.SearchNext(ScrollDirection::kDown));
+    break;
+  default:
+    // Everything else is either typed via HandleChar, or ignored.
+    break;
+  }
+}
+
+void Session::UpdateSearch(bool found) {
+  if (found || m_search_query.empty()) {
+    m_window.SetTitle(fmt::format("search: {}", m_search_query));
+  } else {
+    m_window.SetTitle(fmt::format("search: {} (no match)", m_search_query));
+  }
+}
+
+void Session::ToggleStatsOverlay() {
+  m_stats_overlay = !m_stats_overlay;
+
+  if (!m_stats_overlay) {
+    // Redraw the cells that were under it.
+    m_display.Invalidate();
+  }
+}
+
+void Session::HandleResize(int width, int height) {
+  m_has_pending_resize = true;
+  m_pending_width = width;
+  m_pending_height = height;
+  m_resize_deadline = glfwGetTime() + kResizeSettleTime;
+
+  // The window still has to show its new size right away.
+  RequestImmediateFrame();
+}
+
+void Session::HandleSurfaceReset() {
+  m_display.Invalidate();
+  RequestImmediateFrame();
+}
+
+void Session::ApplyResize(int width, int height) {
+  m_has_pending_resize = false;
+
+  int cols = m_display.cols(), rows = m_display.rows();
   if (auto err = m_display.Resize(width, height)) {
     err.Extend("while resizing terminal display").Print();
   }
+
+  if (m_display.cols() == cols && m_display.rows() == rows) {
+    return;
+  }
+
+  // The surface can be larger than the window, and the old cells outside the new grid
+  // are still on it.
+  m_window.canvas()->clear(m_config.theme()[Colors::kBackground]);
+  RequestImmediateFrame();
+
+  if (m_recorder.is_open()) {
+    if (auto err = m_recorder.WriteResize(m_display.cols(), m_display.rows())) {
+      err.Extend("while recording resize").Print();
+    }
+  }
 }
 
-void Uterm::HandleSelection(Selection state, double mx, double my) {
+void Session::HandleSelection(Selection state, double mx, double my) {
+  RequestImmediateFrame();
   if (state == Selection::kEnd) {
     m_display.EndSelection();
   } else {
@@ -179,10 +670,14 @@ void Uterm::HandleSelection(Selection state, double mx, double my) {
   }
 }
 
-void Uterm::HandleScroll(ScrollDirection direction, uint distance) {
+void Session::HandleScroll(ScrollDirection direction, uint distance) {
+  RequestImmediateFrame();
   m_term.Scroll(direction, distance);
 }
 
-void Uterm::HandleTitle(const string &title) {
-  m_window.SetTitle(title);
+void Session::HandleTitle(const string &title) {
+  m_title = title;
+  if (!m_term.searching()) {
+    m_window.SetTitle(title);
+  }
 }
@@ -4,8 +4,14 @@
 #include "terminal.h"
 #include "display.h"
 #include "config.h"
+#include "ring_buffer.h"
+#include "asciicast.h"
+#include "server.h"
 
 #include <atomic>
+#include <chrono>
+#include <functional>
+#include <memory>
 #include <thread>
 #include <mutex>
 
@@ -17,53 +23,189 @@ private:
   std::atomic<bool> m_flag{false};
 };
 
-class ProtectedBuffer {
-public:
-  void Append(string text);
-  string ReadAndClear();
-private:
-  std::mutex m_lock;
-  string m_buffer;
-};
-
 class ReaderThread {
 public:
-  ReaderThread(Pty *pty);
+  using WakeCb = std::function<void()>;
+
+  // Creates a thread reading from the given pty, in reads of up to read_size bytes.
+  // Reads are batched for up to read_latency microseconds before the main thread is
+  // told about them via wake_cb (which is called from the reader thread). wake_cb is
+  // also called once reading is done. If recorder is open, everything read is also
+  // written to it.
+  ReaderThread(Pty *pty, size_t read_size, int read_latency, WakeCb wake_cb,
+               CastWriter *recorder);
 
   void Interrupt();
   void Stop();
 
-  ProtectedBuffer & buffer() { return m_buffer; }
+  // Called from the SIGCHLD handler when the given process has been reaped.
+  void HandleChildExit(int pid);
+
+  RingBuffer & buffer() { return m_buffer; }
   bool done() { return m_done_flag.get(); }
 private:
-  void StaticRun(Pty *pty);
+  void StaticRun();
+  // Reads from the pty until it's empty or the latency budget is used up, returning
+  // the number of bytes read. Sets *wake if the main thread needs to be woken up.
+  size_t ReadBatch(bool *eof, bool *wake);
 
-  std::thread m_thread;
-  ProtectedBuffer m_buffer;
+  // When the buffer is full, the reader stops reading until the main thread catches
+  // up, which in turn makes the kernel throttle the child process.
+  static constexpr size_t kMinBufferSize = 1 << 20;
+
+  Pty *m_pty;
+  size_t m_read_size;
+  std::chrono::microseconds m_read_latency;
+  WakeCb m_wake_cb;
+  CastWriter *m_recorder;
+  RingBuffer m_buffer;
   AtomicFlag m_done_flag;
+  std::thread m_thread;
 };
 
-class Uterm {
+struct UtermOptions {
+  // If not empty, the session is recorded into this file in the asciicast v2 format.
+  string record;
+  // If not empty, the output is replayed from this asciicast file instead of coming
+  // from a shell.
+  string replay;
+  // Whether to replay the output as fast as possible instead of at the original speed.
+  bool replay_fast{false};
+  // Whether to open windows for clients connecting to the socket, rather than opening
+  // one right away.
+  bool server{false};
+  // Whether to ask the server listening on the socket for a window. If there's no
+  // server, the window is opened as usual.
+  bool client{false};
+  // The server's socket, or empty for the default one.
+  string socket;
+};
+
+// A Session is a single terminal window, along with the shell (or replay) running in
+// it. The config and fonts belong to the Uterm hosting it, and are shared with all of
+// its other sessions.
+class Session {
 public:
-  int Run();
-  void InterruptReader();
+  Session(const Config &config, FontSet *fonts);
+  ~Session();
+
+  // Opens the window, and either spawns a shell in the given directory (or the current
+  // one, if it's empty) or starts the replay given in the options.
+  Error Start(const UtermOptions &options, const string &cwd);
+
+  // Parses the output that's waiting, and draws a frame if one is due, along with the
+  // given overlay lines if the overlay is on. sample_overlay is true if the lines were
+  // just updated. Returns how long the main loop may wait before the next call (-1 for
+  // as long as it likes).
+  double Update(const std::vector<string> &overlay_lines, bool sample_overlay);
+
+  // Whether the window was closed or the shell is gone.
+  bool done();
+  bool stats_overlay() const { return m_stats_overlay; }
+
+  void HandleChildExit(int pid);
 private:
   void HandleCopy(const string &str);
   string HandlePaste();
   void HandleKey(uint32 keysym, int mods);
   void HandleChar(uint code);
   void HandleResize(int width, int height);
+  void HandleSurfaceReset();
   void HandleSelection(Selection state, double mx, double my);
   void HandleScroll(ScrollDirection direction, uint distance);
   void HandleTitle(const string &title);
 
-  std::mutex m_current_reader_lock;
-  ReaderThread *m_current_reader{nullptr};
+  // While searching, keys edit the query instead of going to the shell, and the window
+  // title shows the query.
+  void HandleSearchKey(uint32 keysym, int mods);
+  void UpdateSearch(bool found);
+
+  void ToggleStatsOverlay();
+
+  // Parses the output waiting in the buffer, until either all of it has been parsed or
+  // the deadline passes.
+  void ParseOutput(RingBuffer *buffer, double deadline);
+  // Like ParseOutput, but for the replayed output that's due by now. Returns how many
+  // bytes of it are still waiting to be parsed (stopping at kFastScrollBacklog).
+  size_t ReplayOutput(double deadline);
+  // Returns the number of seconds until the next replayed output is due, or -1 if
+  // there's none left.
+  double NextReplayOutput();
+
+  // Resizes the display (and with it, the shell) to fit a window of the given size.
+  void ApplyResize(int width, int height);
+
+  // Makes the next frame get drawn as soon as possible, rather than waiting for the
+  // frame deadline. Used for anything directly triggered by the user.
+  void RequestImmediateFrame();
+
+  const Config &m_config;
+
+  // The time the last frame was drawn, and the earliest time at which the next one may
+  // be drawn.
+  double m_last_frame{0}, m_next_frame{0};
+
+  // While the window is being resized, the latest size, which is applied once it hasn't
+  // changed for kResizeSettleTime seconds (i.e. at m_resize_deadline).
+  bool m_has_pending_resize{false};
+  int m_pending_width{0}, m_pending_height{0};
+  double m_resize_deadline{0};
+
+  bool m_stats_overlay{false};
+  // Whether any output was parsed yet, for the startup stats.
+  bool m_has_output{false};
+
+  // The search query being typed, and the title set by the shell, which is put back
+  // once the search is done.
+  string m_search_query, m_title{"uterm"};
+
+  CastWriter m_recorder;
+
+  // The output being replayed, and the position in it.
+  std::vector<CastEvent> m_replay_events;
+  size_t m_replay_index{0}, m_replay_offset{0};
+  double m_replay_start{0};
+  bool m_replay_fast{false};
+
+  Pty m_pty;
+  // Not set when replaying.
+  std::unique_ptr<ReaderThread> m_reader;
 
-  Config m_config;
   Terminal m_term;
-  Display m_display{&m_term};
+  Display m_display;
   Window m_window;
 };
 
+class Uterm {
+public:
+  int Run(const UtermOptions &options);
+  // Called from the thread waiting for SIGCHLD, so this only notes that a child exited;
+  // the main loop reaps it the next time it wakes up.
+  void RequestReap() { m_reap_requested.store(true); }
+private:
+  // Reaps every exited child, and lets the session it belonged to know.
+  void ReapChildren();
+  // Opens a new window, with its shell started in the given directory.
+  Error OpenSession(const UtermOptions &options, const string &cwd);
+  // Updates all the sessions, and closes the ones that are done. Returns how long the
+  // main loop may wait for events.
+  double UpdateSessions();
+
+  void DumpStats();
+
+  // The overlay shows the stats sampled every kStatsOverlayInterval seconds, while any
+  // session has it on.
+  static constexpr double kStatsOverlayInterval = 1;
+  bool m_sampling_stats{false};
+  std::vector<string> m_overlay_lines;
+  double m_next_overlay_sample{0};
+
+  Config m_config;
+  FontSet m_fonts;
+  Server m_server;
+
+  std::atomic<bool> m_reap_requested{false};
+  std::vector<std::unique_ptr<Session>> m_sessions;
+};
+
 extern Uterm gUterm;
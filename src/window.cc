@@ -1,16 +1,69 @@
 #include "window.h"
 #include "terminal.h"
 #include "keys.h"
+#include "stats.h"
 
 #include <absl/memory/memory.h>
 
+#include <algorithm>
+
+#if SK_SUPPORT_GPU
+#include <GrBackendSurface.h>
+#include <gl/GrGLAssembleInterface.h>
+#include <gl/GrGLInterface.h>
+#endif
+
 const int kGLMajor = 3, kGLMinor = 3, kSamples = 4;
 
-Window::Window() {}
+// Surfaces are allocated a quarter larger than the framebuffer, rounded up to a
+// multiple of kSurfaceAlignment, so dragging a window's edge doesn't reallocate them at
+// every step. They're only shrunk once the framebuffer is less than half their size.
+const int kSurfaceAlignment = 64;
+
+static int SurfaceSize(int size, int current, int max) {
+  if (size <= current && size > current / 2) {
+    return current;
+  }
+
+  int padded = size + size / 4;
+  padded = (padded + kSurfaceAlignment - 1) / kSurfaceAlignment * kSurfaceAlignment;
+  return std::max(std::min(padded, max), size);
+}
+
+Window::Window(): m_gl{absl::make_unique<GLManager>()} {}
 
 Window::~Window() {
+  if (m_window == nullptr) {
+    return;
+  }
+
+  // Other windows may still be around, so everything that lives in this window's GL
+  // context has to be released while it's current.
+  glfwMakeContextCurrent(m_window);
+  m_gl.reset();
+  m_surface.reset();
+  #if SK_SUPPORT_GPU
+  m_fb_surface.reset();
+  m_gr_context.reset();
+  #endif
+
   glfwSetCursor(m_window, nullptr);
   glfwDestroyCursor(m_cursor);
+  glfwDestroyWindow(m_window);
+}
+
+Error Window::InitializeGlfw() {
+  glfwSetErrorCallback([](int ec, const char *err) {
+    fmt::print("GLFW error: {}\n", err);
+  });
+
+  if (!glfwInit())
+    return Error::New("failed to initialize GLFW");
+
+  return Error::New();
+}
+
+void Window::TerminateGlfw() {
   glfwTerminate();
 }
 
@@ -19,21 +72,24 @@ void Window::set_char_cb(CharCb char_cb) { m_char_cb = char_cb; }
 void Window::set_resize_cb(ResizeCb resize_cb) { m_resize_cb = resize_cb; }
 void Window::set_selection_cb(SelectionCb selection_cb) { m_selection_cb = selection_cb; }
 void Window::set_scroll_cb(ScrollCb scroll_cb) { m_scroll_cb = scroll_cb; }
+void Window::set_surface_cb(SurfaceCb surface_cb) { m_surface_cb = surface_cb; }
 
 bool Window::isopen() {
   assert(m_window);
   return !glfwWindowShouldClose(m_window);
 }
 
-Error Window::Initialize(int width, int height, int vsync, const Theme& theme) {
-  m_theme = &theme;
-
-  glfwSetErrorCallback([](int ec, const char *err) {
-    fmt::print("GLFW error: {}\n", err);
-  });
+bool Window::gpu_active() const {
+  #if SK_SUPPORT_GPU
+  return m_gr_context != nullptr;
+  #else
+  return false;
+  #endif
+}
 
-  if (!glfwInit())
-    return Error::New("failed to initialize GLFW");
+Error Window::Initialize(int width, int height, int vsync, bool gpu,
+                         const Theme& theme) {
+  m_theme = &theme;
 
   glfwWindowHint(GLFW_CONTEXT_VERSION_MAJOR, kGLMajor);
   glfwWindowHint(GLFW_CONTEXT_VERSION_MINOR, kGLMinor);
@@ -62,7 +118,9 @@ Error Window::Initialize(int width, int height, int vsync, const Theme& theme) {
   glfwSetCharCallback(m_window, StaticCharCallback);
   glfwSetWindowSizeCallback(m_window, StaticWinResizeCallback);
   glfwSetFramebufferSizeCallback(m_window, StaticFbResizeCallback);
+  glfwSetWindowRefreshCallback(m_window, StaticRefreshCallback);
   glfwSetMouseButtonCallback(m_window, StaticMouseCallback);
+  glfwSetCursorPosCallback(m_window, StaticCursorPosCallback);
   glfwSetScrollCallback(m_window, StaticScrollCallback);
 
   m_cursor = glfwCreateStandardCursor(GLFW_IBEAM_CURSOR);
@@ -75,12 +133,21 @@ Error Window::Initialize(int width, int height, int vsync, const Theme& theme) {
     return Error::New("failed to ensure OpenGL >=3.0 is supported");
 
   glfwGetFramebufferSize(m_window, &m_fb_width, &m_fb_height);
+  glGetIntegerv(GL_MAX_TEXTURE_SIZE, &m_max_surface_size);
 
-  if (auto err = m_gl.Initialize(m_fb_width, m_fb_height)) {
-    return err;
+  if (gpu) {
+    if (auto err = InitializeGpu()) {
+      err.Extend("falling back to CPU rendering").Print();
+    }
   }
 
-  if (auto err = CreateSurface()) {
+  if (!gpu_active()) {
+    if (auto err = m_gl->Initialize()) {
+      return err;
+    }
+  }
+
+  if (auto err = ResizeSurface()) {
     return err;
   }
 
@@ -100,45 +167,170 @@ void Window::SetTitle(const string &title) {
   glfwSetWindowTitle(m_window, title.c_str());
 }
 
-void Window::DrawAndPoll(bool significant_redraw) {
-  if (significant_redraw) {
+void Window::Draw(const SkIRect &damage) {
+  if (damage.isEmpty() && !m_needs_present && !m_needs_full_upload) {
+    return;
+  }
+
+  glfwMakeContextCurrent(m_window);
+
+  #if SK_SUPPORT_GPU
+  if (gpu_active()) {
+    // The damage doesn't matter here: copying the whole surface on the GPU is cheap.
+    m_surface->draw(m_fb_surface->getCanvas(), 0, 0, nullptr);
+    {
+      ScopedTimer timer{Stage::kFlush};
+      m_fb_surface->getCanvas()->flush();
+    }
+
+    glfwSwapBuffers(m_window);
+    m_needs_present = false;
+    m_needs_full_upload = false;
+    return;
+  }
+  #endif
+
+  SkIRect upload = m_needs_full_upload ? SkIRect::MakeWH(m_fb_width, m_fb_height)
+                                       : damage;
+  if (!upload.isEmpty() && upload.intersect(SkIRect::MakeWH(m_fb_width, m_fb_height))) {
     SkPixmap pixmap;
-    canvas()->flush();
+    {
+      ScopedTimer timer{Stage::kFlush};
+      canvas()->flush();
+    }
     canvas()->peekPixels(&pixmap);
 
-    m_gl.UpdateTextureData(pixmap.addr());
+    m_gl->UpdateTextureData(pixmap.addr(), pixmap.rowBytes() / 4, upload.x(), upload.y(),
+                           upload.width(), upload.height());
   }
 
-  m_gl.Draw();
+  m_gl->Draw();
   glfwSwapBuffers(m_window);
+  m_needs_present = false;
+  m_needs_full_upload = false;
+}
 
-  bool previous_selection_status = m_selection_active;
-  glfwPollEvents();
+void Window::WaitEvents(double timeout) {
+  if (timeout < 0) {
+    glfwWaitEvents();
+  } else if (timeout == 0) {
+    glfwPollEvents();
+  } else {
+    glfwWaitEventsTimeout(timeout);
+  }
+}
 
-  double mx, my;
-  glfwGetCursorPos(m_window, &mx, &my);
+void Window::Wake() {
+  glfwPostEmptyEvent();
+}
 
-  if (m_selection_active) {
-    if (previous_selection_status) {
-      m_selection_cb(Selection::kUpdate, mx, my);
-    } else {
-      m_selection_cb(Selection::kBegin, mx, my);
-    }
-  } else if (previous_selection_status) {
-    m_selection_cb(Selection::kEnd, mx, my);
+Error Window::ResizeSurface() {
+  int width = SurfaceSize(m_fb_width, m_surface_width, m_max_surface_size),
+      height = SurfaceSize(m_fb_height, m_surface_height, m_max_surface_size);
+  bool reallocate = m_surface == nullptr || width != m_surface_width ||
+                    height != m_surface_height;
+
+  if (!gpu_active()) {
+    m_gl->Resize(m_fb_width, m_fb_height, width, height);
   }
-}
 
-Error Window::CreateSurface() {
-  auto info = SkImageInfo::Make(m_fb_width, m_fb_height, kRGBA_8888_SkColorType,
+  auto info = SkImageInfo::Make(width, height, kRGBA_8888_SkColorType,
                                 kPremul_SkAlphaType);
-  m_surface = SkSurface::MakeRaster(info);
+
+  #if SK_SUPPORT_GPU
+  if (gpu_active()) {
+    if (auto err = WrapFramebuffer()) {
+      return err;
+    }
+
+    if (reallocate) {
+      m_surface = SkSurface::MakeRenderTarget(m_gr_context.get(), SkBudgeted::kNo,
+                                              info);
+    }
+  } else if (reallocate) {
+    m_surface = SkSurface::MakeRaster(info);
+  }
+  #else
+  if (reallocate) {
+    m_surface = SkSurface::MakeRaster(info);
+  }
+  #endif
+
+  if (!reallocate) {
+    return Error::New();
+  }
+
   if (m_surface == nullptr) {
     return Error::New("failed to create SkSurface");
   }
 
+  m_surface_width = width;
+  m_surface_height = height;
+
   canvas()->clear((*m_theme)[Colors::kBackground]);
+  if (m_surface_cb) {
+    m_surface_cb();
+  }
+
+  return Error::New();
+}
+
+Error Window::InitializeGpu() {
+  #if SK_SUPPORT_GPU
+  auto interface = GrGLMakeAssembledInterface(nullptr,
+                                              [](void *ctx, const char name[]) {
+    return reinterpret_cast<GrGLFuncPtr>(glfwGetProcAddress(name));
+  });
+  if (interface == nullptr) {
+    return Error::New("failed to create the Skia OpenGL interface");
+  }
+
+  m_gr_context = GrContext::MakeGL(interface);
+  if (m_gr_context == nullptr) {
+    return Error::New("failed to create the Skia GPU context");
+  }
+
+  // If the framebuffer can't be rendered to, it's not too late to use the CPU instead.
+  if (auto err = WrapFramebuffer()) {
+    m_gr_context.reset();
+    return err;
+  }
+
   return Error::New();
+  #else
+  return Error::New("uterm was built without GPU support (see --enable-gpu)");
+  #endif
+}
+
+Error Window::WrapFramebuffer() {
+  #if SK_SUPPORT_GPU
+  // Skia might have left one of its own framebuffers bound.
+  glBindFramebuffer(GL_FRAMEBUFFER, 0);
+  m_gr_context->resetContext();
+
+  GLint samples, stencil_bits;
+  glGetIntegerv(GL_SAMPLES, &samples);
+  glGetFramebufferAttachmentParameteriv(GL_DRAW_FRAMEBUFFER, GL_STENCIL,
+                                        GL_FRAMEBUFFER_ATTACHMENT_STENCIL_SIZE,
+                                        &stencil_bits);
+
+  GrGLFramebufferInfo fb_info;
+  fb_info.fFBOID = 0;
+  fb_info.fFormat = GL_RGBA8;
+
+  GrBackendRenderTarget target{m_fb_width, m_fb_height, samples, stencil_bits, fb_info};
+  m_fb_surface = SkSurface::MakeFromBackendRenderTarget(m_gr_context.get(), target,
+                                                        kBottomLeft_GrSurfaceOrigin,
+                                                        kRGBA_8888_SkColorType, nullptr,
+                                                        nullptr);
+  if (m_fb_surface == nullptr) {
+    return Error::New("failed to wrap the default framebuffer in an SkSurface");
+  }
+
+  return Error::New();
+  #else
+  return Error::New("uterm was built without GPU support (see --enable-gpu)");
+  #endif
 }
 
 void Window::StaticKeyCallback(GLFWwindow *glfw_window, int key, int scancode,
@@ -173,25 +365,43 @@ void Window::StaticFbResizeCallback(GLFWwindow *glfw_window, int width, int heig
   }
 
   Window *window = static_cast<Window*>(glfwGetWindowUserPointer(glfw_window));
+  glfwMakeContextCurrent(glfw_window);
 
   window->m_fb_width = width;
   window->m_fb_height = height;
-  window->m_gl.Resize(width, height);
+  window->m_needs_full_upload = true;
 
-  if (auto err = window->CreateSurface()) {
-    err.Extend("in StaticResizeCallback").Print();
+  if (auto err = window->ResizeSurface()) {
+    err.Extend("in StaticFbResizeCallback").Print();
   }
 }
 
+void Window::StaticRefreshCallback(GLFWwindow *glfw_window) {
+  Window *window = static_cast<Window*>(glfwGetWindowUserPointer(glfw_window));
+  window->m_needs_present = true;
+}
+
 void Window::StaticMouseCallback(GLFWwindow *glfw_window, int button, int action,
                                  int mods) {
   if (button != GLFW_MOUSE_BUTTON_LEFT) return;
   Window *window = static_cast<Window*>(glfwGetWindowUserPointer(glfw_window));
 
+  double mx, my;
+  glfwGetCursorPos(glfw_window, &mx, &my);
+
   if (action == GLFW_PRESS) {
     window->m_selection_active = true;
-  } else if (action == GLFW_RELEASE) {
+    window->m_selection_cb(Selection::kBegin, mx, my);
+  } else if (action == GLFW_RELEASE && window->m_selection_active) {
     window->m_selection_active = false;
+    window->m_selection_cb(Selection::kEnd, mx, my);
+  }
+}
+
+void Window::StaticCursorPosCallback(GLFWwindow *glfw_window, double mx, double my) {
+  Window *window = static_cast<Window*>(glfwGetWindowUserPointer(glfw_window));
+  if (window->m_selection_active) {
+    window->m_selection_cb(Selection::kUpdate, mx, my);
   }
 }
 
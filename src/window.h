@@ -11,7 +11,12 @@
 #include <SkCanvas.h>
 #include <SkSurface.h>
 
+#if SK_SUPPORT_GPU
+#include <GrContext.h>
+#endif
+
 #include <functional>
+#include <memory>
 
 class Window {
 public:
@@ -20,25 +25,49 @@ public:
   using ResizeCb = std::function<void(int, int)>;
   using SelectionCb = std::function<void(Selection, double, double)>;
   using ScrollCb = std::function<void(ScrollDirection, uint)>;
+  using SurfaceCb = std::function<void()>;
 
   Window();
   ~Window();
 
+  // Sets up and tears down GLFW, which is shared by all the windows in the process.
+  // InitializeGlfw must be called before anything else here.
+  static Error InitializeGlfw();
+  static void TerminateGlfw();
+
   void set_key_cb(KeyCb key_cb);
   void set_char_cb(CharCb char_cb);
   void set_resize_cb(ResizeCb resize_cb);
   void set_selection_cb(SelectionCb selection_cb);
   void set_scroll_cb(ScrollCb scroll_cb);
+  // Called when the surface was replaced, and everything has to be drawn again.
+  void set_surface_cb(SurfaceCb surface_cb);
 
-  Error Initialize(int width, int height, int vsync, const Theme& theme);
+  // If gpu is true and Skia was built with GPU support, rendering is done with OpenGL;
+  // otherwise (or if that fails), it's done on the CPU.
+  Error Initialize(int width, int height, int vsync, bool gpu, const Theme& theme);
   bool isopen();
+  // Whether rendering is being done on the GPU.
+  bool gpu_active() const;
+  // The canvas can be larger than the window, in which case only its top left corner
+  // is shown.
   SkCanvas * canvas() { return m_surface->getCanvas(); }
 
   string ClipboardRead();
   void ClipboardWrite(const string &str);
   void SetTitle(const string &str);
 
-  void DrawAndPoll(bool significant_redraw);
+  // Presents the current canvas contents, of which only the damaged area has changed
+  // since the last call. If nothing was damaged and the window doesn't need to be
+  // repainted, this does nothing.
+  void Draw(const SkIRect &damage);
+  // Processes pending events for all windows, waiting up to timeout seconds for one to
+  // arrive. A negative timeout waits indefinitely.
+  static void WaitEvents(double timeout);
+
+  // Wakes up a WaitEvents call. Unlike the rest of the methods, this is safe to call
+  // from any thread.
+  static void Wake();
 private:
   const Theme *m_theme{nullptr};
 
@@ -47,23 +76,50 @@ private:
   ResizeCb m_resize_cb;
   SelectionCb m_selection_cb;
   ScrollCb m_scroll_cb;
+  SurfaceCb m_surface_cb;
 
-  Error CreateSurface();
+  // Makes sure the surface (and the texture, when rendering on the CPU) covers the
+  // framebuffer. They're allocated with room to spare, so most resizes only change how
+  // much of them is shown.
+  Error ResizeSurface();
+  // Sets up the GPU backend, and leaves it inactive if that fails.
+  Error InitializeGpu();
+  // Wraps the default framebuffer in m_fb_surface, at the current framebuffer size.
+  Error WrapFramebuffer();
 
   static void StaticKeyCallback(GLFWwindow *glfw_window, int key, int scancode,
                                 int action, int glfw_mods);
   static void StaticCharCallback(GLFWwindow *glfw_window, uint code);
   static void StaticWinResizeCallback(GLFWwindow *glfw_window, int width, int height);
   static void StaticFbResizeCallback(GLFWwindow *glfw_window, int width, int height);
+  static void StaticRefreshCallback(GLFWwindow *glfw_window);
   static void StaticMouseCallback(GLFWwindow *glfw_window, int button, int action,
                                   int mods);
+  static void StaticCursorPosCallback(GLFWwindow *glfw_window, double mx, double my);
   static void StaticScrollCallback(GLFWwindow *glfw_window, double xoffset,
                                    double yoffset);
 
   GLFWwindow *m_window{nullptr};
   GLFWcursor *m_cursor{nullptr};
-  GLManager m_gl;
+  // Only used when rendering on the CPU. Its GL objects belong to this window's
+  // context, so they're released before the window goes away.
+  std::unique_ptr<GLManager> m_gl;
   int m_fb_width, m_fb_height;
+  // The size m_surface was allocated with, and the largest one allowed.
+  int m_surface_width{0}, m_surface_height{0};
+  int m_max_surface_size{0};
   bool m_selection_active{false};
+  bool m_needs_present{true};
+  // Set when the texture's contents were lost (e.g. on resize), and the whole canvas
+  // has to be uploaded again regardless of the damage.
+  bool m_needs_full_upload{true};
   sk_sp<SkSurface> m_surface;
+
+  #if SK_SUPPORT_GPU
+  // When rendering on the GPU, m_surface is an offscreen render target (the display
+  // only redraws what changed, so its contents have to survive buffer swaps), which is
+  // copied to m_fb_surface, wrapping the default framebuffer, when presenting.
+  sk_sp<GrContext> m_gr_context;
+  sk_sp<SkSurface> m_fb_surface;
+  #endif
 };
@@ -24,7 +24,7 @@ cd ..
 export PKG_CONFIG_PATH=/usr/lib/pkgconfig
 # XXX
 sed -i '/#include <GLES2\/gl2.h>/d' deps/skia/src/gpu/gl/egl/*.cpp
-if ! fbuild --release --cc=gcc --cxx=g++ --ld=gold --no-force-color -j4; then
+if ! FBUILD_FLAGS='--cc=gcc --cxx=g++ --ld=gold --no-force-color -j4' ./pgo.sh; then
   set +x
   echo '*******************************'
   echo '********** BUILD LOG **********'